@@ -0,0 +1,212 @@
+"""
+Versoes ASGI das views SSE (chat e jobs). Uma conexao aberta e uma corrotina
+esperando no Redis, nao uma thread/worker: servidas por setup/asgi.py com
+AI_ASYNC_SSE ligado (ver urls.py).
+"""
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .serializers import ChatRequestSerializer, JobStatusSerializer
+from .services.chat import achat_stream
+from .services.chat_sessions import asession_stream, open_session
+from .services.jobs import TERMINAL_STATUSES, user_channel
+from .services.redis_client import blocking_wait, get_async_redis
+from .services.sse_replay import aproduce, areplay, asession_owner
+from . import views
+from .views import (
+    _job_events,
+    _job_message_events,
+    _last_event_id,
+    _parse_job_ids,
+    _stream_jobs,
+    encode_sse,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _authenticate_sync(request):
+    # mesmos autenticadores do DRF (JWT no header ou no cookie)
+    drf_request = Request(request, authenticators=[cls() for cls in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        user = drf_request.user
+    except APIException:
+        return None
+    return user if user and user.is_authenticated else None
+
+
+async def _authenticate(request):
+    return await sync_to_async(_authenticate_sync)(request)
+
+
+def _unauthorized() -> JsonResponse:
+    return JsonResponse({"detail": "As credenciais de autenticacao nao foram fornecidas."}, status=401)
+
+
+def _sse_response(stream, session_id: str | None = None) -> StreamingHttpResponse:
+    resp = StreamingHttpResponse(stream, content_type="text/event-stream")
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"
+    if session_id:
+        resp["X-Chat-Session"] = session_id
+    return resp
+
+
+async def achat_packets(user, data: dict):
+    """Mesmo contrato de views.chat_packets, com os geradores async do chat."""
+    if data.get("message"):
+        chat = await sync_to_async(open_session)(user, data.get("session_id"))
+        if chat is None:
+            return None
+        return str(chat.id), asession_stream(user, chat, data["message"])
+    session_id = str(uuid.uuid4())
+    return session_id, achat_stream(user, data["messages"], session_id)
+
+
+async def _resume_chat_stream(user, session_id: str, last_id: int):
+    if await asession_owner(session_id) != str(user.id):
+        return JsonResponse({"detail": "Sessao nao encontrada ou expirada."}, status=404)
+    logger.info(json.dumps({
+        "timestamp": datetime.now().isoformat(),
+        "session_id": session_id,
+        "event": "sse_stream_resumed",
+        "last_event_id": last_id,
+    }))
+
+    async def event_source():
+        yield "retry: 1000\n\n"
+        async for item in areplay(session_id, last_id):
+            if item is None:
+                yield ": ping\n\n"
+                continue
+            event_id, event_name, payload = item
+            yield encode_sse(event_name, payload, event_id=event_id)
+
+    return _sse_response(event_source(), session_id)
+
+
+class AsyncChatSSEView(View):
+    """POST /chat/stream/: mesmo contrato de views.ChatSSEView."""
+
+    async def post(self, request):
+        user = await _authenticate(request)
+        if user is None:
+            return _unauthorized()
+        resume_id = request.GET.get("session_id")
+        if resume_id and request.headers.get("Last-Event-ID") is not None:
+            return await _resume_chat_stream(user, resume_id, _last_event_id(request))
+        try:
+            body = json.loads(request.body or b"{}")
+        except ValueError:
+            return JsonResponse({"detail": "JSON invalido"}, status=400)
+        s = ChatRequestSerializer(data=body)
+        if not s.is_valid():
+            return JsonResponse(s.errors, status=400)
+        packets = await achat_packets(user, s.validated_data)
+        if packets is None:
+            return JsonResponse({"detail": "Sessao de chat nao encontrada."}, status=404)
+        session_id, packets = packets
+        logger.info(json.dumps({
+            "timestamp": datetime.now().isoformat(),
+            "session_id": session_id,
+            "event": "chat_sse_request",
+            "user": str(user),
+            "messages_count": len(s.validated_data.get("messages") or []),
+        }))
+        # o turno roda numa task do event loop (astream; so as tool calls e o
+        # ORM passam por sync_to_async); a conexao aguarda num asyncio.Queue
+        events = aproduce(session_id, user.id, packets)
+
+        async def event_source():
+            yield "retry: 1000\n\n"
+            total = 0
+            async for event_id, event_name, payload in events:
+                total = event_id
+                yield encode_sse(event_name, payload, event_id=event_id)
+            logger.info(json.dumps({
+                "timestamp": datetime.now().isoformat(),
+                "session_id": session_id,
+                "event": "sse_stream_completed",
+                "total_events": total,
+            }))
+
+        return _sse_response(event_source(), session_id)
+
+
+class AsyncChatSSEResumeView(View):
+    """GET /chat/stream/<session_id>/: replay do buffer da sessao a partir do Last-Event-ID."""
+
+    async def get(self, request, session_id):
+        user = await _authenticate(request)
+        if user is None:
+            return _unauthorized()
+        return await _resume_chat_stream(user, str(session_id), _last_event_id(request))
+
+
+def _job_snapshot(jobs, job_id: str | None) -> tuple[list[str], bool]:
+    events = []
+    for job in jobs:
+        data = JobStatusSerializer(job).data
+        events.extend(_job_events(data))
+        if job_id and data["status"] in TERMINAL_STATUSES:
+            return events, True
+    return events, False
+
+
+class AsyncJobStreamView(View):
+    """GET /jobs/stream/: mesmo contrato de views.JobStreamView, com redis.asyncio."""
+
+    async def get(self, request):
+        user = await _authenticate(request)
+        if user is None:
+            return _unauthorized()
+        job_id = None
+        if request.GET.get("job_id"):
+            ids = _parse_job_ids(request.GET["job_id"])
+            if not ids:
+                return JsonResponse({"detail": "job_id invalido"}, status=400)
+            job_id = str(ids[0])
+        jobs = _stream_jobs(user, job_id)
+        if job_id and not await jobs.aexists():
+            return JsonResponse({"detail": "Job nao encontrado."}, status=404)
+        channel = user_channel(user.id)
+
+        async def event_source():
+            pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+            # assina antes de ler o snapshot: nenhum evento se perde entre os dois
+            await pubsub.subscribe(channel)
+            try:
+                yield "retry: 1000\n\n"
+                events, done = await sync_to_async(_job_snapshot)(jobs, job_id)
+                for chunk in events:
+                    yield chunk
+                if done:
+                    return
+                loop = asyncio.get_running_loop()
+                # lidos de views na hora: um so lugar para ajustar (e para os testes)
+                deadline = loop.time() + views.JOB_STREAM_MAX_S
+                while loop.time() < deadline:
+                    message = await pubsub.get_message(timeout=blocking_wait(views.JOB_STREAM_HEARTBEAT_S))
+                    if message is None:
+                        yield ": ping\n\n"
+                        continue
+                    events, done = _job_message_events(message["data"], job_id)
+                    for chunk in events:
+                        yield chunk
+                    if done:
+                        return
+                yield encode_sse("meta", {"job_id": job_id, "status": "timeout"})
+            finally:
+                await pubsub.aclose()
+
+        return _sse_response(event_source())
@@ -1,13 +1,12 @@
 import os
-import json
 import logging
-from datetime import datetime
-from typing import Optional, Iterable
-from google import genai
+from typing import AsyncIterator, Optional, Iterable
+from asgiref.sync import sync_to_async
 from google.genai import types
 from collections.abc import Mapping
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+from apps.ai.services import llm_cache, llm_metrics, rate_limit
+from apps.ai.services.genai_client import get_async_client, get_client
 
 CHAT_MODEL = os.getenv("GEMINI_CHAT_MODEL")
 
@@ -112,64 +111,183 @@ def tool_config_auto() -> types.ToolConfig:
     )
 
 
+class _Call:
+    """
+    Partes comuns de generate/agenerate/astream (config, tokens estimados,
+    trace e cache); so a chamada ao SDK, sync ou async, fica com cada um.
+    """
+
+    def __init__(self, contents, schema=None, tools=None, session_id=None, call_site="other"):
+        self.schema = schema
+        self.tools = tools
+        self.session_id = session_id
+        self.call_site = call_site
+        self.request = {
+            "model": CHAT_MODEL,
+            "contents": contents,
+            "config": make_generate_config(
+                schema=schema,
+                tools=tools,
+                tool_config=tool_config_auto() if tools else None,
+            ),
+        }
+        # balde global (RPM/TPM) + janela AIMD: sem vaga a chamada espera na fila ate o prazo
+        self.tokens = rate_limit.estimate_request_tokens(contents)
+
+    def trace(self, stream: bool = False) -> llm_metrics.CallTrace:
+        return llm_metrics.CallTrace(
+            self.call_site, CHAT_MODEL, stream=stream, session_id=self.session_id, prompt_tokens=self.tokens,
+        )
+
+    def cache_key(self, cache: bool) -> str | None:
+        if not (cache and llm_cache.LLM_CACHE_ENABLED):
+            return None
+        return llm_cache.cache_key(CHAT_MODEL, self.request["contents"], self.schema, self.tools)
+
+    def lookup(self, key: str | None, refresh: bool):
+        # sync: o caminho async chama via sync_to_async
+        if key is None:
+            return None
+        if refresh:
+            llm_cache.note_bypass()
+            return None
+        cached = llm_cache.lookup(key)
+        if cached is not None:
+            llm_metrics.note_cache_hit(self.call_site, CHAT_MODEL)
+        return cached
+
+    def store(self, key: str | None, resp):
+        if key:
+            llm_cache.store(key, resp, self.schema)
+
+
 def generate(
     contents,
     schema: Optional[dict] = None,
     tools: Optional[list[types.Tool]] = None,
     stream: bool = False,
     session_id: str = None,
+    cache: bool = False,
+    refresh: bool = False,
+    call_site: str = "other",
 ):
     """
     Geração unificada com/sem streaming.
     - Para streaming, use generate_content_stream(...) e itere .text dos chunks.
+    - cache=True (so sem stream): reaproveita a resposta de um pedido identico
+      (modelo, contents, schema, tools); refresh=True ignora o que esta gravado
+      e regrava com a resposta nova.
+    - call_site: quem montou o prompt (llm_metrics.CALL_SITES), rotulo da telemetria.
     """
-    if session_id:
-        print(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "event": "generate_call",
-            "model": CHAT_MODEL,
-            "contents_count": len(contents),
-            "stream": stream,
-            "has_tools": tools is not None,
-            "has_schema": schema is not None
-        }))
-    cfg = make_generate_config(
-        schema=schema,
-        tools=tools,
-        tool_config=tool_config_auto() if tools else None,
-    )
+    call = _Call(contents, schema, tools, session_id, call_site)
     if stream:
-        return client.models.generate_content_stream(
-            model=CHAT_MODEL,
-            contents=contents,
-            config=cfg,
-        )
-    resp = client.models.generate_content(
-        model=CHAT_MODEL,
-        contents=contents,
-        config=cfg,
-    )
-    if session_id:
-        text = getattr(resp, "text", "") or ""
-        print(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "event": "generate_response",
-            "text_length": len(text),
-            "has_candidates": bool(getattr(resp, "candidates", None))
-        }))
+        trace = call.trace(stream=True)
+        return _traced_stream(trace, rate_limit.guard_stream("generate", call.tokens, trace.attempt(
+            lambda: get_client().models.generate_content_stream(**call.request)
+        )))
+    key = call.cache_key(cache)
+    cached = call.lookup(key, refresh)
+    if cached is not None:
+        return cached
+    # latencia medida com a espera por vaga no rate limit: e o que o chamador sente
+    trace = call.trace()
+    try:
+        resp = rate_limit.guard("generate", call.tokens, trace.attempt(
+            lambda: get_client().models.generate_content(**call.request)
+        ), call_site=call.call_site)
+    except Exception as exc:
+        trace.finish(exc)
+        raise
+    trace.usage(resp)
+    trace.finish()
+    call.store(key, resp)
     return resp
 
 
+def _traced_stream(trace: llm_metrics.CallTrace, chunks: Iterable) -> Iterable:
+    # grava a chamada quando o stream acaba (ou e abandonado pelo consumidor)
+    error = None
+    try:
+        for chunk in chunks:
+            trace.chunk(chunk)
+            yield chunk
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        trace.finish(error)
+
+
+async def _atraced_stream(trace: llm_metrics.CallTrace, chunks: AsyncIterator) -> AsyncIterator:
+    error = None
+    try:
+        async for chunk in chunks:
+            trace.chunk(chunk)
+            yield chunk
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        trace.finish(error)
+
+
 def stream_text(
     contents,
     schema: Optional[dict] = None,
     tools: Optional[list[types.Tool]] = None,
+    call_site: str = "other",
 ) -> Iterable[str]:
     """
     Helper para SSE: devolve somente texto dos chunks de stream.
     """
-    for chunk in generate(contents, schema=schema, tools=tools, stream=True):
+    for chunk in generate(contents, schema=schema, tools=tools, stream=True, call_site=call_site):
         if getattr(chunk, "text", None):
             yield chunk.text
+
+
+async def agenerate(
+    contents,
+    schema: Optional[dict] = None,
+    tools: Optional[list[types.Tool]] = None,
+    session_id: str = None,
+    cache: bool = False,
+    refresh: bool = False,
+    call_site: str = "other",
+):
+    """
+    Versao async de generate (sem stream) sobre client.aio: a corrotina espera a
+    resposta sem prender uma thread, com o mesmo cache e o mesmo rate limit.
+    """
+    call = _Call(contents, schema, tools, session_id, call_site)
+    key = call.cache_key(cache)
+    cached = await sync_to_async(call.lookup, thread_sensitive=False)(key, refresh)
+    if cached is not None:
+        return cached
+    trace = call.trace()
+    try:
+        resp = await rate_limit.aguard("generate", call.tokens, trace.attempt(
+            lambda: get_async_client().models.generate_content(**call.request)
+        ), call_site=call.call_site)
+    except Exception as exc:
+        trace.finish(exc)
+        raise
+    trace.usage(resp)
+    trace.finish()
+    await sync_to_async(call.store, thread_sensitive=False)(key, resp)
+    return resp
+
+
+async def astream(
+    contents,
+    schema: Optional[dict] = None,
+    tools: Optional[list[types.Tool]] = None,
+    session_id: str = None,
+    call_site: str = "other",
+) -> AsyncIterator[types.GenerateContentResponse]:
+    """Chunks do generate_content_stream async, na ordem em que chegam."""
+    call = _Call(contents, schema, tools, session_id, call_site)
+    trace = call.trace(stream=True)
+    async for chunk in _atraced_stream(trace, rate_limit.aguard_stream("generate", call.tokens, trace.attempt(
+        lambda: get_async_client().models.generate_content_stream(**call.request)
+    ))):
+        yield chunk
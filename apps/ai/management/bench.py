@@ -0,0 +1,5 @@
+def percentile(samples: list[float], pct: float) -> float:
+    # sem interpolacao: devolve sempre uma das amostras medidas
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[idx]
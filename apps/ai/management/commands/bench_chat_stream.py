@@ -0,0 +1,39 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from apps.ai.management.bench import percentile
+from apps.ai.services.chat import chat_stream
+
+
+class Command(BaseCommand):
+    help = (
+        "Mede time-to-first-token e latencia total do chat_stream contra o modelo configurado "
+        "(GEMINI_CHAT_MODEL). Usa uma mensagem que nao dispara tool calls."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=10)
+        parser.add_argument("--message", default="Oi! Quais informacoes voce vai precisar de mim?")
+
+    def handle(self, *args, **opts):
+        ttft, total, tokens = [], [], []
+        for _ in range(opts["runs"]):
+            started = time.perf_counter()
+            first = None
+            count = 0
+            for packet in chat_stream(None, [{"role": "user", "content": opts["message"]}], str(uuid.uuid4())):
+                if packet["event"] == "token":
+                    count += 1
+                    if first is None:
+                        first = time.perf_counter()
+            end = time.perf_counter()
+            ttft.append(((first or end) - started) * 1000)
+            total.append((end - started) * 1000)
+            tokens.append(count)
+        self.stdout.write(
+            f"runs={opts['runs']} ttft p50={percentile(ttft, 50):8.1f}ms p95={percentile(ttft, 95):8.1f}ms "
+            f"total p50={percentile(total, 50):8.1f}ms p95={percentile(total, 95):8.1f}ms "
+            f"avg_token_events={sum(tokens) / len(tokens):.1f}"
+        )
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.ai.models import Chunk, Document
+from apps.ai.services.chunk_writer import write_chunks
+
+BENCH_SOURCE = "bench_chunk_writer"
+
+
+class Command(BaseCommand):
+    help = "Compara Chunk.objects.bulk_create com o COPY binario (write_chunks) em 1k/10k/100k chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[1_000, 10_000, 100_000])
+        parser.add_argument("--dim", type=int, default=1536)
+        parser.add_argument("--text-chars", type=int, default=1200)
+        parser.add_argument("--batch-size", type=int, default=200, help="batch_size do bulk_create")
+
+    def handle(self, *args, **opts):
+        rng = np.random.default_rng(7)
+        text = ("lorem ipsum dolor sit amet " * (opts["text_chars"] // 27 + 1))[: opts["text_chars"]]
+        doc = Document.objects.create(title="bench chunk writer", source=BENCH_SOURCE)
+        try:
+            for size in opts["sizes"]:
+                vecs = rng.standard_normal((size, opts["dim"]), dtype=np.float32)
+                rows = [(i, text, vecs[i]) for i in range(size)]
+                as_lists = [(i, t, v.tolist()) for i, t, v in rows]
+
+                elapsed_bulk = self._time(
+                    doc,
+                    lambda: Chunk.objects.bulk_create(
+                        [Chunk(document=doc, order=o, text=t, embedding=v) for o, t, v in as_lists],
+                        batch_size=opts["batch_size"],
+                    ),
+                )
+                elapsed_copy = self._time(doc, lambda: write_chunks(doc.id, rows))
+                self.stdout.write(
+                    f"size={size:>7} bulk_create={elapsed_bulk:7.2f}s ({size / elapsed_bulk:9.0f} rows/s) "
+                    f"copy_binary={elapsed_copy:7.2f}s ({size / elapsed_copy:9.0f} rows/s) "
+                    f"speedup={elapsed_bulk / elapsed_copy:5.1f}x"
+                )
+        finally:
+            Document.objects.filter(source=BENCH_SOURCE).delete()
+
+    def _time(self, doc, fn) -> float:
+        started = time.perf_counter()
+        with transaction.atomic():
+            fn()
+        elapsed = time.perf_counter() - started
+        Chunk.objects.filter(document=doc).delete()
+        return elapsed
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.ai.services.chunking import estimate_tokens, iter_chunks
+
+SAMPLE = (
+    "Segundo o art. 5º da Constituição Federal, todos são iguais perante a lei. "
+    "O Prof. Silva resolveu a questão 12 (p. 34) usando a Lei de Ohm: V = R * I!\n"
+    "Revisão ENEM - Biologia\n"
+    "A fotossíntese ocorre nos cloroplastos; a respiração celular, nas mitocôndrias. "
+    "Quais são os reagentes? Água, gás carbônico e luz.\n\n"
+)
+MINIFIED = "var a=1;" * 400 + "\n"
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark do chunker (services/chunking.py): MB/s, chunks e tokens medios por chunk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mb", type=float, default=20.0, help="Tamanho do texto sintetico em MB")
+        parser.add_argument("--block-chars", type=int, default=256 * 1024)
+        parser.add_argument("--max-tokens", type=int, default=None)
+        parser.add_argument("--overlap-tokens", type=int, default=None)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **opts):
+        unit = SAMPLE * 20 + MINIFIED
+        text = unit * max(1, int(opts["mb"] * 1024 * 1024 / len(unit.encode("utf-8"))))
+        size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+        step = opts["block_chars"]
+
+        best = None
+        for _ in range(opts["repeat"]):
+            blocks = (text[i:i + step] for i in range(0, len(text), step))
+            started = time.perf_counter()
+            count = tokens = 0
+            for chunk in iter_chunks(blocks, opts["max_tokens"], opts["overlap_tokens"]):
+                count += 1
+                tokens += estimate_tokens(chunk)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        self.stdout.write(
+            f"input={size_mb:.1f}MB best={best:.2f}s throughput={size_mb / best:.1f}MB/s "
+            f"chunks={count} avg_tokens/chunk={tokens / max(count, 1):.0f}"
+        )
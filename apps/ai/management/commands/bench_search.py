@@ -0,0 +1,90 @@
+import random
+import time
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from apps.ai.management.bench import percentile
+from apps.ai.models import Document
+from apps.ai.services.chunk_writer import write_chunks
+from apps.ai.services.search import vector_search
+
+User = get_user_model()
+
+BENCH_SOURCE = "bench_search"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara p50/p95 da busca vetorial sem filtro vs. com escopo de dono/documentos "
+        "em tamanhos crescentes da tabela de chunks (dados sinteticos)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000, 1_000_000])
+        parser.add_argument("--tenants", type=int, default=50)
+        parser.add_argument("--docs-per-tenant", type=int, default=4)
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument("-k", type=int, default=5)
+        parser.add_argument("--dim", type=int, default=1536)
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--keep", action="store_true", help="Nao remove os dados sinteticos ao final")
+
+    def handle(self, *args, **opts):
+        rng = np.random.default_rng(42)
+        dim = opts["dim"]
+        tenants = [
+            User.objects.get_or_create(username=f"bench-tenant-{i}", defaults={"email": f"bench{i}@example.com"})[0]
+            for i in range(opts["tenants"])
+        ]
+        docs = []
+        for user in tenants:
+            for j in range(opts["docs_per_tenant"]):
+                docs.append(Document.objects.create(title=f"bench {user.username} #{j}", owner=user, source=BENCH_SOURCE))
+
+        seeded = 0
+        try:
+            for size in sorted(opts["sizes"]):
+                seeded = self._seed(rng, docs, seeded, size, dim, opts["batch_size"])
+                self._measure(rng, size, tenants, docs, dim, opts["queries"], opts["k"])
+        finally:
+            if not opts["keep"]:
+                Document.objects.filter(source=BENCH_SOURCE).delete()
+                User.objects.filter(username__startswith="bench-tenant-").delete()
+
+    def _seed(self, rng, docs, current: int, target: int, dim: int, batch_size: int) -> int:
+        started = time.monotonic()
+        while current < target:
+            n = min(batch_size, target - current)
+            vecs = rng.standard_normal((n, dim), dtype=np.float32)
+            vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+            # um COPY por documento, intercalando os chunks entre os tenants
+            for d, doc in enumerate(docs):
+                write_chunks(doc.id, (
+                    (current + i, f"chunk {current + i}", vecs[i])
+                    for i in range(d, n, len(docs))
+                ))
+            current += n
+        self.stdout.write(f"[seed] {target} chunks ({time.monotonic() - started:.1f}s)")
+        return current
+
+    def _measure(self, rng, size, tenants, docs, dim, queries, k):
+        scenarios = {
+            "unfiltered": lambda q: vector_search(q, k),
+            "owner": lambda q: vector_search(q, k, owner=random.choice(tenants)),
+            "document": lambda q: vector_search(q, k, document_ids=[random.choice(docs).id]),
+        }
+        for name, run in scenarios.items():
+            latencies, returned = [], []
+            for _ in range(queries):
+                q = rng.standard_normal(dim, dtype=np.float32)
+                q /= np.linalg.norm(q)
+                started = time.perf_counter()
+                rows = run(q.tolist())
+                latencies.append((time.perf_counter() - started) * 1000)
+                returned.append(len(rows))
+            self.stdout.write(
+                f"size={size:>9} {name:<10} p50={percentile(latencies, 50):8.2f}ms "
+                f"p95={percentile(latencies, 95):8.2f}ms avg_rows={sum(returned) / len(returned):.2f}/{k}"
+            )
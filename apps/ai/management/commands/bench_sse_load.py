@@ -0,0 +1,83 @@
+import os
+import asyncio
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from apps.ai.management.bench import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "Abre N conexoes SSE simultaneas (jobs/stream por padrao) contra um servidor rodando e mede "
+        "p50/p95 de um endpoint comum enquanto elas ficam abertas. Compare WSGI (setup.wsgi) e ASGI (setup.asgi)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--base-url", default="http://localhost:8000")
+        parser.add_argument("--token", default=os.getenv("BENCH_TOKEN"), help="JWT de acesso (ou BENCH_TOKEN)")
+        parser.add_argument("--streams", nargs="+", type=int, default=[0, 10, 100, 1000])
+        parser.add_argument("--stream-path", default="/api/ai/jobs/stream/")
+        parser.add_argument("--probe-path", default="/api/ai/jobs/")
+        parser.add_argument("--probes", type=int, default=50)
+        parser.add_argument("--timeout", type=float, default=30.0, help="Timeout (s) de cada requisicao de sonda")
+
+    def handle(self, *args, **opts):
+        asyncio.run(self._run(opts))
+
+    async def _run(self, opts):
+        headers = {"Authorization": f"Bearer {opts['token']}"} if opts["token"] else {}
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=opts["base_url"], headers=headers, limits=limits,
+                                     timeout=httpx.Timeout(opts["timeout"], read=None)) as http:
+            for n in opts["streams"]:
+                await self._measure(http, n, opts)
+
+    async def _hold(self, http, path: str, opened: asyncio.Event, counter: list[int]):
+        try:
+            async with http.stream("GET", path) as resp:
+                if resp.status_code == 200:
+                    counter[0] += 1
+                else:
+                    counter[1] += 1
+                opened.set()
+                async for _ in resp.aiter_raw():
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            counter[1] += 1
+            opened.set()
+
+    async def _measure(self, http, n: int, opts):
+        counter = [0, 0]  # abertas, falhas
+        gates = [asyncio.Event() for _ in range(n)]
+        holders = [asyncio.create_task(self._hold(http, opts["stream_path"], g, counter)) for g in gates]
+        started = time.perf_counter()
+        try:
+            # com WSGI sync as conexoes alem do numero de workers nem chegam a abrir
+            await asyncio.wait_for(asyncio.gather(*(g.wait() for g in gates)), timeout=opts["timeout"])
+        except asyncio.TimeoutError:
+            pass
+        open_s = time.perf_counter() - started
+
+        latencies, errors = [], 0
+        for _ in range(opts["probes"]):
+            t0 = time.perf_counter()
+            try:
+                resp = await http.get(opts["probe_path"])
+                if resp.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        for task in holders:
+            task.cancel()
+        await asyncio.gather(*holders, return_exceptions=True)
+        self.stdout.write(
+            f"streams={n:>5} open={counter[0]:>5} failed={counter[1]:>4} open_time={open_s:6.2f}s "
+            f"probe p50={percentile(latencies, 50):8.2f}ms p95={percentile(latencies, 95):8.2f}ms "
+            f"errors={errors}/{opts['probes']}"
+        )
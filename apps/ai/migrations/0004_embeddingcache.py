@@ -0,0 +1,31 @@
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai", "0003_document_status_fields"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingCache",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("model", models.CharField(max_length=100)),
+                ("dimensions", models.IntegerField()),
+                ("text_hash", models.CharField(max_length=64)),
+                ("embedding", pgvector.django.vector.VectorField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("model", "dimensions", "text_hash"),
+                        name="embedding_cache_model_dim_hash_uniq",
+                    )
+                ],
+            },
+        ),
+    ]
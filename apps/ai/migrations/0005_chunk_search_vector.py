@@ -0,0 +1,26 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai", "0004_embeddingcache"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chunk",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE ai_chunk SET search_vector = to_tsvector('portuguese', text) WHERE search_vector IS NULL;",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name="chunk",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="chunk_search_vector_gin"),
+        ),
+    ]
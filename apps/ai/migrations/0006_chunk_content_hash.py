@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai", "0005_chunk_search_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chunk",
+            name="content_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE ai_chunk SET content_hash = encode(sha256(convert_to(text, 'UTF8')), 'hex') WHERE content_hash = '';",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai", "0006_chunk_content_hash"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="document",
+            name="job_id",
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="chunks_total",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="chunks_done",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="ingest_checkpoint",
+            field=models.IntegerField(default=0),
+        ),
+    ]
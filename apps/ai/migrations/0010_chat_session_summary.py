@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0009_chat_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='summary_upto',
+            field=models.IntegerField(default=0),
+        ),
+    ]
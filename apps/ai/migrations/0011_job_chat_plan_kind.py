@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0010_chat_session_summary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('study_plan', 'Study plan'), ('study_day', 'Study day'), ('section_tasks', 'Section tasks'), ('ingest', 'Ingest'), ('chat_plan', 'Chat plan')], max_length=30),
+        ),
+    ]
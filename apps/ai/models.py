@@ -1,6 +1,8 @@
 import uuid
 from django.db import models
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from pgvector.django import VectorField, HnswIndex
 
 class Document(models.Model):
@@ -17,7 +19,12 @@ class Document(models.Model):
         default="succeeded",
     )
     last_error = models.TextField(blank=True, default="")
-    job_id = models.CharField(max_length=100, null=True, blank=True)
+    job_id = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    # progresso/checkpoint da ingestao: chunks_total e conhecido apos a extracao;
+    # ingest_checkpoint = chunks (por order) ja gravados com vetor no caminho serial
+    chunks_total = models.IntegerField(null=True, blank=True)
+    chunks_done = models.IntegerField(default=0)
+    ingest_checkpoint = models.IntegerField(default=0)
     def __str__(self):
         return f"{self.title} ({self.id})"
 
@@ -27,6 +34,8 @@ class Chunk(models.Model):
     order = models.IntegerField(default=0)
     text = models.TextField()
     embedding = VectorField(dimensions=1536, null=True)  # 1536 p/ gemini-embedding-001
+    search_vector = SearchVectorField(null=True)  # to_tsvector('portuguese', text), preenchido na ingestao
+    content_hash = models.CharField(max_length=64, blank=True, default="")  # sha256(text), usado na re-ingestao
 
     class Meta:
         indexes = [
@@ -35,5 +44,123 @@ class Chunk(models.Model):
                 fields=["embedding"],
                 m=16, ef_construction=200,
                 opclasses=["vector_cosine_ops"]
-            )
+            ),
+            GinIndex(name="chunk_search_vector_gin", fields=["search_vector"]),
         ]
+
+
+class EmbeddingCache(models.Model):
+    """
+    Cache persistente de embeddings, enderecado pelo conteudo:
+    (modelo, dimensionalidade, sha256 do texto) -> vetor.
+    """
+    id = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=100)
+    dimensions = models.IntegerField()
+    text_hash = models.CharField(max_length=64)
+    embedding = VectorField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["model", "dimensions", "text_hash"],
+                name="embedding_cache_model_dim_hash_uniq",
+            )
+        ]
+
+
+class Job(models.Model):
+    """
+    Registro duravel de um trabalho assincrono (Celery). O id e o task_id da
+    task principal; as tasks atualizam status/progresso/tempos aqui e os
+    endpoints de status leem so esta tabela.
+    """
+    KIND_CHOICES = [
+        ("study_plan", "Study plan"),
+        ("study_day", "Study day"),
+        ("section_tasks", "Section tasks"),
+        ("ingest", "Ingest"),
+        ("chat_plan", "Chat plan"),
+    ]
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="ai_jobs", on_delete=models.CASCADE)
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    plan = models.ForeignKey(
+        "accounts.StudyPlan", related_name="jobs", on_delete=models.SET_NULL, null=True, blank=True
+    )
+    day = models.ForeignKey(
+        "accounts.StudyDay", related_name="jobs", on_delete=models.SET_NULL, null=True, blank=True
+    )
+    document = models.ForeignKey(
+        Document, related_name="jobs", on_delete=models.SET_NULL, null=True, blank=True
+    )
+    progress = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "-created_at"], name="job_owner_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"Job({self.kind}, {self.status}, {self.id})"
+
+
+class ChatSession(models.Model):
+    """
+    Conversa do chat guardada no servidor: o cliente manda so a mensagem nova
+    e o session_id; o historico e remontado a partir dos turnos gravados.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="ai_chat_sessions", on_delete=models.CASCADE)
+    turn_count = models.IntegerField(default=0)
+    # resumo cumulativo dos turnos [0, summary_upto); o prompt leva o resumo + os turnos seguintes
+    summary = models.TextField(blank=True, default="")
+    summary_upto = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "-updated_at"], name="chat_owner_updated_idx"),
+        ]
+
+    def __str__(self):
+        return f"ChatSession({self.owner_id}, {self.turn_count} turnos)"
+
+
+class ChatTurn(models.Model):
+    ROLE_CHOICES = [
+        ("user", "User"),
+        ("assistant", "Assistant"),
+    ]
+
+    session = models.ForeignKey(ChatSession, related_name="turns", on_delete=models.CASCADE)
+    index = models.IntegerField()
+    role = models.CharField(max_length=20, choices=ROLE_CHOICES)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["index"]
+        constraints = [
+            models.UniqueConstraint(fields=["session", "index"], name="chat_turn_session_index_uniq"),
+        ]
+
+    def __str__(self):
+        return f"ChatTurn({self.session_id}#{self.index}, {self.role})"
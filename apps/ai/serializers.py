@@ -1,8 +1,10 @@
 from drf_spectacular.utils import extend_schema_field
+from django.utils import timezone
 from rest_framework import serializers
 
 from apps.accounts.models import StudyPlan, StudyTask, StudyDay
-from apps.ai.models import Document
+from apps.ai.models import Document, Job
+from apps.ai.services.extraction import MIME_BINARY, sniff_mime
 
 
 class DocumentIngestSerializer(serializers.Serializer):
@@ -14,11 +16,20 @@ class DocumentIngestSerializer(serializers.Serializer):
 class DocumentIngestResponseSerializer(serializers.Serializer):
     document_id = serializers.UUIDField()
     chunks = serializers.IntegerField()
+    # preenchidos quando `id` aponta para um documento existente (re-ingestao)
+    reused = serializers.IntegerField(required=False)
+    added = serializers.IntegerField(required=False)
+    removed = serializers.IntegerField(required=False)
 
 
 class SearchResultSerializer(serializers.Serializer):
+    chunk_id = serializers.IntegerField()
+    doc_id = serializers.UUIDField()
+    ord = serializers.IntegerField()
     text = serializers.CharField()
-    score = serializers.FloatField()
+    distance = serializers.FloatField(required=False, allow_null=True)
+    rank = serializers.FloatField(required=False)
+    score = serializers.FloatField(required=False)
 
 
 class ChatMessageSerializer(serializers.Serializer):
@@ -27,21 +38,41 @@ class ChatMessageSerializer(serializers.Serializer):
 
 
 class ChatRequestSerializer(serializers.Serializer):
-    messages = ChatMessageSerializer(many=True)
+    # sessao no servidor: so a mensagem nova (+ session_id a partir do 2o turno)
+    message = serializers.CharField(required=False)
+    session_id = serializers.UUIDField(required=False)
+    # legado: historico completo reenviado a cada turno, sem sessao
+    messages = ChatMessageSerializer(many=True, required=False)
     stream = serializers.BooleanField(required=False, default=False)
 
+    def validate(self, attrs):
+        if not attrs.get("message") and not attrs.get("messages"):
+            raise serializers.ValidationError("Envie message (com session_id opcional) ou messages.")
+        if attrs.get("session_id") and not attrs.get("message"):
+            raise serializers.ValidationError({"message": "Obrigatorio quando session_id e enviado."})
+        return attrs
+
 
 class ChatResponseSerializer(serializers.Serializer):
     reply = serializers.CharField()
+    session_id = serializers.UUIDField(required=False)
 
 
 class GeneratePlanRequestSerializer(serializers.Serializer):
     title = serializers.CharField(required=False, allow_blank=True)
     goal_override = serializers.CharField(required=False, allow_blank=True)
+    force_regenerate = serializers.BooleanField(
+        required=False, default=False,
+        help_text="Ignora o cache de respostas da IA e gera de novo mesmo com as mesmas entradas.",
+    )
 
 
 class GenerateTasksRequestSerializer(serializers.Serializer):
     section_id = serializers.CharField()
+    force_regenerate = serializers.BooleanField(
+        required=False, default=False,
+        help_text="Ignora o cache de respostas da IA e gera de novo mesmo com as mesmas entradas.",
+    )
 
 
 class TaskProgressRequestSerializer(serializers.Serializer):
@@ -56,17 +87,33 @@ class TaskProgressRequestSerializer(serializers.Serializer):
 
 class GenerateDayRequestSerializer(serializers.Serializer):
     reset_existing = serializers.BooleanField(required=False, default=True)
+    force_regenerate = serializers.BooleanField(
+        required=False, default=False,
+        help_text="Ignora o cache de respostas da IA e gera de novo mesmo com as mesmas entradas.",
+    )
 
 
 class PlanMaterialUploadSerializer(serializers.Serializer):
     title = serializers.CharField(required=False, allow_blank=True)
     file = serializers.FileField()
+    document_id = serializers.UUIDField(
+        required=False,
+        help_text="Documento existente a atualizar (re-ingestao incremental: so chunks novos sao embedados).",
+    )
+
+    def validate_file(self, value):
+        # rejeita binarios (imagem, audio, zip...) ja no upload; PDF escaneado sem
+        # texto so e detectado na extracao, antes de qualquer embedding
+        if sniff_mime(value) == MIME_BINARY:
+            raise serializers.ValidationError("Formato nao suportado; envie PDF, DOCX ou texto.")
+        return value
 
 
 class PlanMaterialUploadResponseSerializer(serializers.Serializer):
     document_id = serializers.UUIDField()
     chunks = serializers.IntegerField()
     file_id = serializers.UUIDField()
+    mode = serializers.ChoiceField(choices=["ingest", "reingest"])
 
 
 class LessonContentSerializer(serializers.Serializer):
@@ -435,7 +482,32 @@ class StudyDayResultSerializer(serializers.Serializer):
 
 
 class JobStatusSerializer(serializers.Serializer):
-    job_id = serializers.CharField()
+    job_id = serializers.UUIDField(source="id")
+    kind = serializers.CharField()
     status = serializers.CharField()
-    result = serializers.DictField(required=False, allow_null=True)
-    error = serializers.CharField(required=False, allow_blank=True)
+    plan_id = serializers.UUIDField(allow_null=True)
+    day_id = serializers.UUIDField(allow_null=True)
+    document_id = serializers.UUIDField(allow_null=True)
+    result = serializers.DictField(allow_null=True)
+    error = serializers.CharField(allow_blank=True)
+    progress = serializers.SerializerMethodField()
+    attempts = serializers.IntegerField()
+    created_at = serializers.DateTimeField()
+    started_at = serializers.DateTimeField(allow_null=True)
+    finished_at = serializers.DateTimeField(allow_null=True)
+    duration_ms = serializers.SerializerMethodField()
+
+    @extend_schema_field(serializers.DictField())
+    def get_progress(self, obj: Job):
+        progress = dict(obj.progress or {})
+        # ingestao: o progresso por chunk fica no Document (atualizado pelas subtarefas)
+        if obj.kind == "ingest" and obj.document is not None:
+            progress.update(chunks_done=obj.document.chunks_done, chunks_total=obj.document.chunks_total)
+        return progress
+
+    @extend_schema_field(serializers.IntegerField(allow_null=True))
+    def get_duration_ms(self, obj: Job):
+        if not obj.started_at:
+            return None
+        end = obj.finished_at or timezone.now()
+        return int((end - obj.started_at).total_seconds() * 1000)
@@ -1,12 +1,15 @@
-from typing import Any, Generator
+from typing import Any, AsyncIterator, Generator
 import json
 import logging
 import time
-import os
 from datetime import datetime
+from asgiref.sync import sync_to_async
 from google.genai import types
-from apps.ai.client import generate, make_tools
-from apps.ai.tools.commit_user_context import function_declarations, handle_tool_call
+from apps.ai.client import astream, generate, make_tools
+from apps.ai.models import Job
+from apps.ai.services.jobs import create_job, enqueue
+from apps.ai.services.tool_engine import ToolLoopBudget, run_tool_calls
+from apps.ai.tools.commit_user_context import TOOL_RESOURCES, function_declarations
 
 SYSTEM = (
   "Você é um assistente de onboarding (AI Wizard) em pt-BR para Teacher Plus. "
@@ -40,24 +43,25 @@ SYSTEM = (
 )
 
 
-STREAM_CHUNK_CHARS = int(os.getenv("AI_STREAM_CHUNK", "10"))
-STREAM_DELAY_MS    = int(os.getenv("AI_STREAM_DELAY_MS", "22"))
+# o prompt de sistema e imutavel: um unico Content compartilhado por todas as conversas
+SYSTEM_CONTENT = types.Content(role="user", parts=[types.Part(text=SYSTEM)])
+ROLE_MAP = {"user": "user", "assistant": "model", "system": "user"}
+PLAN_PROMPT = "Com base no contexto do usuário recém-persistido, gere um plano de estudos inicial personalizado."
+# emitido quando o modelo nao devolve texto: nao e uma resposta do assistente para o historico
+FALLBACK_REPLY = "Desculpe, não consegui gerar a mensagem."
 
 
-def _chunk_text(s: str, n: int = STREAM_CHUNK_CHARS):
-    for i in range(0, len(s), n):
-        yield s[i:i+n]
+def make_turn(role: str, text: str) -> types.Content:
+    return types.Content(role=ROLE_MAP.get(role, "user"), parts=[types.Part(text=text)])
 
 
 def _make_history(messages: list[dict]) -> list[types.Content]:
     """
     messages: [{"role":"user"|"assistant"|"system","content":"..."}]
     """
-    hist: list[types.Content] = [types.Content(role="user", parts=[types.Part(text=SYSTEM)])]
-    role_map = {"user": "user", "assistant": "model", "system": "user"}
+    hist: list[types.Content] = [SYSTEM_CONTENT]
     for m in messages:
-        role = role_map.get(m.get("role","user"), "user")
-        hist.append(types.Content(role=role, parts=[types.Part(text=m.get("content",""))]))
+        hist.append(make_turn(m.get("role", "user"), m.get("content", "")))
     return hist
 
 
@@ -100,7 +104,28 @@ def _response_to_content(resp, session_id: str | None = None) -> types.Content:
     return types.Content(role="model", parts=parts)
 
 
-def chat_once(user, messages: list[dict], session_id: str = None) -> str:
+def enqueue_chat_plan(user, study_context_id: str, history: list[types.Content] | None = None) -> Job:
+    """
+    Job (fila ai_generation) pos-commit do contexto: gera o outline do plano e,
+    com `history`, o plano inicial em texto, transmitido pelos eventos do job.
+    """
+    from apps.ai.tasks import generate_chat_plan_task  # tasks importa este modulo
+
+    job = create_job(user, "chat_plan")
+    # SYSTEM_CONTENT e fixo: vai so o resto do historico na mensagem da task
+    contents = [c.model_dump(mode="json", exclude_none=True) for c in history[1:]] if history else None
+    enqueue(generate_chat_plan_task, job, args=[str(job.id), study_context_id, contents], queue="ai_generation")
+    return job
+
+
+def stream_plan(contents: list[dict], session_id: str | None = None) -> Generator[str, None, None]:
+    """Texto do plano inicial, pedaco a pedaco, a partir do historico serializado por enqueue_chat_plan."""
+    hist = [SYSTEM_CONTENT] + [types.Content.model_validate(c) for c in contents]
+    hist.append(types.Content(role="user", parts=[types.Part(text=PLAN_PROMPT)]))
+    yield from _stream_round(hist, None, session_id, call_site="chat_plan")
+
+
+def chat_once(user, messages: list[dict], session_id: str = None, history: list[types.Content] | None = None) -> str:
     if session_id:
         logging.info(json.dumps({
             "timestamp": datetime.now().isoformat(),
@@ -109,7 +134,7 @@ def chat_once(user, messages: list[dict], session_id: str = None) -> str:
             "messages": messages
         }))
     tools = make_tools(function_declarations())
-    hist = _make_history(messages)
+    hist = list(history) if history is not None else _make_history(messages)
     if session_id:
         print(json.dumps({
             "timestamp": datetime.now().isoformat(),
@@ -124,7 +149,7 @@ def chat_once(user, messages: list[dict], session_id: str = None) -> str:
             ]
         }))
     # 1ª rodada: modelo pode propor chamadas de função
-    resp = generate(contents=hist, tools=tools, stream=False, session_id=session_id)
+    resp = generate(contents=hist, tools=tools, stream=False, session_id=session_id, call_site="chat")
 
     calls = _extract_function_calls(resp)
     if session_id:
@@ -136,27 +161,32 @@ def chat_once(user, messages: list[dict], session_id: str = None) -> str:
             "text": text,
             "has_candidates": bool(getattr(resp, "candidates", None))
         }))
-    while calls:
+    study_context_id: str | None = None
+    budget = ToolLoopBudget()
+    while calls and not budget.expired():
+        budget.rounds += 1
         if session_id:
             logging.info(json.dumps({
                 "timestamp": datetime.now().isoformat(),
                 "session_id": session_id,
                 "event": "function_calls_detected",
+                "round": budget.rounds,
                 "calls": [{"name": c.name, "args": dict(c.args or {})} for c in calls]
             }))
-        # Executa cada call e envia function_response de volta
+        # Executa as calls da rodada (independentes em paralelo) e envia function_response de volta
         out_parts: list[types.Part] = []
-        for call in calls:
-            result = handle_tool_call(user, call.name, dict(call.args or {}))
+        for call, result, error, _ in run_tool_calls(user, calls, timeout=budget.remaining()):
+            if error is not None:
+                raise error
+            if TOOL_RESOURCES.get(call.name) == "study_context" and result.get("status") == "ok":
+                study_context_id = result.get("study_context_id") or study_context_id
             out_parts.append(types.Part.from_function_response(name=call.name, response=result))
 
-        # Pede continuação incluindo:
-        # - o conteúdo da chamada de função anterior (cand.content)
-        # - as respostas de função como um novo Content(role="user")
-        follow_up = []
+        # Pede continuação com o histórico + o conteúdo da chamada de função
+        # anterior (cand.content) + as respostas de função num Content(role="user")
         model_content = _response_to_content(resp, session_id)
         if getattr(model_content, "parts", None):
-            follow_up.append(model_content)
+            hist.append(model_content)
         elif session_id:
             print(json.dumps({
                 "timestamp": datetime.now().isoformat(),
@@ -164,211 +194,364 @@ def chat_once(user, messages: list[dict], session_id: str = None) -> str:
                 "event": "model_content_skipped",
                 "reason": "empty_parts_after_tool_call",
             }))
-        follow_up.append(types.Content(role="user", parts=out_parts))
+        hist.append(types.Content(role="user", parts=out_parts))
+        # ultima rodada permitida: sem tools, o modelo precisa responder em texto
+        final = budget.exhausted()
         if session_id:
             logging.info(json.dumps({
                 "timestamp": datetime.now().isoformat(),
                 "session_id": session_id,
                 "event": "follow_up_prompt",
-                "follow_up_summary": f"previous content + {len(out_parts)} function responses"
+                "follow_up_summary": f"history + previous content + {len(out_parts)} function responses",
+                "final_round": final,
             }))
-        resp = generate(contents=follow_up, tools=tools, stream=False, session_id=session_id)
-        calls = _extract_function_calls(resp)
+        resp = generate(contents=hist, tools=None if final else tools, stream=False, session_id=session_id, call_site="chat")
+        calls = [] if final else _extract_function_calls(resp)
 
+    if study_context_id:
+        # sem stream nao ha onde transmitir o plano: o job so monta o outline
+        enqueue_chat_plan(user, study_context_id)
     # resposta final em texto
     return getattr(resp, "text", "") or ""
 
 
 
-def chat_stream(user, messages: list[dict], session_id: str | None = None) -> Generator[dict[str, Any], None, None]:
+class _RoundParts:
     """
-    Stream chat flow as structured events for SSE consumers.
-    Each yielded item is a dict like {"event": <str>, "data": {..}}.
+    Acumula uma rodada em streaming: o texto vai para quem repassa os tokens e
+    as partes (texto + function_call, como vieram, com thought_signature) viram
+    o turno do modelo no historico da rodada seguinte do loop de tools.
+    """
+
+    def __init__(self):
+        self.parts: list[types.Part] = []
+        self.calls: list[types.FunctionCall] = []
+        self._text: list[str] = []
+
+    def _flush_text(self):
+        if self._text:
+            self.parts.append(types.Part(text="".join(self._text)))
+            self._text.clear()
+
+    def feed(self, chunk) -> list[str]:
+        pieces = []
+        candidates = getattr(chunk, "candidates", None) or []
+        content = getattr(candidates[0], "content", None) if candidates else None
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "function_call", None):
+                self._flush_text()
+                self.parts.append(part)
+                self.calls.append(part.function_call)
+            elif getattr(part, "text", None) and not getattr(part, "thought", False):
+                self._text.append(part.text)
+                pieces.append(part.text)
+        return pieces
+
+    def result(self) -> tuple[types.Content, list[types.FunctionCall]]:
+        self._flush_text()
+        return types.Content(role="model", parts=self.parts), self.calls
+
+
+def _stream_round(
+    contents, tools, session_id: str | None = None, call_site: str = "chat"
+) -> Generator[str, None, tuple[types.Content, list[types.FunctionCall]]]:
+    """
+    Uma rodada do modelo em streaming: repassa o texto de cada chunk assim que
+    chega e devolve (content, calls) para o historico.
+    """
+    round_parts = _RoundParts()
+    for chunk in generate(contents=contents, tools=tools, stream=True, session_id=session_id, call_site=call_site):
+        yield from round_parts.feed(chunk)
+    return round_parts.result()
+
+
+class _ChatTurn:
+    """
+    Um turno do chat em streaming, sem I/O: `steps()` devolve comandos e quem
+    dirige (chat_stream na thread, achat_stream no event loop) executa cada um
+    e manda o resultado de volta com send():
+
+    - ("event", packet): repassar ao cliente;
+    - ("model", contents, tools): rodar uma rodada em stream, chamando
+      `token()` a cada pedaco de texto; devolve (content, calls);
+    - ("tools", calls, timeout): run_tool_calls; devolve os resultados;
+    - ("plan", study_context_id, hist): enqueue_chat_plan; devolve o Job.
     """
-    if session_id:
-        logging.info(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "event": "chat_stream_start",
-            "messages": messages
-        }))
 
-    def _wrap(event_type: str, payload: dict[str, Any]) -> dict[str, Any]:
+    def __init__(self, messages: list[dict], session_id: str | None, history: list[types.Content] | None):
+        self.messages = messages
+        self.session_id = session_id
+        self.history = history
+        self.started = time.monotonic()
+        self.first_token_at: float | None = None
+        self.token_index = 0
+        self.committed = False
+        self.study_context_id: str | None = None
+
+    def _wrap(self, event_type: str, payload: dict[str, Any]) -> dict[str, Any]:
         data = payload.copy()
-        if session_id:
-            data.setdefault("session_id", session_id)
+        if self.session_id:
+            data.setdefault("session_id", self.session_id)
         return {"event": event_type, "data": data}
 
-    yield _wrap("meta", {"type": "session_started"})
+    def _timings(self) -> dict[str, Any]:
+        return {
+            "ttft_ms": round((self.first_token_at - self.started) * 1000) if self.first_token_at else None,
+            "total_ms": round((time.monotonic() - self.started) * 1000),
+        }
 
-    tools = make_tools(function_declarations())
-    hist = _make_history(messages)
-    if session_id:
-        logging.info(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "event": "stream_history_built",
-            "system_prompt": SYSTEM,
-            "history": [
-                {
-                    "role": c.role,
-                    "parts": [{"text": p.text} for p in c.parts if hasattr(p, 'text')]
-                } for c in hist
-            ]
-        }))
+    def token(self, piece: str, stage: str = "assistant_response") -> dict[str, Any]:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.token_index += 1
+        return self._wrap("token", {"index": self.token_index, "stage": stage, "text": piece})
 
-    resp = generate(contents=hist, tools=tools, stream=False, session_id=session_id)
-    calls = _extract_function_calls(resp)
-    committed = False
-    study_context_id: str | None = None
-    token_index = 0
+    def _finished(self, **extra) -> dict[str, Any]:
+        timings = self._timings()
+        if self.session_id:
+            print(json.dumps({
+                "timestamp": datetime.now().isoformat(),
+                "session_id": self.session_id,
+                "event": "chat_stream_latency",
+                "tokens": self.token_index,
+                **timings,
+            }))
+        return self._wrap("meta", {
+            "type": "session_finished",
+            "total_tokens": self.token_index,
+            "committed": self.committed,
+            "study_context_id": self.study_context_id,
+            "user_context_id": self.study_context_id,
+            **timings,
+            **extra,
+        })
 
-    while calls:
-        out_parts: list[types.Part] = []
-        for call in calls:
-            yield _wrap("heartbeat", {"stage": "tool_call", "tool": call.name})
-            try:
-                result = handle_tool_call(user, call.name, dict(call.args or {}))
-            except Exception as exc:
+    def steps(self):
+        session_id = self.session_id
+        if session_id:
+            logging.info(json.dumps({
+                "timestamp": datetime.now().isoformat(),
+                "session_id": session_id,
+                "event": "chat_stream_start",
+                "messages": self.messages
+            }))
+        yield "event", self._wrap("meta", {"type": "session_started"})
+
+        tools = make_tools(function_declarations())
+        hist = list(self.history) if self.history is not None else _make_history(self.messages)
+        if session_id:
+            logging.info(json.dumps({
+                "timestamp": datetime.now().isoformat(),
+                "session_id": session_id,
+                "event": "stream_history_built",
+                "system_prompt": SYSTEM,
+                "history": [
+                    {
+                        "role": c.role,
+                        "parts": [{"text": p.text} for p in c.parts if hasattr(p, 'text')]
+                    } for c in hist
+                ]
+            }))
+
+        model_content, calls = yield "model", hist, tools
+
+        budget = ToolLoopBudget()
+        while calls:
+            if budget.expired():
                 error_payload = {
-                    "stage": "tool_call",
-                    "tool": call.name,
-                    "message": str(exc),
+                    "stage": "tool_loop",
+                    "message": "tempo limite do loop de tools excedido",
+                    "rounds": budget.rounds,
                 }
-                yield _wrap("error", error_payload)
-                yield _wrap("meta", {
-                    "type": "session_finished",
-                    "total_tokens": token_index,
-                    "committed": committed,
-                    "study_context_id": study_context_id,
-                    "user_context_id": study_context_id,
-                    "error": error_payload,
-                })
+                yield "event", self._wrap("error", error_payload)
+                yield "event", self._finished(error=error_payload)
                 return
-
-            if session_id:
-                print(json.dumps({
-                    "timestamp": datetime.now().isoformat(),
-                    "session_id": session_id,
-                    "event": "tool_call_result",
-                    "tool": call.name,
-                    "result_keys": sorted(result.keys()),
-                    "status": result.get("status"),
-                }))
-            if call.name == "commit_user_context":
-                if result.get("status") == "ok":
-                    committed = True
-                    study_context_id = result.get("study_context_id") or result.get("user_context_id")
-                    yield _wrap("meta", {
-                        "type": "context_committed",
-                        "study_context_id": study_context_id,
-                        "user_context_id": study_context_id,
-                    })
-                else:
+            budget.rounds += 1
+            round_calls = len(calls)
+            for call in calls:
+                yield "event", self._wrap("heartbeat", {"stage": "tool_call", "tool": call.name})
+            tools_started = time.monotonic()
+            results = yield "tools", calls, budget.remaining()
+            tools_ms = round((time.monotonic() - tools_started) * 1000)
+            out_parts: list[types.Part] = []
+            for call, result, error, call_ms in results:
+                if error is not None:
                     error_payload = {
                         "stage": "tool_call",
                         "tool": call.name,
-                        "message": "commit_user_context returned a non-ok status",
-                        "payload": result,
+                        "message": str(error),
                     }
-                    yield _wrap("error", error_payload)
-                    yield _wrap("meta", {
-                        "type": "session_finished",
-                        "total_tokens": token_index,
-                        "committed": committed,
-                        "study_context_id": study_context_id,
-                        "user_context_id": study_context_id,
-                        "error": error_payload,
-                    })
+                    yield "event", self._wrap("error", error_payload)
+                    yield "event", self._finished(error=error_payload)
                     return
 
-            out_parts.append(types.Part.from_function_response(name=call.name, response=result))
+                if session_id:
+                    print(json.dumps({
+                        "timestamp": datetime.now().isoformat(),
+                        "session_id": session_id,
+                        "event": "tool_call_result",
+                        "tool": call.name,
+                        "result_keys": sorted(result.keys()),
+                        "status": result.get("status"),
+                        "ms": call_ms,
+                    }))
+                if TOOL_RESOURCES.get(call.name) == "study_context":
+                    if result.get("status") == "ok":
+                        new_context_id = result.get("study_context_id") or result.get("user_context_id")
+                        if not self.committed or new_context_id != self.study_context_id:
+                            yield "event", self._wrap("meta", {
+                                "type": "context_committed",
+                                "study_context_id": new_context_id,
+                                "user_context_id": new_context_id,
+                            })
+                        self.committed = True
+                        self.study_context_id = new_context_id
+                    else:
+                        error_payload = {
+                            "stage": "tool_call",
+                            "tool": call.name,
+                            "message": "commit_user_context returned a non-ok status",
+                            "payload": result,
+                        }
+                        yield "event", self._wrap("error", error_payload)
+                        yield "event", self._finished(error=error_payload)
+                        return
 
-        model_content = _response_to_content(resp, session_id)
-        if getattr(model_content, "parts", None):
+                out_parts.append(types.Part.from_function_response(name=call.name, response=result))
+
+            if model_content.parts:
+                hist.append(model_content)
+            elif session_id:
+                print(json.dumps({
+                    "timestamp": datetime.now().isoformat(),
+                    "session_id": session_id,
+                    "event": "model_content_skipped",
+                    "reason": "empty_parts_after_tool_call",
+                }))
+            if out_parts:
+                hist.append(types.Content(role="user", parts=out_parts))
+            # ultima rodada permitida: sem tools, o modelo precisa responder em texto
+            final = budget.exhausted()
+            model_started = time.monotonic()
+            model_content, calls = yield "model", hist, None if final else tools
+            if final:
+                calls = []
+            yield "event", self._wrap("heartbeat", {
+                "stage": "tool_round",
+                "round": budget.rounds,
+                "calls": round_calls,
+                "tools_ms": tools_ms,
+                "model_ms": round((time.monotonic() - model_started) * 1000),
+                "elapsed_ms": budget.elapsed_ms(),
+                "final": final,
+            })
+
+        if model_content.parts:
             hist.append(model_content)
         elif session_id:
             print(json.dumps({
                 "timestamp": datetime.now().isoformat(),
                 "session_id": session_id,
-                "event": "model_content_skipped",
-                "reason": "empty_parts_after_tool_call",
+                "event": "final_content_skipped",
+                "reason": "empty_parts",
             }))
-        if out_parts:
-            hist.append(types.Content(role="user", parts=out_parts))
-        resp = generate(contents=hist, tools=tools, stream=False, session_id=session_id)
-        calls = _extract_function_calls(resp)
-
-    final_content = _response_to_content(resp, session_id)
-    if getattr(final_content, "parts", None):
-        hist.append(final_content)
-    elif session_id:
-        print(json.dumps({
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "event": "final_content_skipped",
-            "reason": "empty_parts",
-        }))
 
-    if committed:
-        plan_prompt = "Com base no contexto do usuário recém-persistido, gere um plano de estudos inicial personalizado."
-        plan_request = types.Content(role="user", parts=[types.Part(text=plan_prompt)])
-        hist.append(plan_request)
-        if session_id:
-            print(json.dumps({
-                "timestamp": datetime.now().isoformat(),
-                "session_id": session_id,
-                "event": "plan_prompt_assembled",
-                "plan_prompt": plan_prompt,
-                "plan_contents_count": len(hist)
-            }))
-        yield _wrap("meta", {
-            "type": "plan_generation_started",
-            "study_context_id": study_context_id,
-            "user_context_id": study_context_id,
-        })
-        stream = generate(contents=hist, stream=True, session_id=session_id)
-        for chunk in stream:
-            text_piece = getattr(chunk, "text", None)
-            if not text_piece:
-                continue
-            token_index += 1
-            yield _wrap("token", {
-                "index": token_index,
-                "stage": "study_plan",
-                "text": text_piece,
-            })
-            if STREAM_DELAY_MS:
-                time.sleep(STREAM_DELAY_MS / 1000.0)
-        yield _wrap("meta", {
-            "type": "plan_generation_completed",
-            "study_context_id": study_context_id,
-            "user_context_id": study_context_id,
-            "tokens_streamed": token_index,
-        })
-    else:
-        final_text = getattr(resp, "text", "") or "Desculpe, não consegui gerar a mensagem."
-        if session_id:
-            print(json.dumps({
-                "timestamp": datetime.now().isoformat(),
-                "session_id": session_id,
-                "event": "final_text_streaming",
-                "final_text_length": len(final_text)
-            }))
-        for piece in _chunk_text(final_text):
-            token_index += 1
-            yield _wrap("token", {
-                "index": token_index,
-                "stage": "assistant_response",
-                "text": piece,
+        job_id: str | None = None
+        if self.committed:
+            # o plano e gerado por um job: o chat termina aqui e os tokens do plano
+            # chegam pelo stream do job (GET /jobs/stream/?job_id=...)
+            job = yield "plan", self.study_context_id, hist
+            job_id = str(job.id)
+            if session_id:
+                print(json.dumps({
+                    "timestamp": datetime.now().isoformat(),
+                    "session_id": session_id,
+                    "event": "plan_generation_enqueued",
+                    "job_id": job_id,
+                    "plan_contents_count": len(hist)
+                }))
+            yield "event", self._wrap("meta", {
+                "type": "plan_generation_enqueued",
+                "job_id": job_id,
+                "study_context_id": self.study_context_id,
+                "user_context_id": self.study_context_id,
             })
-            if STREAM_DELAY_MS:
-                time.sleep(STREAM_DELAY_MS / 1000.0)
-
-    yield _wrap("meta", {
-        "type": "session_finished",
-        "total_tokens": token_index,
-        "committed": committed,
-        "study_context_id": study_context_id,
-        "user_context_id": study_context_id,
-    })
+        elif not self.token_index:
+            # o modelo nao devolveu texto algum: mantem a mensagem de fallback
+            yield "event", self.token(FALLBACK_REPLY)
+
+        yield "event", self._finished(job_id=job_id)
+
+
+def chat_stream(
+    user,
+    messages: list[dict],
+    session_id: str | None = None,
+    history: list[types.Content] | None = None,
+) -> Generator[dict[str, Any], None, None]:
+    """
+    Stream chat flow as structured events for SSE consumers.
+    Each yielded item is a dict like {"event": <str>, "data": {..}}.
+    Text is forwarded as the model produces it (no buffering between rounds).
+    `history` (server-side sessions) replaces building it from `messages`.
+    """
+    turn = _ChatTurn(messages, session_id, history)
+    steps = turn.steps()
+    reply = None
+    while True:
+        try:
+            command = steps.send(reply)
+        except StopIteration:
+            return
+        reply = None
+        kind = command[0]
+        if kind == "event":
+            yield command[1]
+        elif kind == "model":
+            pieces = _stream_round(command[1], command[2], session_id)
+            while True:
+                try:
+                    piece = next(pieces)
+                except StopIteration as stop:
+                    reply = stop.value
+                    break
+                yield turn.token(piece)
+        elif kind == "tools":
+            reply = run_tool_calls(user, command[1], timeout=command[2])
+        elif kind == "plan":
+            reply = enqueue_chat_plan(user, command[1], command[2])
+
+
+async def achat_stream(
+    user,
+    messages: list[dict],
+    session_id: str | None = None,
+    history: list[types.Content] | None = None,
+) -> AsyncIterator[dict[str, Any]]:
+    """
+    Mesmo turno de chat_stream no event loop: as rodadas do modelo usam
+    client.astream (a conexao espera na corrotina, sem thread por stream); so
+    as tools e o enqueue do plano, que usam o ORM, passam por sync_to_async.
+    """
+    turn = _ChatTurn(messages, session_id, history)
+    steps = turn.steps()
+    reply = None
+    while True:
+        try:
+            command = steps.send(reply)
+        except StopIteration:
+            return
+        reply = None
+        kind = command[0]
+        if kind == "event":
+            yield command[1]
+        elif kind == "model":
+            round_parts = _RoundParts()
+            async for chunk in astream(command[1], tools=command[2], session_id=session_id, call_site="chat"):
+                for piece in round_parts.feed(chunk):
+                    yield turn.token(piece)
+            reply = round_parts.result()
+        elif kind == "tools":
+            reply = await sync_to_async(run_tool_calls)(user, command[1], timeout=command[2])
+        elif kind == "plan":
+            reply = await sync_to_async(enqueue_chat_plan)(user, command[1], command[2])
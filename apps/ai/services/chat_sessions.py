@@ -0,0 +1,201 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Generator
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from google.genai import types
+
+from apps.ai.client import generate
+from apps.ai.models import ChatSession, ChatTurn
+from apps.ai.services.chat import FALLBACK_REPLY, SYSTEM_CONTENT, achat_stream, chat_once, chat_stream, make_turn
+from apps.ai.services.chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Historicos (list[types.Content]) mantidos em memoria por processo; validados
+# pelo turn_count da sessao, entao um turno gravado por outro worker so forca
+# remontar a partir do banco.
+CHAT_HISTORY_CACHE_SIZE = int(os.getenv("CHAT_HISTORY_CACHE_SIZE", "512"))
+# Compactacao: quando os turnos fora do resumo passam do orcamento (tokens
+# estimados), os mais antigos sao dobrados no resumo e ficam so os ultimos
+# CHAT_HISTORY_KEEP_TURNS. Roda numa task depois que a resposta e gravada,
+# entao o turno seguinte ja sai com o prompt dentro do orcamento.
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+CHAT_HISTORY_KEEP_TURNS = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "6"))
+
+SUMMARY_PROMPT = (
+    "Você mantém o resumo de uma conversa de onboarding do Teacher Plus. "
+    "Atualize o resumo abaixo com as novas mensagens, registrando apenas os fatos já informados "
+    "pelo usuário (persona, objetivo, prazo, horas semanais, rotina, nível, autoavaliação, interesses, "
+    "materiais, preferências, infraestrutura, consentimento LGPD) e correções feitas por ele, "
+    "além da etapa em que a conversa está. Responda só com o resumo, em tópicos curtos."
+)
+
+_lock = threading.Lock()
+_histories: OrderedDict[str, tuple[int, list[types.Content]]] = OrderedDict()
+
+
+def _cache_get(session: ChatSession) -> list[types.Content] | None:
+    with _lock:
+        entry = _histories.get(str(session.id))
+        if entry is None or entry[0] != session.turn_count:
+            return None
+        _histories.move_to_end(str(session.id))
+        return entry[1]
+
+
+def _cache_put(session_id, turn_count: int, history: list[types.Content]):
+    if CHAT_HISTORY_CACHE_SIZE <= 0:
+        return
+    with _lock:
+        _histories[str(session_id)] = (turn_count, history)
+        _histories.move_to_end(str(session_id))
+        while len(_histories) > CHAT_HISTORY_CACHE_SIZE:
+            _histories.popitem(last=False)
+
+
+def clear_history_cache():
+    with _lock:
+        _histories.clear()
+
+
+def open_session(user, session_id=None) -> ChatSession | None:
+    """Sessao existente do usuario (None se nao for dele) ou uma nova."""
+    if session_id is None:
+        return ChatSession.objects.create(owner=user)
+    return ChatSession.objects.filter(id=session_id, owner=user).first()
+
+
+def session_history(session: ChatSession) -> list[types.Content]:
+    """Historico pronto para o modelo (SYSTEM + turnos), sem reconstruir a cada turno."""
+    history = _cache_get(session)
+    if history is None:
+        turns = session.turns.order_by("index").values_list("role", "content")
+        history = [SYSTEM_CONTENT] + [make_turn(role, content) for role, content in turns]
+        _cache_put(session.id, session.turn_count, history)
+    return history
+
+
+def _cache_extend(session_id, expected_count: int, content: types.Content):
+    with _lock:
+        entry = _histories.get(str(session_id))
+    if entry is not None and entry[0] == expected_count:
+        # copia: quem ja leu a lista (um stream em andamento) nao ve a mudanca
+        _cache_put(session_id, expected_count + 1, entry[1] + [content])
+
+
+def append_turn(session: ChatSession, role: str, content: str) -> ChatTurn:
+    with transaction.atomic():
+        # trava a linha da sessao: dois turnos simultaneos nao disputam o mesmo index
+        index = ChatSession.objects.select_for_update().values_list("turn_count", flat=True).get(id=session.id)
+        turn = ChatTurn.objects.create(session_id=session.id, index=index, role=role, content=content)
+        ChatSession.objects.filter(id=session.id).update(turn_count=index + 1, updated_at=timezone.now())
+    session.turn_count = index + 1
+    _cache_extend(session.id, index, make_turn(role, content))
+    return turn
+
+
+def _content_tokens(content: types.Content) -> int:
+    return sum(estimate_tokens(p.text) for p in content.parts or [] if getattr(p, "text", None))
+
+
+def _summarize(previous: str, turns: list[types.Content]) -> str:
+    lines = [f"{'Usuário' if c.role == 'user' else 'Assistente'}: {c.parts[0].text}" for c in turns]
+    prompt = f"{SUMMARY_PROMPT}\n\nResumo atual:\n{previous or '(vazio)'}\n\nNovas mensagens:\n" + "\n".join(lines)
+    resp = generate(contents=[types.Content(role="user", parts=[types.Part(text=prompt)])], call_site="chat_summary")
+    return (getattr(resp, "text", "") or "").strip()
+
+
+def _needs_compaction(session: ChatSession, turns: list[types.Content]) -> bool:
+    window = turns[session.summary_upto:]
+    return sum(_content_tokens(c) for c in window) > CHAT_HISTORY_TOKEN_BUDGET and len(window) > CHAT_HISTORY_KEEP_TURNS
+
+
+def prompt_history(session: ChatSession) -> list[types.Content]:
+    """
+    Historico enviado ao modelo: SYSTEM + resumo gravado dos turnos antigos +
+    turnos desde o resumo. Nao chama o modelo: o resumo e atualizado por
+    compact_history, depois do turno.
+    """
+    history = session_history(session)
+    if not session.summary:
+        return history
+    note = types.Content(role="user", parts=[types.Part(
+        text=f"Resumo da conversa até aqui (fatos já coletados):\n{session.summary}"
+    )])
+    return [history[0], note] + history[1:][session.summary_upto:]
+
+
+def compact_history(session_id) -> bool:
+    """
+    Dobra no resumo os turnos antigos quando a janela estoura o orcamento (uma
+    chamada ao modelo). Roda na task ai.compact_chat_history; sem resumo o
+    proximo turno segue com a janela inteira.
+    """
+    session = ChatSession.objects.filter(id=session_id).first()
+    if session is None:
+        return False
+    turns = session_history(session)[1:]
+    if not _needs_compaction(session, turns):
+        return False
+    upto = len(turns) - CHAT_HISTORY_KEEP_TURNS
+    try:
+        summary = _summarize(session.summary, turns[session.summary_upto:upto])
+    except Exception as exc:
+        logger.warning("Falha ao resumir a sessao %s: %s", session.id, exc)
+        return False
+    if not summary:
+        return False
+    # outra compactacao pode ter gravado antes: so substitui o resumo que foi lido
+    return bool(ChatSession.objects.filter(id=session.id, summary_upto=session.summary_upto).update(
+        summary=summary, summary_upto=upto,
+    ))
+
+
+def _finish_turn(session: ChatSession, reply: str):
+    """Grava a resposta do assistente e, se a janela estourou, agenda a compactacao."""
+    if reply and reply != FALLBACK_REPLY:
+        append_turn(session, "assistant", reply)
+    if _needs_compaction(session, session_history(session)[1:]):
+        from apps.ai.tasks import compact_chat_history_task  # lazy import: tasks importa os servicos do chat
+
+        session_id = str(session.id)
+        transaction.on_commit(lambda: compact_chat_history_task.apply_async(args=[session_id], queue="ai_generation"))
+
+
+def session_reply(user, session: ChatSession, message: str) -> str:
+    append_turn(session, "user", message)
+    reply = chat_once(user, [], str(session.id), history=prompt_history(session))
+    _finish_turn(session, reply)
+    return reply
+
+
+def session_stream(user, session: ChatSession, message: str) -> Generator[dict[str, Any], None, None]:
+    """
+    chat_stream sobre o historico da sessao: grava a mensagem do usuario antes
+    de gerar e o texto emitido pelo modelo (tokens) como turno do assistente.
+    A mensagem de fallback (modelo sem texto) nao entra no historico.
+    """
+    append_turn(session, "user", message)
+    reply: list[str] = []
+    for packet in chat_stream(user, [], str(session.id), history=prompt_history(session)):
+        if packet.get("event") == "token":
+            reply.append(packet["data"].get("text", ""))
+        yield packet
+    _finish_turn(session, "".join(reply))
+
+
+async def asession_stream(user, session: ChatSession, message: str) -> AsyncGenerator[dict[str, Any], None]:
+    """Versao async de session_stream, sobre achat_stream."""
+    await sync_to_async(append_turn)(session, "user", message)
+    history = await sync_to_async(prompt_history)(session)
+    reply: list[str] = []
+    async for packet in achat_stream(user, [], str(session.id), history=history):
+        if packet.get("event") == "token":
+            reply.append(packet["data"].get("text", ""))
+        yield packet
+    await sync_to_async(_finish_turn)(session, "".join(reply))
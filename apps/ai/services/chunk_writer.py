@@ -0,0 +1,168 @@
+import uuid
+import weakref
+from typing import Iterable
+
+import numpy as np
+from django.db import connection, transaction
+from pgvector.psycopg import register_vector
+
+from apps.ai.models import Chunk
+from apps.ai.services.embedding import text_hash
+
+# (order, text, embedding) -- embedding pode ser None (chunk ainda sem vetor)
+ChunkRow = tuple[int, str, "list[float] | np.ndarray | None"]
+
+_COPY_TYPES = ["uuid", "int4", "text", "vector", "text"]
+
+# conexoes psycopg que ja conhecem o tipo vector. register_vector consulta o
+# catalogo a cada chamada; uma vez por conexao basta (reconexao = objeto novo)
+_vector_conns: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def _copy_sql() -> str:
+    qn = connection.ops.quote_name
+    opts = Chunk._meta
+    cols = ", ".join(qn(opts.get_field(f).column) for f in ("document", "order", "text", "embedding", "content_hash"))
+    return f"COPY {qn(opts.db_table)} ({cols}) FROM STDIN (FORMAT BINARY)"
+
+
+def _as_vector(v):
+    if v is None or isinstance(v, np.ndarray):
+        return v
+    return np.asarray(v, dtype=np.float32)
+
+
+def _vector_connection():
+    connection.ensure_connection()
+    conn = connection.connection
+    if conn not in _vector_conns:
+        register_vector(conn)
+        _vector_conns.add(conn)
+    return conn
+
+
+def _bulk_create(document_id, rows: Iterable[ChunkRow]) -> int:
+    objs = [Chunk(document_id=document_id, order=o, text=t, embedding=v, content_hash=text_hash(t)) for o, t, v in rows]
+    Chunk.objects.bulk_create(objs, batch_size=200)
+    return len(objs)
+
+
+def write_chunks(document_id, rows: Iterable[ChunkRow]) -> int:
+    """
+    Grava chunks via COPY ... FROM STDIN (FORMAT BINARY) na conexao do Django
+    (respeita o atomic() corrente). Vetores vao no formato binario do
+    pgvector em vez de texto, evitando renderizar/parsear 1536 floats por linha.
+    """
+    if connection.vendor != "postgresql":
+        return _bulk_create(document_id, rows)
+    doc_uuid = document_id if isinstance(document_id, uuid.UUID) else uuid.UUID(str(document_id))
+    conn = _vector_connection()
+    written = 0
+    with conn.cursor() as cur:
+        with cur.copy(_copy_sql()) as copy:
+            copy.set_types(_COPY_TYPES)
+            for order, text, vec in rows:
+                copy.write_row((doc_uuid, order, text, _as_vector(vec), text_hash(text)))
+                written += 1
+    return written
+
+
+def _bulk_update(rows: Iterable[tuple[int, "list[float] | np.ndarray"]]) -> int:
+    objs = [Chunk(id=chunk_id, embedding=vec) for chunk_id, vec in rows]
+    Chunk.objects.bulk_update(objs, ["embedding"], batch_size=200)
+    return len(objs)
+
+
+def update_embeddings(rows: Iterable[tuple[int, "list[float] | np.ndarray"]]) -> int:
+    """
+    Preenche o embedding de chunks ja gravados: COPY binario (id, vetor) para
+    uma tabela temporaria e um unico UPDATE ... FROM, em vez de um UPDATE por linha.
+    """
+    if connection.vendor != "postgresql":
+        return _bulk_update(rows)
+    qn = connection.ops.quote_name
+    table = qn(Chunk._meta.db_table)
+    with transaction.atomic():
+        conn = _vector_connection()
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE _chunk_vectors (id bigint, embedding vector) ON COMMIT DROP")
+            written = 0
+            with cur.copy("COPY _chunk_vectors (id, embedding) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.set_types(["int8", "vector"])
+                for chunk_id, vec in rows:
+                    copy.write_row((chunk_id, _as_vector(vec)))
+                    written += 1
+            cur.execute(f"UPDATE {table} AS c SET embedding = v.embedding FROM _chunk_vectors AS v WHERE c.id = v.id")
+            # dentro de um atomic() externo o commit demora: libera o nome ja
+            cur.execute("DROP TABLE _chunk_vectors")
+    return written
+
+
+class ChunkStage:
+    """
+    Linhas novas de uma versao do documento, gravadas fora da tabela de chunks
+    (tabela temporaria da sessao, via COPY binario) ate `publish`: busca e RAG
+    nao veem a versao nova pela metade, e uma falha no meio nao deixa as duas.
+    """
+
+    def __init__(self, document_id):
+        self.document_id = document_id
+        self.table = f"_chunk_stage_{uuid.uuid4().hex}"
+        self.pending: list[ChunkRow] = []  # sem Postgres: fica em memoria
+        self.created = False
+        self.rows = 0
+
+    def _cursor(self):
+        return _vector_connection().cursor()
+
+    def write(self, rows: Iterable[ChunkRow]) -> int:
+        if connection.vendor != "postgresql":
+            batch = list(rows)
+            self.pending.extend(batch)
+            self.rows += len(batch)
+            return len(batch)
+        written = 0
+        with self._cursor() as cur:
+            if not self.created:
+                # sem ON COMMIT DROP: sobrevive aos commits entre os lotes (vive na sessao)
+                cur.execute(f"CREATE TEMP TABLE {self.table} (\"order\" int4, text text, embedding vector, content_hash text)")
+                self.created = True
+            with cur.copy(f"COPY {self.table} (\"order\", text, embedding, content_hash) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.set_types(["int4", "text", "vector", "text"])
+                for order, text, vec in rows:
+                    copy.write_row((order, text, _as_vector(vec), text_hash(text)))
+                    written += 1
+        self.rows += written
+        return written
+
+    def publish(self) -> int:
+        """Move as linhas para a tabela de chunks; chamar dentro do atomic() da troca de versao."""
+        if connection.vendor != "postgresql":
+            written = _bulk_create(self.document_id, self.pending)
+            self.pending = []
+            return written
+        if not self.created:
+            return 0
+        qn = connection.ops.quote_name
+        opts = Chunk._meta
+        cols = ", ".join(qn(opts.get_field(f).column) for f in ("document", "order", "text", "embedding", "content_hash"))
+        doc_uuid = self.document_id if isinstance(self.document_id, uuid.UUID) else uuid.UUID(str(self.document_id))
+        with self._cursor() as cur:
+            cur.execute(
+                f"INSERT INTO {qn(opts.db_table)} ({cols}) "
+                f"SELECT %s, \"order\", text, embedding, content_hash FROM {self.table}",
+                [doc_uuid],
+            )
+            cur.execute(f"DROP TABLE {self.table}")
+        self.created = False
+        return self.rows
+
+    def discard(self):
+        self.pending = []
+        if self.created and connection.connection is not None:
+            try:
+                with connection.connection.cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {self.table}")
+            except Exception:
+                pass  # sessao perdida: a tabela temporaria ja foi junto
+        self.created = False
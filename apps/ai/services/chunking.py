@@ -0,0 +1,128 @@
+import os
+import re
+from typing import Iterable, Iterator
+
+# Tamanho e sobreposicao dos chunks em tokens estimados (~4 caracteres/token).
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "300"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+CHARS_PER_TOKEN = 4
+
+# Candidatos a fim de sentenca: pontuacao final (+ aspas/parenteses) seguida de
+# espaco, ou quebra de linha. A decisao final fica em _is_boundary.
+_BOUNDARY = re.compile(r'[.!?…]+["”’»)\]]*[ \t]+|[ \t]*\n\s*')
+_WORD_BEFORE = re.compile(r"(\S+)$")
+
+# Abreviacoes comuns em pt-BR (apostilas, legislacao, provas) que terminam em
+# ponto sem encerrar a sentenca: "art. 5º", "Prof. Silva", "p. 12"...
+_ABBREVIATIONS = {
+    "art", "arts", "inc", "par", "al", "cf", "cap", "caps", "p", "pp", "pag", "pág", "pgs",
+    "sr", "sra", "srs", "srta", "dr", "dra", "drs", "prof", "profa", "profª", "me", "ma",
+    "n", "nº", "no", "núm", "num", "vol", "fig", "figs", "tab", "ex", "obs", "av", "r",
+    "séc", "sec", "aprox", "máx", "max", "mín", "min", "ltda", "cia", "etc", "ed", "trad",
+    "org", "coord", "a.c", "d.c", "e.g", "i.e", "vs", "op", "cit", "ibid", "id",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    # Heuristica barata (~4 caracteres por token) suficiente para dimensionar lotes.
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _is_boundary(buf: str, m: re.Match) -> bool:
+    if "\n" in m.group(0):
+        return True
+    if m.group(0)[0] == ".":
+        word = _WORD_BEFORE.search(buf, 0, m.start())
+        token = (word.group(1) if word else "").lstrip("(\"“'").lower()
+        if token in _ABBREVIATIONS or (len(token) == 1 and token.isalpha()):
+            return False
+    nxt = buf[m.end()] if m.end() < len(buf) else ""
+    # "... e.g. a seguir" -> continua a sentenca quando o proximo caractere e minusculo
+    return not nxt.islower()
+
+
+def _hard_split(text: str, max_chars: int) -> Iterator[str]:
+    """Quebra um trecho sem fronteira natural, preferindo cortar em espaco."""
+    while len(text) > max_chars:
+        cut = text.rfind(" ", max_chars // 2, max_chars)
+        cut = cut + 1 if cut > 0 else max_chars
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
+
+
+def iter_segments(blocks: Iterable[str], max_chars: int) -> Iterator[str]:
+    """
+    Converte um fluxo de blocos de texto em sentencas/linhas (com o espaco que
+    as segue), nunca maiores que `max_chars`. So mantem em memoria o trecho
+    ainda sem fronteira.
+    """
+    buf = ""
+    for block in blocks:
+        buf += block
+        start = 0
+        for m in _BOUNDARY.finditer(buf):
+            # a fronteira no fim do buffer pode continuar no proximo bloco
+            if m.end() >= len(buf):
+                break
+            if not _is_boundary(buf, m):
+                continue
+            yield from _hard_split(buf[start:m.end()], max_chars)
+            start = m.end()
+        buf = buf[start:]
+        if len(buf) > max_chars:
+            pieces = list(_hard_split(buf, max_chars))
+            yield from pieces[:-1]
+            buf = pieces[-1]
+    if buf:
+        yield from _hard_split(buf, max_chars)
+
+
+def iter_chunks(
+    blocks: Iterable[str],
+    max_tokens: int | None = None,
+    overlap_tokens: int | None = None,
+) -> Iterator[str]:
+    """
+    Chunker unico (gerador) para ingestao: agrupa sentencas ate `max_tokens`
+    estimados e repete as ultimas sentencas do chunk anterior ate
+    `overlap_tokens`. Linhas sem pontuacao maiores que o limite (texto
+    minificado, paragrafos extraidos de PDF) sao cortadas a forca.
+    """
+    max_tokens = max_tokens or CHUNK_MAX_TOKENS
+    overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    overlap_chars = min(overlap_tokens * CHARS_PER_TOKEN, max_chars // 2)
+
+    window: list[str] = []
+    size = 0
+    fresh = False  # a janela tem conteudo ainda nao emitido?
+    for seg in iter_segments(blocks, max_chars):
+        if size + len(seg) > max_chars and fresh:
+            chunk = "".join(window).strip()
+            if chunk:
+                yield chunk
+            # sobreposicao: sentencas finais inteiras que cabem em overlap_chars
+            keep: list[str] = []
+            kept = 0
+            for prev in reversed(window):
+                if kept + len(prev) > overlap_chars:
+                    break
+                keep.insert(0, prev)
+                kept += len(prev)
+            window, size, fresh = keep, kept, False
+        while window and size + len(seg) > max_chars:
+            size -= len(window.pop(0))
+        window.append(seg)
+        size += len(seg)
+        if seg.strip():
+            fresh = True
+    if fresh:
+        chunk = "".join(window).strip()
+        if chunk:
+            yield chunk
+
+
+def chunk_text(text: str, max_tokens: int | None = None, overlap_tokens: int | None = None) -> list[str]:
+    return list(iter_chunks([text], max_tokens=max_tokens, overlap_tokens=overlap_tokens))
@@ -1,36 +1,346 @@
 import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from google import genai
-from google.genai import types
+import httpx
+from asgiref.sync import sync_to_async
+from google.genai import types, errors
+
+from apps.ai.models import EmbeddingCache
+from apps.ai.services import llm_backend, llm_metrics, rate_limit
+from apps.ai.services.chunking import estimate_tokens
+from apps.ai.services.genai_client import get_async_client, get_client
 
 EMBED_MODEL = os.getenv("GEMINI_EMBEDDING_MODEL", "gemini-embedding-001")
 EMBED_DIM = int(os.getenv("EMBEDDING_DIM", "1536"))
+# Tamanho do LRU em memoria (por processo) e liga/desliga do nivel Postgres.
+EMBED_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBED_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "true").lower() in ("1", "true", "yes", "on")
+# Limites por requisicao do provedor + paralelismo/backoff dos sub-lotes.
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "100"))
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "20000"))
+EMBED_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+EMBED_BACKOFF_BASE_S = float(os.getenv("EMBEDDING_BACKOFF_BASE_S", "0.5"))
+EMBED_BACKOFF_MAX_S = float(os.getenv("EMBEDDING_BACKOFF_MAX_S", "20"))
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+logger = logging.getLogger(__name__)
 
 
-def embed_one(text: str) -> List[float]:
-    resp = client.models.embed_content(
-        model=EMBED_MODEL,
-        contents=text,
-        config=types.EmbedContentConfig(output_dimensionality=EMBED_DIM),
+class _LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is not None:
+                self._data.move_to_end(key)
+            return vec
+
+    def put(self, key: str, vec: List[float]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = vec
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_memory_cache = _LRUCache(EMBED_CACHE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "api_calls": 0, "retries": 0}
+
+
+def _bump(**deltas):
+    with _stats_lock:
+        for k, v in deltas.items():
+            _stats[k] += v
+
+
+def cache_stats() -> dict:
+    """Contadores de hit/miss do cache de embeddings neste processo."""
+    with _stats_lock:
+        data = dict(_stats)
+    lookups = data["memory_hits"] + data["db_hits"] + data["misses"]
+    data["hit_rate"] = round((data["memory_hits"] + data["db_hits"]) / lookups, 4) if lookups else 0.0
+    return data
+
+
+def reset_cache(stats: bool = True):
+    _memory_cache.clear()
+    if stats:
+        with _stats_lock:
+            for k in _stats:
+                _stats[k] = 0
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _cache_model() -> str:
+    # vetores sinteticos/de replay ficam fora das linhas do modelo real
+    namespace = llm_backend.cache_namespace()
+    return f"{namespace}:{EMBED_MODEL}" if namespace else EMBED_MODEL
+
+
+def _memory_key(digest: str) -> str:
+    return f"{_cache_model()}:{EMBED_DIM}:{digest}"
+
+
+def _to_vector(e) -> List[float]:
+    # resp.embeddings[0].values em versoes recentes; senao tentamos mapear para list[float]
+    if hasattr(e, "values"):
+        return list(e.values)
+    return list(e)
+
+
+def split_batches(
+    texts: List[str],
+    max_items: int | None = None,
+    max_tokens: int | None = None,
+) -> List[tuple[int, List[str]]]:
+    """
+    Divide `texts` em sub-lotes que respeitam o limite de itens e de tokens
+    estimados por requisicao. Devolve (offset, textos) para reordenar depois.
+    """
+    max_items = max_items or EMBED_BATCH_MAX_ITEMS
+    max_tokens = max_tokens or EMBED_BATCH_MAX_TOKENS
+    batches: List[tuple[int, List[str]]] = []
+    start, buf, tokens = 0, [], 0
+    for i, text in enumerate(texts):
+        cost = estimate_tokens(text)
+        if buf and (len(buf) >= max_items or tokens + cost > max_tokens):
+            batches.append((start, buf))
+            start, buf, tokens = i, [], 0
+        buf.append(text)
+        tokens += cost
+    if buf:
+        batches.append((start, buf))
+    return batches
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, errors.APIError):
+        code = getattr(exc, "code", None) or 0
+        return code == 429 or code >= 500
+    # o SDK usa httpx: conexao recusada/caida e timeout de leitura nao viram APIError
+    return isinstance(exc, (ConnectionError, TimeoutError, httpx.TransportError))
+
+
+def _request_trace(texts: List[str]) -> tuple[int, llm_metrics.CallTrace]:
+    tokens = sum(estimate_tokens(t) for t in texts)
+    return tokens, llm_metrics.CallTrace("embedding", EMBED_MODEL, prompt_tokens=tokens)
+
+
+def _request_kwargs(texts: List[str]) -> dict:
+    return {
+        "model": EMBED_MODEL,
+        "contents": texts,
+        "config": types.EmbedContentConfig(output_dimensionality=EMBED_DIM),
+    }
+
+
+def _retry_delay(trace: llm_metrics.CallTrace, exc: Exception, attempt: int) -> float:
+    """Espera antes da proxima tentativa; erro final ou nao-retentavel e relancado."""
+    if attempt >= EMBED_MAX_RETRIES or not is_retryable(exc):
+        trace.finish(exc)
+        raise exc
+    # full jitter: espera aleatoria em [0, min(max, base * 2^tentativa)]
+    delay = random.uniform(0, min(EMBED_BACKOFF_MAX_S, EMBED_BACKOFF_BASE_S * (2 ** attempt)))
+    logger.warning(
+        "embed_content falhou (%s); tentativa %s/%s em %.2fs",
+        exc, attempt + 1, EMBED_MAX_RETRIES, delay,
     )
-    # O SDK retorna objeto com lista de embeddings; para 1 conteúdo, pegue o primeiro
-    # O formato concreto é serializável; usamos .values se disponível, senão normalizamos:
-    vec = (getattr(resp, "embeddings", None) or getattr(resp, "embedding", None))
-    # resp.embeddings[0].values em versões recentes
-    if isinstance(vec, list) and hasattr(vec[0], "values"):
-        return vec[0].values
-    if hasattr(vec, "values"):
-        return vec.values
-    # fallback: tentamos mapear para list[float]
-    return list(vec)  # pode ser já uma lista de floats
+    _bump(retries=1)
+    return delay
 
-def embed_batch(texts: List[str]) -> List[List[float]]:
-    resp = client.models.embed_content(
-        model=EMBED_MODEL,
-        contents=texts,
-        config=types.EmbedContentConfig(output_dimensionality=EMBED_DIM),
+
+def _embed_request(texts: List[str]) -> List[List[float]]:
+    tokens, trace = _request_trace(texts)
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            _bump(api_calls=1)
+            # o backoff abaixo continua sendo o retry; o guard so espera vaga e ajusta a janela
+            resp = rate_limit.guard("embed", tokens, trace.attempt(
+                lambda: get_client().models.embed_content(**_request_kwargs(texts))
+            ), retries=0, call_site="embedding")
+            break
+        except Exception as exc:
+            time.sleep(_retry_delay(trace, exc, attempt))
+    trace.finish()
+    return _response_vectors(resp, texts)
+
+
+def _response_vectors(resp, texts: List[str]) -> List[List[float]]:
+    embs = getattr(resp, "embeddings", None) or getattr(resp, "embedding", None) or []
+    if not isinstance(embs, list):
+        embs = [embs]
+    vectors = [_to_vector(e) for e in embs]
+    if len(vectors) != len(texts):
+        raise ValueError(f"Embedding API devolveu {len(vectors)} vetores para {len(texts)} textos")
+    return vectors
+
+
+def _embed_remote(texts: List[str]) -> List[List[float]]:
+    """
+    Envia `texts` em sub-lotes (itens + tokens estimados) num pool de threads
+    limitado e devolve os vetores na ordem original.
+    """
+    batches = split_batches(texts)
+    if len(batches) == 1:
+        return _embed_request(batches[0][1])
+    out: List[List[float] | None] = [None] * len(texts)
+    workers = max(1, min(EMBED_MAX_WORKERS, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as pool:
+        futures = [(offset, pool.submit(_embed_request, batch)) for offset, batch in batches]
+        for offset, fut in futures:
+            vectors = fut.result()
+            out[offset:offset + len(vectors)] = vectors
+    return out
+
+
+def _db_lookup(digests: list[str]) -> dict[str, List[float]]:
+    if not EMBED_CACHE_DB or not digests:
+        return {}
+    rows = EmbeddingCache.objects.filter(
+        model=_cache_model(), dimensions=EMBED_DIM, text_hash__in=digests
+    ).values_list("text_hash", "embedding")
+    return {h: v.tolist() if hasattr(v, "tolist") else list(v) for h, v in rows}
+
+
+def _db_store(entries: dict[str, List[float]]):
+    if not EMBED_CACHE_DB or not entries:
+        return
+    model = _cache_model()
+    EmbeddingCache.objects.bulk_create(
+        [
+            EmbeddingCache(model=model, dimensions=EMBED_DIM, text_hash=h, embedding=v)
+            for h, v in entries.items()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
     )
-    embs = getattr(resp, "embeddings", None) or []
-    return [e.values if hasattr(e, "values") else list(e) for e in embs]
+
+
+class _CacheLookup:
+    """
+    Estado de um embed_batch/aembed no cache em dois niveis. So as idas ao
+    Postgres e a API ficam com o chamador (sync ou async).
+    """
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.digests = [text_hash(t) for t in texts]
+        self.found: dict[str, List[float]] = {}
+        self.memory_hits = self.db_hits = 0
+        for d in set(self.digests):
+            vec = _memory_cache.get(_memory_key(d))
+            if vec is not None:
+                self.found[d] = vec
+                self.memory_hits += 1
+        self.pending = [d for d in dict.fromkeys(self.digests) if d not in self.found]
+        self.missing = self.pending
+
+    def add_db(self, db_found: dict[str, List[float]]):
+        for d, vec in db_found.items():
+            _memory_cache.put(_memory_key(d), vec)
+        self.found.update(db_found)
+        self.db_hits = len(db_found)
+        self.missing = [d for d in self.pending if d not in self.found]
+
+    def missing_texts(self) -> List[str]:
+        first_text = {}
+        for d, t in zip(self.digests, self.texts):
+            first_text.setdefault(d, t)
+        return [first_text[d] for d in self.missing]
+
+    def add_fresh(self, vectors: List[List[float]]) -> dict[str, List[float]]:
+        fresh = dict(zip(self.missing, vectors))
+        for d, vec in fresh.items():
+            _memory_cache.put(_memory_key(d), vec)
+        self.found.update(fresh)
+        return fresh
+
+    def result(self) -> List[List[float]]:
+        _bump(memory_hits=self.memory_hits, db_hits=self.db_hits, misses=len(self.missing))
+        return [self.found[d] for d in self.digests]
+
+
+def embed_one(text: str) -> List[float]:
+    return embed_batch([text])[0]
+
+
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Embeda `texts` passando pelo cache em dois niveis (LRU em memoria -> Postgres).
+    Apenas os textos ausentes dos dois niveis vao para a API; textos repetidos
+    dentro do mesmo lote sao enviados uma unica vez.
+    """
+    if not texts:
+        return []
+    lookup = _CacheLookup(texts)
+    lookup.add_db(_db_lookup(lookup.pending))
+    if lookup.missing:
+        _db_store(lookup.add_fresh(_embed_remote(lookup.missing_texts())))
+    return lookup.result()
+
+
+async def _aembed_request(texts: List[str]) -> List[List[float]]:
+    tokens, trace = _request_trace(texts)
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            _bump(api_calls=1)
+            resp = await rate_limit.aguard("embed", tokens, trace.attempt(
+                lambda: get_async_client().models.embed_content(**_request_kwargs(texts))
+            ), retries=0, call_site="embedding")
+            break
+        except Exception as exc:
+            await asyncio.sleep(_retry_delay(trace, exc, attempt))
+    trace.finish()
+    return _response_vectors(resp, texts)
+
+
+async def _aembed_remote(texts: List[str]) -> List[List[float]]:
+    # sub-lotes em voo ao mesmo tempo na mesma conexao/pool, limitados como no caminho sync
+    gate = asyncio.Semaphore(max(1, EMBED_MAX_WORKERS))
+
+    async def _one(batch):
+        async with gate:
+            return await _aembed_request(batch)
+
+    batches = split_batches(texts)
+    results = await asyncio.gather(*(_one(batch) for _, batch in batches))
+    out: List[List[float]] = []
+    for vectors in results:
+        out.extend(vectors)
+    return out
+
+
+async def aembed(texts: List[str]) -> List[List[float]]:
+    """
+    Versao async de embed_batch: mesmo cache em dois niveis (o Postgres via
+    sync_to_async) e chamadas a API pelo client.aio.
+    """
+    if not texts:
+        return []
+    lookup = _CacheLookup(texts)
+    lookup.add_db(await sync_to_async(_db_lookup)(lookup.pending))
+    if lookup.missing:
+        fresh = lookup.add_fresh(await _aembed_remote(lookup.missing_texts()))
+        await sync_to_async(_db_store)(fresh)
+    return lookup.result()
@@ -0,0 +1,203 @@
+import os
+import shutil
+import logging
+import zipfile
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterable, Iterator
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+# PDFs grandes sao extraidos em faixas de paginas num pool de processos
+# (pypdf e CPU-bound e segura o GIL). Abaixo do limite vale mais fazer inline.
+PDF_WORKERS = int(os.getenv("EXTRACT_PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("EXTRACT_PDF_PAGES_PER_TASK", "16"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACT_PDF_PARALLEL_MIN_PAGES", "48"))
+SNIFF_BYTES = 8192
+
+MIME_PDF = "application/pdf"
+MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MIME_TEXT = "text/plain"
+MIME_BINARY = "application/octet-stream"
+SUPPORTED_MIMES = (MIME_PDF, MIME_DOCX, MIME_TEXT)
+
+# Assinaturas de formatos binarios comuns que nao extraimos (imagens, audio,
+# executaveis, compactados). Cai em MIME_BINARY e e rejeitado antes do embedding.
+_BINARY_MAGIC = (
+    b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"RIFF", b"ID3", b"\x1f\x8b", b"7z\xbc\xaf",
+    b"Rar!", b"MZ", b"\x7fELF", b"\xd0\xcf\x11\xe0", b"OggS", b"fLaC",
+)
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class UnsupportedMaterialError(ValueError):
+    """Arquivo sem texto extraivel (binario, escaneado, formato nao suportado)."""
+
+
+def _looks_binary(head: bytes) -> bool:
+    if not head:
+        return False
+    if b"\x00" in head:
+        return True
+    # bytes de controle (fora \t \n \r \f) denunciam arquivo binario
+    control = sum(1 for b in head if b < 32 and b not in (9, 10, 12, 13))
+    return control / len(head) > 0.05
+
+
+def sniff_mime(fileobj: BinaryIO) -> str:
+    """Detecta o tipo pelo conteudo (magic bytes), nao pela extensao do upload."""
+    pos = fileobj.tell()
+    head = fileobj.read(SNIFF_BYTES)
+    fileobj.seek(pos)
+    if head.startswith(b"%PDF-"):
+        return MIME_PDF
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(fileobj) as zf:
+                is_docx = "word/document.xml" in zf.namelist()
+        except zipfile.BadZipFile:
+            is_docx = False
+        finally:
+            fileobj.seek(pos)
+        return MIME_DOCX if is_docx else MIME_BINARY
+    if head.startswith(_BINARY_MAGIC) or _looks_binary(head):
+        return MIME_BINARY
+    return MIME_TEXT
+
+
+# --- PDF ---------------------------------------------------------------------
+
+def _extract_pdf_range(path: str, start: int, stop: int) -> list[str]:
+    # roda no processo filho: cada faixa reabre o arquivo (PdfReader nao e picklable)
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    pages = []
+    for i in range(start, stop):
+        try:
+            pages.append(reader.pages[i].extract_text() or "")
+        except Exception as exc:  # pagina corrompida nao derruba o documento inteiro
+            logger.warning("Falha ao extrair pagina %s de %s: %s", i + 1, path, exc)
+            pages.append("")
+    return pages
+
+
+def _can_fork_pool() -> bool:
+    # filhos do pool prefork do Celery sao daemon e nao podem criar processos;
+    # a fila ingest roda com --pool threads (compose.yml) para usar o pool
+    return not multiprocessing.current_process().daemon
+
+
+def iter_pdf_pages(path: str, workers: int | None = None) -> Iterator[str]:
+    """
+    Devolve o texto de cada pagina, em ordem. PDFs com muitas paginas sao
+    divididos em faixas de PDF_PAGES_PER_TASK processadas em paralelo, com no
+    maximo 2 faixas por worker em voo para manter a memoria limitada.
+    """
+    from pypdf import PdfReader
+
+    try:
+        total = len(PdfReader(path).pages)
+    except Exception as exc:
+        raise UnsupportedMaterialError(f"PDF invalido: {exc}") from exc
+    workers = workers or PDF_WORKERS
+    ranges = [(s, min(s + PDF_PAGES_PER_TASK, total)) for s in range(0, total, PDF_PAGES_PER_TASK)]
+
+    parallel = total >= PDF_PARALLEL_MIN_PAGES and workers > 1
+    if parallel and not _can_fork_pool():
+        logger.info("PDF com %s paginas extraido em serie: processo daemon (use --pool threads na fila ingest)", total)
+        parallel = False
+    if not parallel:
+        for start, stop in ranges:
+            yield from _extract_pdf_range(path, start, stop)
+        return
+
+    # spawn: o filho nao herda conexoes de banco/threads do worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = []
+        it = iter(ranges)
+        for start, stop in it:
+            pending.append(pool.submit(_extract_pdf_range, path, start, stop))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            pages = pending.pop(0).result()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append(pool.submit(_extract_pdf_range, path, *nxt))
+            yield from pages
+
+
+@contextmanager
+def local_path(fileobj: BinaryIO, suffix: str = ""):
+    """Caminho em disco para o arquivo (storages remotos sao copiados para /tmp)."""
+    raw = getattr(fileobj, "file", fileobj)
+    name = getattr(raw, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        yield name
+        return
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        shutil.copyfileobj(fileobj, tmp)
+        tmp.flush()
+        yield tmp.name
+
+
+# --- DOCX --------------------------------------------------------------------
+
+def iter_docx_paragraphs(fileobj: BinaryIO) -> Iterator[str]:
+    """Le word/document.xml em streaming (iterparse) e devolve um paragrafo por vez."""
+    try:
+        zf = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as exc:
+        raise UnsupportedMaterialError(f"DOCX invalido: {exc}") from exc
+    with zf, zf.open("word/document.xml") as xml:
+        parts: list[str] = []
+        for _, el in ElementTree.iterparse(xml, events=("end",)):
+            tag = el.tag
+            if tag == f"{_W}t":
+                parts.append(el.text or "")
+            elif tag == f"{_W}tab":
+                parts.append("\t")
+            elif tag in (f"{_W}br", f"{_W}cr"):
+                parts.append("\n")
+            elif tag == f"{_W}p":
+                yield "".join(parts) + "\n"
+                parts = []
+                el.clear()
+
+
+# --- entrada unica -----------------------------------------------------------
+
+def _require_text(blocks: Iterable[str], mime: str) -> Iterator[str]:
+    seen = False
+    for block in blocks:
+        if not seen and block.strip():
+            seen = True
+        yield block
+    if not seen:
+        raise UnsupportedMaterialError(f"Nenhum texto extraivel do arquivo ({mime})")
+
+
+def extract_blocks(fileobj: BinaryIO, mime: str | None = None) -> Iterator[str]:
+    """
+    Fluxo de blocos de texto do material, pronto para o chunker. Levanta
+    UnsupportedMaterialError para binarios e para arquivos sem texto (PDF
+    escaneado, DOCX vazio) antes que qualquer chunk chegue ao embedding.
+    """
+    mime = mime or sniff_mime(fileobj)
+    if mime == MIME_PDF:
+        with local_path(fileobj, suffix=".pdf") as path:
+            yield from _require_text((p + "\n\n" for p in iter_pdf_pages(path)), mime)
+    elif mime == MIME_DOCX:
+        yield from _require_text(iter_docx_paragraphs(fileobj), mime)
+    elif mime == MIME_TEXT:
+        from apps.ai.services.ingest import iter_decoded_blocks  # ingest importa models
+
+        yield from _require_text(iter_decoded_blocks(fileobj), mime)
+    else:
+        raise UnsupportedMaterialError(f"Formato nao suportado ({mime}); envie PDF, DOCX ou texto")
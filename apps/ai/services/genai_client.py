@@ -0,0 +1,58 @@
+import os
+import asyncio
+import threading
+import weakref
+
+import httpx
+from google import genai
+from google.genai import types
+
+from apps.ai.services import llm_backend
+
+# Um cliente genai por processo (geracao e embeddings), criado no primeiro
+# uso: importar os modulos nao abre conexao nem exige GEMINI_API_KEY.
+# Sem aiohttp instalado o SDK usa httpx nos dois caminhos; os limites abaixo
+# valem para o pool sync e para o async.
+GEMINI_HTTP_MAX_CONNECTIONS = int(os.getenv("GEMINI_HTTP_MAX_CONNECTIONS", "64"))
+GEMINI_HTTP_MAX_KEEPALIVE = int(os.getenv("GEMINI_HTTP_MAX_KEEPALIVE", "32"))
+GEMINI_HTTP_KEEPALIVE_S = float(os.getenv("GEMINI_HTTP_KEEPALIVE_S", "30"))
+
+_lock = threading.Lock()
+_client: genai.Client | None = None
+# o pool async fica preso ao event loop que o criou: um cliente por loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, genai.Client]" = weakref.WeakKeyDictionary()
+
+
+def _http_options() -> types.HttpOptions:
+    limits = httpx.Limits(
+        max_connections=GEMINI_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=GEMINI_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=GEMINI_HTTP_KEEPALIVE_S,
+    )
+    return types.HttpOptions(client_args={"limits": limits}, async_client_args={"limits": limits})
+
+
+def _new_client() -> genai.Client:
+    # AI_LLM_BACKEND troca o cliente real por record/replay/synthetic (ver llm_backend)
+    return llm_backend.build_client(
+        lambda: genai.Client(api_key=os.getenv("GEMINI_API_KEY"), http_options=_http_options())
+    )
+
+
+def get_client() -> genai.Client:
+    """Cliente genai compartilhado pelo processo (o pool httpx e thread-safe)."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _new_client()
+    return _client
+
+
+def get_async_client():
+    """Interface async (client.aio) do event loop atual: varias chamadas em voo sem threads."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = _new_client()
+    return client.aio
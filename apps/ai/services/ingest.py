@@ -0,0 +1,257 @@
+import os
+import codecs
+import time
+import resource
+from collections import defaultdict
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator
+
+from django.db import transaction
+from django.db.models import F
+
+from apps.ai.models import Chunk, Document
+from apps.ai.services.chunk_writer import ChunkStage, update_embeddings, write_chunks
+from apps.ai.services.embedding import embed_batch, text_hash
+from apps.ai.services.jobs import publish_document_progress
+from apps.ai.services.search import index_lexical
+
+# Teto de memoria do pipeline: um bloco de leitura + o trecho do chunker ainda
+# sem fronteira + um lote de chunks em voo, independente do tamanho do arquivo.
+READ_BLOCK_BYTES = int(os.getenv("INGEST_READ_BLOCK_BYTES", str(256 * 1024)))
+EMBED_BATCH_CHUNKS = int(os.getenv("INGEST_EMBED_BATCH", "64"))
+DELETE_BATCH_ROWS = 5000
+# Documentos grandes (>= FANOUT_MIN_BYTES) sao gravados sem vetor e embedados
+# em faixas de FANOUT_PART_CHUNKS chunks por subtarefas paralelas (chord).
+FANOUT_MIN_BYTES = int(os.getenv("INGEST_FANOUT_MIN_BYTES", str(2 * 1024 * 1024)))
+FANOUT_PART_CHUNKS = int(os.getenv("INGEST_FANOUT_PART_CHUNKS", "256"))
+
+
+def iter_decoded_blocks(fileobj: BinaryIO, block_size: int | None = None) -> Iterator[str]:
+    """
+    Le o arquivo em blocos e decodifica incrementalmente (UTF-8, caindo para
+    latin-1 a partir do primeiro bloco invalido). Sequencias multibyte
+    quebradas entre blocos ficam no buffer do decoder.
+    """
+    block_size = block_size or READ_BLOCK_BYTES
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    fallback = False
+    for raw in iter(lambda: fileobj.read(block_size), b""):
+        if fallback:
+            yield raw.decode("latin-1", errors="ignore")
+            continue
+        pending, _ = decoder.getstate()
+        try:
+            text = decoder.decode(raw)
+        except UnicodeDecodeError:
+            fallback = True
+            text = (pending + raw).decode("latin-1", errors="ignore")
+        if text:
+            yield text
+    if not fallback:
+        pending, _ = decoder.getstate()
+        if pending:
+            yield pending.decode("latin-1", errors="ignore")
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss vem em KiB no Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def record_progress(document_id, *, done: int | None = None, add: int = 0,
+                    total: int | None = None, checkpoint: int | None = None):
+    """
+    Atualiza progresso/checkpoint do documento com um UPDATE (seguro entre
+    subtarefas) e publica o novo progresso no canal de eventos do job.
+    """
+    fields = {}
+    if done is not None:
+        fields["chunks_done"] = done
+    elif add:
+        fields["chunks_done"] = F("chunks_done") + add
+    if total is not None:
+        fields["chunks_total"] = total
+    if checkpoint is not None:
+        fields["ingest_checkpoint"] = checkpoint
+    if fields:
+        Document.objects.filter(id=document_id).update(**fields)
+        publish_document_progress(document_id)
+
+
+def ingest_chunks(doc: Document, chunks: Iterable[str], batch_size: int | None = None, resume_from: int = 0) -> dict:
+    """
+    Consome `chunks` em lotes: embeda o lote, grava via COPY binario e descarta,
+    de modo que no maximo `batch_size` textos/vetores ficam vivos por vez.
+    Cada lote e gravado junto com o checkpoint na mesma transacao; com
+    `resume_from` os primeiros chunks (ja gravados numa tentativa anterior)
+    sao pulados sem embedar de novo.
+    """
+    batch_size = batch_size or EMBED_BATCH_CHUNKS
+    started = time.monotonic()
+    embed_seconds = 0.0
+    if resume_from:
+        # descarta o que estiver alem do checkpoint (nao deveria haver: lote e atomico)
+        Chunk.objects.filter(document=doc, order__gte=resume_from).delete()
+        chunks = islice(chunks, resume_from, None)
+    total = resume_from
+    for batch in batched(chunks, batch_size):
+        t0 = time.monotonic()
+        vectors = embed_batch(batch)
+        embed_seconds += time.monotonic() - t0
+        with transaction.atomic():
+            write_chunks(doc.id, ((total + i, t, v) for i, (t, v) in enumerate(zip(batch, vectors))))
+            total += len(batch)
+            record_progress(doc.id, done=total, checkpoint=total)
+    if total:
+        index_lexical(doc.id)
+    elapsed = time.monotonic() - started
+    return {
+        "chunks": total,
+        "resumed_from": resume_from,
+        "seconds": round(elapsed, 3),
+        "embed_seconds": round(embed_seconds, 3),
+        "chunks_per_sec": round(total / elapsed, 2) if elapsed > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _existing_by_hash(doc: Document) -> dict[str, list[tuple[int, int]]]:
+    # so (id, order, hash): o texto e os vetores dos chunks existentes nao sao lidos
+    existing: dict[str, list[tuple[int, int]]] = defaultdict(list)
+    rows = Chunk.objects.filter(document=doc).order_by("order").values_list("id", "order", "content_hash")
+    for chunk_id, order, digest in rows.iterator(chunk_size=2000):
+        existing[digest].append((chunk_id, order))
+    return existing
+
+
+def _take(candidates: list[tuple[int, int]], order: int) -> tuple[int, int]:
+    # prefere o chunk que ja esta na mesma posicao (evita UPDATE de order)
+    for i, (_, old_order) in enumerate(candidates):
+        if old_order == order:
+            return candidates.pop(i)
+    return candidates.pop(0)
+
+
+def reingest_chunks(doc: Document, chunks: Iterable[str], batch_size: int | None = None) -> dict:
+    """
+    Re-ingere uma nova versao de `doc`: compara cada chunk pelo hash do
+    conteudo com os chunks ja gravados, reaproveita os iguais (so ajustando
+    `order` quando mudou de posicao), embeda apenas os novos e apaga em lote
+    os que sumiram. Os novos ficam em staging ate o fim: a versao inteira
+    (insercao, reordenacao e remocao) entra numa unica transacao.
+    """
+    batch_size = batch_size or EMBED_BATCH_CHUNKS
+    started = time.monotonic()
+    embed_seconds = 0.0
+    existing = _existing_by_hash(doc)
+    moved: list[Chunk] = []
+    reused = added = 0
+    total = 0
+    stage = ChunkStage(doc.id)
+    try:
+        for batch in batched(chunks, batch_size):
+            fresh: list[tuple[int, str]] = []
+            for i, text in enumerate(batch, start=total):
+                candidates = existing.get(text_hash(text))
+                if candidates:
+                    chunk_id, old_order = _take(candidates, i)
+                    reused += 1
+                    if old_order != i:
+                        moved.append(Chunk(id=chunk_id, order=i))
+                else:
+                    fresh.append((i, text))
+            total += len(batch)
+            if fresh:
+                t0 = time.monotonic()
+                vectors = embed_batch([t for _, t in fresh])
+                embed_seconds += time.monotonic() - t0
+                stage.write((o, t, v) for (o, t), v in zip(fresh, vectors))
+                added += len(fresh)
+            record_progress(doc.id, done=total)
+
+        removed_ids = [chunk_id for rows in existing.values() for chunk_id, _ in rows]
+        # troca de versao (insercao, reordenacao, remocao e tsvector) numa transacao curta
+        with transaction.atomic():
+            stage.publish()
+            if moved:
+                Chunk.objects.bulk_update(moved, ["order"], batch_size=1000)
+            for ids in batched(removed_ids, DELETE_BATCH_ROWS):
+                Chunk.objects.filter(id__in=ids).delete()
+            if added:
+                index_lexical(doc.id)
+            record_progress(doc.id, done=total, total=total)
+    finally:
+        stage.discard()
+    elapsed = time.monotonic() - started
+    return {
+        "chunks": total,
+        "reused": reused,
+        "added": added,
+        "removed": len(removed_ids),
+        "seconds": round(elapsed, 3),
+        "embed_seconds": round(embed_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stage_chunks(doc: Document, chunks: Iterable[str], batch_size: int | None = None) -> dict:
+    """
+    Grava so o texto dos chunks (embedding NULL); os vetores vem depois, por
+    faixa. Tudo numa transacao: `chunks_total` preenchido significa staging
+    completo, e uma nova tentativa pode pular extracao e staging.
+    """
+    batch_size = batch_size or EMBED_BATCH_CHUNKS
+    started = time.monotonic()
+    total = 0
+    with transaction.atomic():
+        Chunk.objects.filter(document=doc).delete()
+        for batch in batched(chunks, batch_size * 8):
+            write_chunks(doc.id, ((total + i, t, None) for i, t in enumerate(batch)))
+            total += len(batch)
+        record_progress(doc.id, done=0, total=total, checkpoint=0)
+    doc.chunks_total, doc.chunks_done, doc.ingest_checkpoint = total, 0, 0
+    return {"chunks": total, "stage_seconds": round(time.monotonic() - started, 3), "peak_rss_mb": peak_rss_mb()}
+
+
+def chunk_ranges(total: int, size: int | None = None) -> list[tuple[int, int]]:
+    size = size or FANOUT_PART_CHUNKS
+    return [(start, min(start + size, total)) for start in range(0, total, size)]
+
+
+def embed_chunk_range(document_id, start: int, stop: int, batch_size: int | None = None) -> dict:
+    """
+    Embeda os chunks com order em [start, stop) que ainda estao sem vetor.
+    Cada lote e gravado (com o progresso) ao terminar, entao uma nova
+    tentativa so refaz o que faltou.
+    """
+    batch_size = batch_size or EMBED_BATCH_CHUNKS
+    started = time.monotonic()
+    embed_seconds = 0.0
+    pending = (Chunk.objects
+               .filter(document_id=document_id, order__lt=stop, embedding=None)
+               .order_by("order")
+               .values_list("id", "order", "text"))
+    cursor = start
+    done = 0
+    while batch := list(pending.filter(order__gte=cursor)[:batch_size]):
+        t0 = time.monotonic()
+        vectors = embed_batch([text for _, _, text in batch])
+        embed_seconds += time.monotonic() - t0
+        with transaction.atomic():
+            update_embeddings((chunk_id, vec) for (chunk_id, _, _), vec in zip(batch, vectors))
+            record_progress(document_id, add=len(batch))
+        cursor = batch[-1][1] + 1
+        done += len(batch)
+    return {
+        "start": start,
+        "stop": stop,
+        "chunks": done,
+        "seconds": round(time.monotonic() - started, 3),
+        "embed_seconds": round(embed_seconds, 3),
+    }
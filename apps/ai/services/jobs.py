@@ -0,0 +1,150 @@
+import os
+import json
+import uuid
+import logging
+import threading
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.ai.models import Document, Job
+from apps.ai.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+MAX_BULK_IDS = 100
+JOB_META_CACHE_SIZE = 4096
+# Ingestao sem sinal de vida (Job.updated_at) por mais que isso e tida como
+# abandonada (worker morto): o documento aceita uma nova re-ingestao. Fica
+# acima do CELERY_TASK_TIME_LIMIT e do countdown das novas tentativas.
+INGEST_STALE_S = int(os.getenv("INGEST_STALE_S", "900"))
+
+# job_id -> (owner_id, kind); so guarda jobs encontrados
+_job_meta_cache: dict[str, tuple[str, str]] = {}
+_job_meta_lock = threading.Lock()
+
+
+def user_channel(user_id) -> str:
+    # um canal por usuario: uma unica conexao SSE acompanha todos os jobs dele
+    return f"ai:jobs:user:{user_id}"
+
+
+def create_job(owner, kind: str, job_id=None, plan=None, day=None, document=None) -> Job:
+    fields = {"id": job_id} if job_id else {}
+    return Job.objects.create(owner=owner, kind=kind, plan=plan, day=day, document=document, **fields)
+
+
+def enqueue(task, job: Job, args: list, kwargs: dict | None = None, queue: str = "default"):
+    """
+    Publica a task com task_id = job.id (AsyncResult e Job passam a falar do
+    mesmo id) so depois do commit, para o worker nunca ler um Job inexistente.
+    """
+    transaction.on_commit(
+        lambda: task.apply_async(args=args, kwargs=kwargs or {}, queue=queue, task_id=str(job.id))
+    )
+
+
+def _job_meta(job_id: str) -> tuple[str, str] | None:
+    # (owner_id, kind) nunca mudam: evita um SELECT por evento publicado. Miss
+    # nao entra no cache: o Job pode ainda nao estar visivel (commit pendente)
+    meta = _job_meta_cache.get(job_id)
+    if meta is not None:
+        return meta
+    row = Job.objects.filter(id=job_id).values_list("owner_id", "kind").first()
+    if row is None:
+        return None
+    meta = (str(row[0]), row[1])
+    with _job_meta_lock:
+        if len(_job_meta_cache) >= JOB_META_CACHE_SIZE:
+            # descarta o mais antigo (dict preserva a ordem de insercao)
+            _job_meta_cache.pop(next(iter(_job_meta_cache)), None)
+        _job_meta_cache[job_id] = meta
+    return meta
+
+
+def publish_event(job_id, event: str, data: dict):
+    """
+    Publica no canal do dono apos o commit (quem recebe o evento sempre le o
+    estado gravado). Falha de Redis so e logada: o estado duravel esta no Job.
+    """
+    meta = _job_meta(str(job_id))
+    if meta is None:
+        return
+    owner_id, kind = meta
+    message = json.dumps({"event": event, "job_id": str(job_id), "kind": kind, **data}, default=str)
+
+    def _send():
+        try:
+            get_redis().publish(user_channel(owner_id), message)
+        except Exception as exc:
+            logger.warning("Falha ao publicar evento %s do job %s: %s", event, job_id, exc)
+
+    transaction.on_commit(_send)
+
+
+def _update(job_id, **fields) -> int:
+    # as tasks recebem so o id; UPDATE direto evita ler a linha e e no-op para jobs antigos sem registro
+    return Job.objects.filter(id=job_id).update(updated_at=timezone.now(), **fields)
+
+
+def start_job(job_id):
+    if _update(job_id, status="running", started_at=timezone.now(), attempts=F("attempts") + 1, error=""):
+        publish_event(job_id, "status", {"status": "running"})
+
+
+def update_progress(job_id, **progress):
+    if _update(job_id, progress=progress):
+        publish_event(job_id, "progress", progress)
+
+
+def finish_job(job_id, result: dict | None = None):
+    if _update(job_id, status="succeeded", result=result, finished_at=timezone.now()):
+        publish_event(job_id, "status", {"status": "succeeded", "result": result})
+
+
+def fail_job(job_id, error: str):
+    if _update(job_id, status="failed", error=error, finished_at=timezone.now()):
+        publish_event(job_id, "status", {"status": "failed", "error": error})
+
+
+def note_retry(job_id, error: str):
+    if _update(job_id, error=error):
+        publish_event(job_id, "status", {"status": "running", "error": error})
+
+
+def ingest_is_stale(doc: Document) -> bool:
+    """
+    Documento em pending/running sem ninguem para terminar a ingestao: sem Job
+    dono, Job ja encerrado ou sem atualizacao ha INGEST_STALE_S.
+    """
+    try:
+        job_id = uuid.UUID(str(doc.job_id))
+    except ValueError:
+        return True
+    job = Job.objects.filter(id=job_id).values("status", "updated_at").first()
+    if job is None or job["status"] in TERMINAL_STATUSES:
+        return True
+    return timezone.now() - job["updated_at"] > timedelta(seconds=INGEST_STALE_S)
+
+
+def publish_document_progress(document_id):
+    """Progresso por chunk de uma ingestao (gravado no Document pelas tasks/subtarefas)."""
+    row = Document.objects.filter(id=document_id).values("job_id", "chunks_done", "chunks_total").first()
+    if row and row["job_id"]:
+        # cada lote gravado conta como sinal de vida do Job (ver ingest_is_stale)
+        _update(row["job_id"])
+        publish_event(row["job_id"], "progress", {
+            "document_id": str(document_id),
+            "chunks_done": row["chunks_done"],
+            "chunks_total": row["chunks_total"],
+        })
+
+
+def user_jobs(user, ids=None):
+    qs = Job.objects.filter(owner=user).select_related("document")
+    if ids is not None:
+        return qs.filter(id__in=list(ids)[:MAX_BULK_IDS])
+    return qs.order_by("-created_at")
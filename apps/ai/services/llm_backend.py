@@ -0,0 +1,418 @@
+"""
+Backends do cliente genai, escolhidos por AI_LLM_BACKEND:
+
+- gemini (padrao): o cliente real;
+- record: o cliente real, gravando cada pedido/resposta (com os tempos) em
+  cassetes JSON em AI_LLM_CASSETTE_DIR;
+- replay: responde com as cassetes gravadas, na cadencia original, sem rede;
+- synthetic: respostas geradas localmente e deterministicas por pedido (texto,
+  JSON no formato do schema pedido e embeddings por hash com EMBEDDING_DIM),
+  com latencia e cadencia de stream configuraveis.
+
+Todos expoem a mesma superficie usada pelo app (models.generate_content,
+models.generate_content_stream, models.embed_content e o mesmo em .aio), entao
+generate/stream_text/embed_* e os benchmarks rodam igual com qualquer um.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from datetime import date
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+AI_LLM_BACKEND = os.getenv("AI_LLM_BACKEND", "gemini").lower()
+AI_LLM_CASSETTE_DIR = os.getenv("AI_LLM_CASSETTE_DIR", "cassettes")
+# replay sem cassete: erro (padrao) ou resposta sintetica
+AI_REPLAY_FALLBACK = os.getenv("AI_REPLAY_FALLBACK", "error").lower()
+# 0 responde as cassetes sem esperar; 1 reproduz os tempos gravados
+AI_REPLAY_SPEED = float(os.getenv("AI_REPLAY_SPEED", "1"))
+# distribuicoes em ms: fixed:MS | uniform:MIN:MAX | normal:MEDIA:DESVIO | lognormal:MEDIANA:SIGMA
+AI_FAKE_LATENCY = os.getenv("AI_FAKE_LATENCY", "lognormal:800:0.5")
+AI_FAKE_TTFT = os.getenv("AI_FAKE_TTFT", "lognormal:300:0.4")
+AI_FAKE_CHUNK_INTERVAL = os.getenv("AI_FAKE_CHUNK_INTERVAL", "uniform:20:60")
+AI_FAKE_EMBED_LATENCY = os.getenv("AI_FAKE_EMBED_LATENCY", "lognormal:120:0.3")
+AI_FAKE_OUTPUT_WORDS = int(os.getenv("AI_FAKE_OUTPUT_WORDS", "200"))
+AI_FAKE_CHUNK_WORDS = int(os.getenv("AI_FAKE_CHUNK_WORDS", "8"))
+AI_FAKE_SEED = int(os.getenv("AI_FAKE_SEED", "0"))
+EMBED_DIM = int(os.getenv("EMBEDDING_DIM", "1536"))
+
+BACKENDS = ("gemini", "record", "replay", "synthetic")
+# backends cujas respostas vem do modelo real: dividem os caches com o gemini
+REAL_BACKENDS = ("gemini", "record")
+
+_WORDS = (
+    "estudo revisao plano semana meta exercicio leitura resumo questao tema conceito pratica "
+    "simulado prova objetivo foco tempo dia sessao aula material capitulo exemplo dica"
+).split()
+
+
+class Distribution:
+    """Amostrador de latencia (ms) a partir da especificacao textual."""
+
+    def __init__(self, spec: str):
+        kind, *args = spec.split(":")
+        self.kind = kind.strip().lower()
+        self.args = [float(a) for a in args]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ImproperlyConfigured(f"Distribuicao de latencia invalida: {spec}")
+
+    def sample(self, rng: np.random.Generator) -> float:
+        a = self.args
+        if self.kind == "fixed":
+            value = a[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(a[0], a[1])
+        elif self.kind == "normal":
+            value = rng.normal(a[0], a[1])
+        else:
+            value = a[0] * float(np.exp(rng.normal(0.0, a[1])))
+        return max(0.0, float(value))
+
+
+def _normalize(value):
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    return value
+
+
+def request_key(kind: str, model: str | None, contents, config=None) -> str:
+    raw = json.dumps([kind, model or "", _normalize(contents), _normalize(config)], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _prompt_words(contents) -> int:
+    if isinstance(contents, str):
+        return len(contents.split())
+    total = 0
+    for item in contents or []:
+        if isinstance(item, str):
+            total += len(item.split())
+        for part in getattr(item, "parts", None) or []:
+            total += len((getattr(part, "text", None) or "").split())
+    return total
+
+
+def _usage(prompt_tokens: int, output_tokens: int) -> types.GenerateContentResponseUsageMetadata:
+    return types.GenerateContentResponseUsageMetadata(
+        prompt_token_count=prompt_tokens,
+        candidates_token_count=output_tokens,
+        total_token_count=prompt_tokens + output_tokens,
+    )
+
+
+def _text_response(text: str, usage=None) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text=text)]),
+            finish_reason=types.FinishReason.STOP,
+        )],
+        usage_metadata=usage,
+    )
+
+
+def _schema_dict(schema) -> dict:
+    if schema is None:
+        return {}
+    return _normalize(schema) if not isinstance(schema, dict) else schema
+
+
+def fake_from_schema(schema: dict, name: str = "valor", index: int = 1) -> Any:
+    """Valor minimo valido para o schema (objetos completos, listas com 2 itens)."""
+    kind = str(schema.get("type") or "object").lower()
+    if schema.get("enum"):
+        return schema["enum"][0]
+    if kind == "object":
+        return {k: fake_from_schema(v, k, index) for k, v in (schema.get("properties") or {}).items()}
+    if kind == "array":
+        items = schema.get("items") or {"type": "string"}
+        return [fake_from_schema(items, name, i) for i in (1, 2)]
+    if kind == "integer":
+        return index
+    if kind == "number":
+        return float(index)
+    if kind == "boolean":
+        return True
+    if schema.get("format") == "date":
+        return date.today().isoformat()
+    return f"{name}-{index}"
+
+
+def fake_embedding(text: str, dim: int | None = None) -> list[float]:
+    """Vetor unitario deterministico por texto: o mesmo texto cai sempre no mesmo ponto."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big") ^ AI_FAKE_SEED
+    vec = np.random.default_rng(seed).standard_normal(dim or EMBED_DIM)
+    return (vec / np.linalg.norm(vec)).tolist()
+
+
+class SyntheticBackend:
+    """Respostas locais; latencias e texto sorteados com semente derivada do pedido."""
+
+    def __init__(self):
+        self.latency = Distribution(AI_FAKE_LATENCY)
+        self.ttft = Distribution(AI_FAKE_TTFT)
+        self.interval = Distribution(AI_FAKE_CHUNK_INTERVAL)
+        self.embed_latency = Distribution(AI_FAKE_EMBED_LATENCY)
+
+    @staticmethod
+    def _rng(key: str) -> np.random.Generator:
+        return np.random.default_rng(int(key[:16], 16) ^ AI_FAKE_SEED)
+
+    def _text(self, rng, config) -> str:
+        schema = getattr(config, "response_schema", None) if config is not None else None
+        if schema is not None:
+            return json.dumps(fake_from_schema(_schema_dict(schema)), ensure_ascii=False)
+        return " ".join(_WORDS[i] for i in rng.integers(0, len(_WORDS), AI_FAKE_OUTPUT_WORDS))
+
+    def generate(self, model, contents, config=None) -> tuple[float, types.GenerateContentResponse]:
+        rng = self._rng(request_key("generate", model, contents, config))
+        text = self._text(rng, config)
+        return self.latency.sample(rng), _text_response(text, _usage(_prompt_words(contents), len(text.split())))
+
+    def stream(self, model, contents, config=None) -> list[tuple[float, types.GenerateContentResponse]]:
+        rng = self._rng(request_key("stream", model, contents, config))
+        words = self._text(rng, config).split(" ")
+        step = max(1, AI_FAKE_CHUNK_WORDS)
+        pieces = [" ".join(words[i:i + step]) + (" " if i + step < len(words) else "") for i in range(0, len(words), step)]
+        chunks = []
+        for i, piece in enumerate(pieces):
+            delay = self.ttft.sample(rng) if i == 0 else self.interval.sample(rng)
+            last = i == len(pieces) - 1
+            chunks.append((delay, _text_response(piece, _usage(_prompt_words(contents), len(words)) if last else None)))
+        return chunks
+
+    def embed(self, model, contents, config=None) -> tuple[float, types.EmbedContentResponse]:
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        dim = getattr(config, "output_dimensionality", None) or EMBED_DIM
+        rng = self._rng(request_key("embed", model, texts, config))
+        resp = types.EmbedContentResponse(embeddings=[types.ContentEmbedding(values=fake_embedding(t, dim)) for t in texts])
+        return self.embed_latency.sample(rng), resp
+
+
+class ReplayBackend:
+    """Responde com as cassetes gravadas pelo modo record."""
+
+    def __init__(self, directory: str | None = None, fallback: SyntheticBackend | None = None):
+        self.directory = Path(directory or AI_LLM_CASSETTE_DIR)
+        self.fallback = fallback
+
+    def _load(self, kind, model, contents, config) -> dict | None:
+        path = self.directory / f"{request_key(kind, model, contents, config)}.json"
+        if path.exists():
+            return json.loads(path.read_text(encoding="utf-8"))
+        if self.fallback is None:
+            raise LookupError(f"Cassete {path.name} ({kind}) nao encontrada em {self.directory}")
+        return None
+
+    def generate(self, model, contents, config=None):
+        tape = self._load("generate", model, contents, config)
+        if tape is None:
+            return self.fallback.generate(model, contents, config)
+        return tape["latency_ms"] * AI_REPLAY_SPEED, types.GenerateContentResponse.model_validate(tape["response"])
+
+    def stream(self, model, contents, config=None):
+        tape = self._load("stream", model, contents, config)
+        if tape is None:
+            return self.fallback.stream(model, contents, config)
+        return [
+            (c["delay_ms"] * AI_REPLAY_SPEED, types.GenerateContentResponse.model_validate(c["chunk"]))
+            for c in tape["chunks"]
+        ]
+
+    def embed(self, model, contents, config=None):
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        tape = self._load("embed", model, texts, config)
+        if tape is None:
+            return self.fallback.embed(model, texts, config)
+        return tape["latency_ms"] * AI_REPLAY_SPEED, types.EmbedContentResponse.model_validate(tape["response"])
+
+
+class _Models:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generate_content(self, *, model, contents, config=None):
+        latency, resp = self.backend.generate(model, contents, config)
+        time.sleep(latency / 1000)
+        return resp
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        for delay, chunk in self.backend.stream(model, contents, config):
+            time.sleep(delay / 1000)
+            yield chunk
+
+    def embed_content(self, *, model, contents, config=None):
+        latency, resp = self.backend.embed(model, contents, config)
+        time.sleep(latency / 1000)
+        return resp
+
+
+class _AsyncModels:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def generate_content(self, *, model, contents, config=None):
+        latency, resp = self.backend.generate(model, contents, config)
+        await asyncio.sleep(latency / 1000)
+        return resp
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        # mesmo contrato do SDK: aguardar devolve o iterador async de chunks
+        chunks = self.backend.stream(model, contents, config)
+
+        async def _iter():
+            for delay, chunk in chunks:
+                await asyncio.sleep(delay / 1000)
+                yield chunk
+
+        return _iter()
+
+    async def embed_content(self, *, model, contents, config=None):
+        latency, resp = self.backend.embed(model, contents, config)
+        await asyncio.sleep(latency / 1000)
+        return resp
+
+
+class _Aio:
+    def __init__(self, models):
+        self.models = models
+
+
+class FakeClient:
+    """Substituto do genai.Client para os backends replay e synthetic."""
+
+    def __init__(self, backend):
+        self.models = _Models(backend)
+        self.aio = _Aio(_AsyncModels(backend))
+
+
+class _Recorder:
+    def __init__(self, directory: str | None = None):
+        self.directory = Path(directory or AI_LLM_CASSETTE_DIR)
+        self._lock = threading.Lock()
+
+    def write(self, kind, model, contents, config, tape: dict):
+        tape = {"kind": kind, "model": model, "recorded_at": time.time(), **tape}
+        path = self.directory / f"{request_key(kind, model, contents, config)}.json"
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(tape, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(path)
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+class _RecordingModels:
+    def __init__(self, models, recorder: _Recorder):
+        self._models = models
+        self._recorder = recorder
+
+    def generate_content(self, *, model, contents, config=None):
+        started = time.perf_counter()
+        resp = self._models.generate_content(model=model, contents=contents, config=config)
+        self._recorder.write("generate", model, contents, config, {
+            "latency_ms": _elapsed_ms(started), "response": _normalize(resp),
+        })
+        return resp
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        chunks, last = [], time.perf_counter()
+        for chunk in self._models.generate_content_stream(model=model, contents=contents, config=config):
+            chunks.append({"delay_ms": _elapsed_ms(last), "chunk": _normalize(chunk)})
+            last = time.perf_counter()
+            yield chunk
+        self._recorder.write("stream", model, contents, config, {"chunks": chunks})
+
+    def embed_content(self, *, model, contents, config=None):
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        started = time.perf_counter()
+        resp = self._models.embed_content(model=model, contents=contents, config=config)
+        self._recorder.write("embed", model, texts, config, {
+            "latency_ms": _elapsed_ms(started), "response": _normalize(resp),
+        })
+        return resp
+
+
+class _AsyncRecordingModels:
+    def __init__(self, models, recorder: _Recorder):
+        self._models = models
+        self._recorder = recorder
+
+    async def generate_content(self, *, model, contents, config=None):
+        started = time.perf_counter()
+        resp = await self._models.generate_content(model=model, contents=contents, config=config)
+        self._recorder.write("generate", model, contents, config, {
+            "latency_ms": _elapsed_ms(started), "response": _normalize(resp),
+        })
+        return resp
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        source = await self._models.generate_content_stream(model=model, contents=contents, config=config)
+
+        async def _iter():
+            chunks, last = [], time.perf_counter()
+            async for chunk in source:
+                chunks.append({"delay_ms": _elapsed_ms(last), "chunk": _normalize(chunk)})
+                last = time.perf_counter()
+                yield chunk
+            self._recorder.write("stream", model, contents, config, {"chunks": chunks})
+
+        return _iter()
+
+    async def embed_content(self, *, model, contents, config=None):
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        started = time.perf_counter()
+        resp = await self._models.embed_content(model=model, contents=contents, config=config)
+        self._recorder.write("embed", model, texts, config, {
+            "latency_ms": _elapsed_ms(started), "response": _normalize(resp),
+        })
+        return resp
+
+
+class RecordingClient:
+    """Cliente real que grava cada chamada como cassete para o modo replay."""
+
+    def __init__(self, client, directory: str | None = None):
+        recorder = _Recorder(directory)
+        self.models = _RecordingModels(client.models, recorder)
+        self.aio = _Aio(_AsyncRecordingModels(client.aio.models, recorder))
+
+
+def cache_namespace(backend: str | None = None) -> str:
+    """
+    Espaco dos caches (embeddings e respostas) do backend: vazio nos reais;
+    replay/synthetic gravam a parte e nao mudam o que um run real recebe.
+    """
+    backend = (backend or AI_LLM_BACKEND).lower()
+    return "" if backend in REAL_BACKENDS else backend
+
+
+def build_client(real_factory: Callable[[], Any], backend: str | None = None):
+    """Cliente do backend configurado; `real_factory` cria o genai.Client quando preciso."""
+    backend = (backend or AI_LLM_BACKEND).lower()
+    if backend == "gemini":
+        return real_factory()
+    if backend == "record":
+        return RecordingClient(real_factory())
+    if backend == "replay":
+        fallback = SyntheticBackend() if AI_REPLAY_FALLBACK == "synthetic" else None
+        return FakeClient(ReplayBackend(fallback=fallback))
+    if backend == "synthetic":
+        return FakeClient(SyntheticBackend())
+    raise ImproperlyConfigured(f"AI_LLM_BACKEND invalido: {backend} (use {', '.join(BACKENDS)})")
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from google.genai import types
+
+from apps.ai.services import llm_backend
+from apps.ai.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Cache opt-in de respostas do generate (sem stream). Chave = hash de
+# (modelo, contents, schema, tools): o mesmo prompt estruturado devolve a
+# resposta gravada em vez de ir a rede. Expira por TTL e, acima de
+# LLM_CACHE_MAX_ENTRIES, as entradas menos usadas saem primeiro (LRU no zset).
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+LLM_CACHE_TTL_S = int(os.getenv("LLM_CACHE_TTL_S", "604800"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+
+_PREFIX = "ai:llm_cache"
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "errors": 0}
+# contadores do bloco `track()` corrente (um job); None fora dele
+_scoped: ContextVar[dict | None] = ContextVar("llm_cache_scoped", default=None)
+
+
+def _bump(**deltas):
+    with _stats_lock:
+        for k, v in deltas.items():
+            _stats[k] += v
+    scoped = _scoped.get()
+    if scoped is not None:
+        for k in ("hits", "misses"):
+            scoped[k] += deltas.get(k, 0)
+
+
+@contextmanager
+def track():
+    """Hits/misses so das chamadas feitas dentro do bloco (o job atual, nao o processo)."""
+    stats = {"hits": 0, "misses": 0}
+    token = _scoped.set(stats)
+    try:
+        yield stats
+    finally:
+        _scoped.reset(token)
+
+
+def cache_stats() -> dict:
+    """Contadores do cache de respostas neste processo."""
+    with _stats_lock:
+        data = dict(_stats)
+    lookups = data["hits"] + data["misses"]
+    data["hit_rate"] = round(data["hits"] / lookups, 4) if lookups else 0.0
+    return data
+
+
+def _prefix() -> str:
+    # replay/synthetic usam chaves, indice LRU e contadores proprios (ver llm_backend)
+    namespace = llm_backend.cache_namespace()
+    return f"{_PREFIX}:{namespace}" if namespace else _PREFIX
+
+
+def _index() -> str:
+    return f"{_prefix()}:lru"
+
+
+def _global_stats_key() -> str:
+    return f"{_prefix()}:stats"
+
+
+def global_stats() -> dict:
+    """Mesmos contadores somados entre processos (hash no Redis)."""
+    try:
+        raw = get_redis().hgetall(_global_stats_key())
+    except Exception as exc:
+        logger.warning("Redis indisponivel ao ler stats do cache LLM: %s", exc)
+        return {}
+    data = {k: int(v) for k, v in raw.items()}
+    lookups = data.get("hits", 0) + data.get("misses", 0)
+    data["hit_rate"] = round(data.get("hits", 0) / lookups, 4) if lookups else 0.0
+    return data
+
+
+def reset_stats():
+    with _stats_lock:
+        for k in _stats:
+            _stats[k] = 0
+
+
+def _normalize(value):
+    # Content/Schema/Tool (pydantic) ou dicts: mesma forma canonica para o hash
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    return value
+
+
+def _digest(value) -> str:
+    raw = json.dumps(_normalize(value), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_key(model: str | None, contents, schema=None, tools=None) -> str:
+    parts = [model or "", _digest(contents), _digest(schema), _digest(tools)]
+    return f"{_prefix()}:{hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()}"
+
+
+def _count(r, field: str):
+    try:
+        r.hincrby(_global_stats_key(), field, 1)
+    except Exception:
+        pass
+
+
+def lookup(key: str) -> types.GenerateContentResponse | None:
+    try:
+        r = get_redis()
+        raw = r.get(key)
+        if raw is not None:
+            r.zadd(_index(), {key: time.time()})  # toque do LRU
+    except Exception as exc:
+        _bump(errors=1)
+        logger.warning("Cache LLM indisponivel: %s", exc)
+        return None
+    if raw is None:
+        _bump(misses=1)
+        _count(r, "misses")
+        return None
+    _bump(hits=1)
+    _count(r, "hits")
+    return types.GenerateContentResponse.model_validate_json(raw)
+
+
+def note_bypass():
+    _bump(bypassed=1)
+
+
+def store(key: str, resp, schema=None):
+    text = getattr(resp, "text", None) or ""
+    if not text:
+        return
+    if schema is not None:
+        # resposta estruturada que nao e JSON valido nao e reaproveitada
+        try:
+            json.loads(text)
+        except ValueError:
+            return
+    try:
+        r = get_redis()
+        index = _index()
+        pipe = r.pipeline(transaction=False)
+        pipe.set(key, resp.model_dump_json(exclude_none=True), ex=LLM_CACHE_TTL_S)
+        pipe.zadd(index, {key: time.time()})
+        # entradas ja expiradas saem do indice; acima do limite, as menos usadas
+        pipe.zremrangebyscore(index, "-inf", time.time() - LLM_CACHE_TTL_S)
+        pipe.zcard(index)
+        size = pipe.execute()[-1]
+        if size > LLM_CACHE_MAX_ENTRIES:
+            evicted = [k for k, _ in r.zpopmin(index, size - LLM_CACHE_MAX_ENTRIES)]
+            if evicted:
+                r.delete(*evicted)
+        _bump(stores=1)
+    except Exception as exc:
+        _bump(errors=1)
+        logger.warning("Falha ao gravar no cache LLM: %s", exc)
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+
+from apps.ai.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Telemetria por chamada ao modelo: cada chamada (generate, stream, embed) vira
+# uma linha JSON no log e alimenta histogramas por (call site, modelo). Os
+# contadores ficam no processo e num hash do Redis, somados entre web e
+# workers; /api/ai/metrics/ expoe tudo no formato texto do Prometheus.
+LLM_METRICS_ENABLED = os.getenv("LLM_METRICS_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+LLM_METRICS_REDIS = os.getenv("LLM_METRICS_REDIS", "true").lower() in ("1", "true", "yes", "on")
+# token do scraper (header X-Metrics-Token); vazio: so usuarios staff
+LLM_METRICS_TOKEN = os.getenv("LLM_METRICS_TOKEN", "")
+
+# quem montou o prompt: plano (outline), tarefas da secao, dia, chat e afins
+CALL_SITES = ("outline", "section", "day", "chat", "chat_plan", "chat_summary", "embedding", "other")
+
+HISTOGRAMS = {
+    "llm_call_latency_ms": (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000),
+    "llm_stream_ttft_ms": (50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000),
+    "llm_prompt_tokens": (64, 256, 1024, 4096, 16384, 65536, 262144),
+    "llm_output_tokens": (16, 64, 256, 1024, 4096, 16384),
+}
+COUNTERS = ("llm_calls_total", "llm_errors_total", "llm_retries_total", "llm_cache_hits_total")
+HELP = {
+    "llm_call_latency_ms": "Latencia da chamada ao modelo (ms), do pedido ao ultimo chunk",
+    "llm_stream_ttft_ms": "Tempo ate o primeiro chunk dos streams (ms)",
+    "llm_prompt_tokens": "Tokens de entrada por chamada (usage_metadata ou estimativa)",
+    "llm_output_tokens": "Tokens de saida por chamada (usage_metadata)",
+    "llm_calls_total": "Chamadas ao modelo (sem contar respostas do cache)",
+    "llm_errors_total": "Chamadas que terminaram em erro",
+    "llm_retries_total": "Novas tentativas apos 429/503 ou erro transitorio",
+    "llm_cache_hits_total": "Respostas servidas pelo cache de respostas",
+}
+
+_KEY = "ai:llm_metrics"
+
+_lock = threading.Lock()
+# (metrica, site, modelo) -> contador, ou [buckets..., +Inf] + soma e total
+_series: dict[tuple[str, str, str], float | dict] = {}
+
+
+class CallTrace:
+    """Uma chamada ao modelo: conta tentativas, marca o primeiro chunk e grava ao terminar."""
+
+    def __init__(self, site: str, model: str, stream: bool = False, session_id: str | None = None,
+                 prompt_tokens: int | None = None):
+        self.site = site if site in CALL_SITES else "other"
+        self.model = model or ""
+        self.stream = stream
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.attempts = 0
+        self.ttft_ms: float | None = None
+        # estimativa ate a resposta trazer usage_metadata
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens: int | None = None
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 3)
+
+    def attempt(self, fn):
+        """Embrulha a chamada ao SDK para contar quantas vezes o guard a executou."""
+        def _call():
+            self.attempts += 1
+            return fn()
+        return _call
+
+    def usage(self, resp):
+        usage = getattr(resp, "usage_metadata", None)
+        if not usage:
+            return
+        if getattr(usage, "prompt_token_count", None) is not None:
+            self.prompt_tokens = usage.prompt_token_count
+        if getattr(usage, "candidates_token_count", None) is not None:
+            self.output_tokens = usage.candidates_token_count
+
+    def chunk(self, chunk):
+        if self.ttft_ms is None:
+            self.ttft_ms = self.elapsed_ms()
+        self.usage(chunk)
+
+    def finish(self, error: Exception | None = None):
+        record(self, error)
+
+
+def _observe(updates: list, metric: str, site: str, model: str, value: float | None):
+    if value is None:
+        return
+    bounds = HISTOGRAMS[metric]
+    updates.append((metric, site, model, bisect_left(bounds, value), value))
+
+
+def _apply_local(counters: list, observations: list):
+    with _lock:
+        for metric, site, model, amount in counters:
+            key = (metric, site, model)
+            _series[key] = _series.get(key, 0) + amount
+        for metric, site, model, bucket, value in observations:
+            hist = _series.setdefault((metric, site, model), {
+                "buckets": [0] * (len(HISTOGRAMS[metric]) + 1), "sum": 0.0, "count": 0,
+            })
+            hist["buckets"][bucket] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+
+def _apply_redis(counters: list, observations: list):
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for metric, site, model, amount in counters:
+            pipe.hincrby(_KEY, f"{metric}|{site}|{model}", amount)
+        for metric, site, model, bucket, value in observations:
+            prefix = f"{metric}|{site}|{model}"
+            pipe.hincrby(_KEY, f"{prefix}|b{bucket}", 1)
+            pipe.hincrbyfloat(_KEY, f"{prefix}|sum", value)
+            pipe.hincrby(_KEY, f"{prefix}|count", 1)
+        pipe.execute()
+    except Exception as exc:
+        logger.warning("Redis indisponivel ao gravar metricas LLM: %s", exc)
+
+
+def _emit(counters: list, observations: list):
+    _apply_local(counters, observations)
+    if LLM_METRICS_REDIS:
+        _apply_redis(counters, observations)
+
+
+def record(trace: CallTrace, error: Exception | None = None):
+    if not LLM_METRICS_ENABLED:
+        return
+    latency_ms = trace.elapsed_ms()
+    retries = max(0, trace.attempts - 1)
+    site, model = trace.site, trace.model
+    counters = [("llm_calls_total", site, model, 1)]
+    if error is not None:
+        counters.append(("llm_errors_total", site, model, 1))
+    if retries:
+        counters.append(("llm_retries_total", site, model, retries))
+    observations: list = []
+    _observe(observations, "llm_call_latency_ms", site, model, latency_ms)
+    if trace.stream:
+        _observe(observations, "llm_stream_ttft_ms", site, model, trace.ttft_ms)
+    _observe(observations, "llm_prompt_tokens", site, model, trace.prompt_tokens)
+    _observe(observations, "llm_output_tokens", site, model, trace.output_tokens)
+    _emit(counters, observations)
+    logger.info(json.dumps({
+        "event": "llm_call",
+        "site": site,
+        "model": model,
+        "stream": trace.stream,
+        "session_id": trace.session_id,
+        "latency_ms": latency_ms,
+        "ttft_ms": trace.ttft_ms,
+        "prompt_tokens": trace.prompt_tokens,
+        "output_tokens": trace.output_tokens,
+        "retries": retries,
+        "error": type(error).__name__ if error is not None else None,
+    }))
+
+
+def note_cache_hit(site: str, model: str):
+    """Resposta do cache: conta o hit, mas nao entra nos histogramas de latencia/tokens."""
+    if not LLM_METRICS_ENABLED:
+        return
+    _emit([("llm_cache_hits_total", site if site in CALL_SITES else "other", model or "", 1)], [])
+
+
+def local_snapshot() -> dict:
+    """Series deste processo (copia)."""
+    with _lock:
+        return {k: (dict(v, buckets=list(v["buckets"])) if isinstance(v, dict) else v) for k, v in _series.items()}
+
+
+def global_snapshot() -> dict | None:
+    """Series somadas entre processos (hash no Redis); None se o Redis nao responder."""
+    try:
+        raw = get_redis().hgetall(_KEY)
+    except Exception as exc:
+        logger.warning("Redis indisponivel ao ler metricas LLM: %s", exc)
+        return None
+    series: dict = {}
+    for field, value in raw.items():
+        metric, site, model, *rest = field.split("|")
+        key = (metric, site, model)
+        if metric not in HISTOGRAMS:
+            series[key] = int(float(value))
+            continue
+        hist = series.setdefault(key, {"buckets": [0] * (len(HISTOGRAMS[metric]) + 1), "sum": 0.0, "count": 0})
+        part = rest[0] if rest else ""
+        if part == "sum":
+            hist["sum"] = float(value)
+        elif part == "count":
+            hist["count"] = int(value)
+        elif part.startswith("b") and int(part[1:]) < len(hist["buckets"]):
+            hist["buckets"][int(part[1:])] = int(value)
+    return series
+
+
+def reset_metrics(redis: bool = False):
+    with _lock:
+        _series.clear()
+    if redis:
+        try:
+            get_redis().delete(_KEY)
+        except Exception as exc:
+            logger.warning("Redis indisponivel ao limpar metricas LLM: %s", exc)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(site: str, model: str, **extra) -> str:
+    pairs = {"site": site, "model": model, **extra}
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs.items()) + "}"
+
+
+def _fmt(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_prometheus(series: dict, cache: dict | None = None) -> str:
+    """
+    Formato texto 0.0.4 do Prometheus (buckets acumulados, como o formato exige).
+    `cache` sao os contadores do cache de respostas (llm_cache.global_stats).
+    """
+    lines = []
+    for metric in COUNTERS:
+        rows = sorted((k, v) for k, v in series.items() if k[0] == metric)
+        lines += [f"# HELP {metric} {HELP[metric]}", f"# TYPE {metric} counter"]
+        lines += [f"{metric}{_labels(site, model)} {_fmt(v)}" for (_, site, model), v in rows]
+    for metric, bounds in HISTOGRAMS.items():
+        rows = sorted((k, v) for k, v in series.items() if k[0] == metric)
+        lines += [f"# HELP {metric} {HELP[metric]}", f"# TYPE {metric} histogram"]
+        for (_, site, model), hist in rows:
+            total = 0
+            for le, count in zip([*bounds, "+Inf"], hist["buckets"]):
+                total += count
+                lines.append(f"{metric}_bucket{_labels(site, model, le=le)} {total}")
+            lines.append(f"{metric}_sum{_labels(site, model)} {_fmt(round(hist['sum'], 3))}")
+            lines.append(f"{metric}_count{_labels(site, model)} {hist['count']}")
+    if cache:
+        lines += [
+            "# HELP llm_response_cache_lookups_total Consultas ao cache de respostas por resultado",
+            "# TYPE llm_response_cache_lookups_total counter",
+            f'llm_response_cache_lookups_total{{result="hit"}} {int(cache.get("hits", 0))}',
+            f'llm_response_cache_lookups_total{{result="miss"}} {int(cache.get("misses", 0))}',
+            "# HELP llm_response_cache_hit_ratio Fracao das consultas ao cache de respostas que acertaram",
+            "# TYPE llm_response_cache_hit_ratio gauge",
+            f"llm_response_cache_hit_ratio {_fmt(cache.get('hit_rate', 0.0))}",
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,419 @@
+"""
+Coordenacao das chamadas ao Gemini entre processos e workers:
+
+- token bucket global no Redis (requisicoes e tokens por minuto, por escopo
+  "generate"/"embed"): quem nao tem saldo espera na fila ate o prazo, em vez
+  de falhar com 429;
+- controle de concorrencia AIMD por processo: a janela de chamadas
+  simultaneas cresce devagar com sucesso e cai pela metade em 429 ou pico de
+  latencia, para o throughput ficar perto do limite sem tempestade de erros.
+  O pico e medido contra a media do proprio call site (um outline longo nao e
+  pico perto de um resumo curto). Streams so ocupam a janela ate o primeiro chunk.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+from google.genai import errors
+
+from apps.ai.services.chunking import estimate_tokens
+from apps.ai.services.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+LLM_RATE_LIMIT_ENABLED = os.getenv("LLM_RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+# limites por minuto de cada escopo (0 desliga aquele balde)
+LLM_LIMITS = {
+    "generate": (int(os.getenv("LLM_GENERATE_RPM", "300")), int(os.getenv("LLM_GENERATE_TPM", "1000000"))),
+    "embed": (int(os.getenv("LLM_EMBED_RPM", "1500")), int(os.getenv("LLM_EMBED_TPM", "1000000"))),
+}
+# prazo para conseguir vaga (balde + concorrencia) antes de desistir
+LLM_RATE_WAIT_S = float(os.getenv("LLM_RATE_WAIT_S", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "1"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "20"))
+# AIMD: janela inicial/minima/maxima, fator de corte e pico (x media de latencia)
+LLM_AIMD_INITIAL = float(os.getenv("LLM_AIMD_INITIAL", "4"))
+LLM_AIMD_MIN = float(os.getenv("LLM_AIMD_MIN", "1"))
+LLM_AIMD_MAX = float(os.getenv("LLM_AIMD_MAX", "32"))
+LLM_AIMD_BACKOFF = float(os.getenv("LLM_AIMD_BACKOFF", "0.5"))
+LLM_AIMD_SPIKE_FACTOR = float(os.getenv("LLM_AIMD_SPIKE_FACTOR", "3"))
+LLM_AIMD_COOLDOWN_S = float(os.getenv("LLM_AIMD_COOLDOWN_S", "2"))
+
+# Os dois baldes do escopo num hash; o relogio e o do Redis (mesmo para todos
+# os hosts). Devolve 0 quando debitou ou os ms ate haver saldo. force=1 so
+# debita (acerto de tokens apos a resposta), podendo deixar saldo negativo.
+_BUCKET_LUA = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) * 1000 + math.floor(tonumber(now_t[2]) / 1000)
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local force = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts')
+local req = tonumber(state[1]) or rpm
+local tok = tonumber(state[2]) or tpm
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+if rpm > 0 then req = math.min(rpm, req + elapsed * rpm / 60000) end
+if tpm > 0 then tok = math.min(tpm, tok + elapsed * tpm / 60000) end
+local wait = 0
+if force == 0 then
+  if rpm > 0 and req < 1 then wait = math.max(wait, (1 - req) * 60000 / rpm) end
+  local need = math.min(cost, tpm)
+  if tpm > 0 and tok < need then wait = math.max(wait, (need - tok) * 60000 / tpm) end
+end
+if wait == 0 then
+  if force == 0 and rpm > 0 then req = req - 1 end
+  if tpm > 0 then tok = tok - cost end
+end
+redis.call('HSET', KEYS[1], 'req', tostring(req), 'tok', tostring(tok), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], 120000)
+return math.ceil(wait)
+"""
+
+
+class RateLimitTimeout(TimeoutError):
+    """Nao houve vaga (balde ou concorrencia) dentro do prazo."""
+
+
+def bucket_key(scope: str) -> str:
+    return f"ai:llm_rate:{scope}"
+
+
+def is_throttled(exc: Exception) -> bool:
+    if isinstance(exc, errors.APIError):
+        code = getattr(exc, "code", None) or 0
+        return code == 429 or code == 503
+    return False
+
+
+def estimate_request_tokens(contents) -> int:
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    total = 0
+    for item in contents or []:
+        if isinstance(item, str):
+            total += estimate_tokens(item)
+            continue
+        for part in getattr(item, "parts", None) or []:
+            if getattr(part, "text", None):
+                total += estimate_tokens(part.text)
+    return max(1, total)
+
+
+class AIMDLimiter:
+    """Janela de concorrencia do processo para um escopo (additive increase, multiplicative decrease)."""
+
+    def __init__(self, initial: float | None = None, minimum: float | None = None, maximum: float | None = None):
+        self.minimum = minimum or LLM_AIMD_MIN
+        self.maximum = maximum or LLM_AIMD_MAX
+        self.limit = min(self.maximum, max(self.minimum, initial or LLM_AIMD_INITIAL))
+        self.in_flight = 0
+        # media de latencia por call site: prompts de tamanhos diferentes dividem a janela
+        self.latency_ewma: dict[str, float] = {}
+        self.stats = {"calls": 0, "throttled": 0, "spikes": 0, "timeouts": 0, "waited_ms": 0}
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, deadline: float):
+        started = time.monotonic()
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.stats["timeouts"] += 1
+                    raise RateLimitTimeout("sem vaga de concorrencia para chamar o modelo")
+                self._cond.wait(left)
+            self.in_flight += 1
+            self.stats["calls"] += 1
+            self.stats["waited_ms"] += round((time.monotonic() - started) * 1000)
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight >= max(1, int(self.limit)):
+                return False
+            self.in_flight += 1
+            self.stats["calls"] += 1
+            return True
+
+    async def aacquire(self, deadline: float):
+        # mesma janela do caminho sync; a corrotina espera sem prender o loop
+        started = time.monotonic()
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                with self._cond:
+                    self.stats["timeouts"] += 1
+                raise RateLimitTimeout("sem vaga de concorrencia para chamar o modelo")
+            await asyncio.sleep(0.02)
+        with self._cond:
+            self.stats["waited_ms"] += round((time.monotonic() - started) * 1000)
+
+    def release(self, latency_s: float | None = None, throttled: bool = False, call_site: str = "other"):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            ewma = self.latency_ewma.get(call_site)
+            spike = latency_s is not None and ewma is not None and latency_s > ewma * LLM_AIMD_SPIKE_FACTOR
+            if throttled or spike:
+                self.stats["throttled" if throttled else "spikes"] += 1
+                # um corte por janela: varias falhas da mesma rajada nao zeram o limite
+                if now - self._last_decrease >= LLM_AIMD_COOLDOWN_S:
+                    self.limit = max(self.minimum, self.limit * LLM_AIMD_BACKOFF)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if latency_s is not None and not throttled:
+                self.latency_ewma[call_site] = latency_s if ewma is None else 0.8 * ewma + 0.2 * latency_s
+            self._cond.notify_all()
+
+
+_limiters_lock = threading.Lock()
+_limiters: dict[str, AIMDLimiter] = {}
+
+
+def limiter(scope: str) -> AIMDLimiter:
+    with _limiters_lock:
+        if scope not in _limiters:
+            _limiters[scope] = AIMDLimiter()
+        return _limiters[scope]
+
+
+def limiter_stats() -> dict:
+    with _limiters_lock:
+        scopes = dict(_limiters)
+    return {
+        scope: {"limit": round(lim.limit, 2), "in_flight": lim.in_flight, **lim.stats}
+        for scope, lim in scopes.items()
+    }
+
+
+def reset_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def _bucket(scope: str, cost: int, force: bool = False) -> int:
+    rpm, tpm = LLM_LIMITS.get(scope, (0, 0))
+    if not rpm and not tpm:
+        return 0
+    r = get_redis()
+    return int(r.eval(_BUCKET_LUA, 1, bucket_key(scope), rpm, tpm, cost, 1 if force else 0))
+
+
+def wait_for_budget(scope: str, tokens: int, deadline: float):
+    """Espera saldo no balde global do escopo; Redis fora do ar nao bloqueia a chamada."""
+    while True:
+        try:
+            wait_ms = _bucket(scope, tokens)
+        except Exception as exc:
+            logger.warning("Rate limiter indisponivel (%s): seguindo sem o balde global", exc)
+            return
+        if wait_ms <= 0:
+            return
+        left = deadline - time.monotonic()
+        if left <= 0 or wait_ms / 1000 > left:
+            limiter(scope).stats["timeouts"] += 1
+            raise RateLimitTimeout(f"limite de {scope} por minuto: sem saldo dentro do prazo")
+        # jitter pequeno: quem acordou junto nao disputa o mesmo saldo
+        time.sleep(min(left, wait_ms / 1000 + random.uniform(0, 0.05)))
+
+
+def settle(scope: str, tokens: int):
+    """Acerta o balde de tokens com o uso real (diferenca para a estimativa)."""
+    if not tokens or not LLM_RATE_LIMIT_ENABLED:
+        return
+    try:
+        _bucket(scope, tokens, force=True)
+    except Exception as exc:
+        logger.warning("Falha ao acertar o balde de %s: %s", scope, exc)
+
+
+def _usage_tokens(resp) -> int | None:
+    usage = getattr(resp, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+
+def _acquire(scope: str, tokens: int, deadline: float) -> AIMDLimiter:
+    wait_for_budget(scope, tokens, deadline)
+    lim = limiter(scope)
+    lim.acquire(deadline)
+    return lim
+
+
+def guard(
+    scope: str, tokens: int, fn: Callable[[], T], retries: int | None = None, wait_s: float | None = None,
+    call_site: str = "other",
+) -> T:
+    """
+    Executa `fn` com vaga no balde global e na janela AIMD do escopo. Em 429/503
+    reduz a janela e tenta de novo (ate `retries`, com backoff e dentro do prazo).
+    `call_site` escolhe a media de latencia contra a qual o pico e medido.
+    """
+    if not LLM_RATE_LIMIT_ENABLED:
+        return fn()
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    deadline = time.monotonic() + (wait_s or LLM_RATE_WAIT_S)
+    attempt = 0
+    while True:
+        lim = _acquire(scope, tokens, deadline)
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as exc:
+            throttled = is_throttled(exc)
+            lim.release(None, throttled=throttled)
+            if not throttled or attempt >= retries:
+                raise
+            delay = random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt)))
+            if time.monotonic() + delay >= deadline:
+                raise
+            logger.warning("%s limitado pelo provedor (%s); nova tentativa em %.2fs", scope, exc, delay)
+            attempt += 1
+            time.sleep(delay)
+            continue
+        lim.release(time.monotonic() - started, call_site=call_site)
+        used = _usage_tokens(result)
+        if used:
+            settle(scope, used - tokens)
+        return result
+
+
+def guard_stream(scope: str, tokens: int, fn: Callable[[], Iterator[T]], wait_s: float | None = None) -> Iterator[T]:
+    """
+    Versao para streaming: a vaga da janela AIMD vale ate o primeiro chunk (o
+    provedor aceitou o pedido; 429/503 chegam antes dele). Prender a vaga pelo
+    stream inteiro faria uma conversa longa bloquear as outras. O balde global
+    (RPM/TPM) e debitado do mesmo jeito. Sem retry (os chunks ja entregues nao
+    voltam) e sem sinal de latencia (depende do tamanho).
+    """
+    if not LLM_RATE_LIMIT_ENABLED:
+        yield from fn()
+        return
+    lim = _acquire(scope, tokens, time.monotonic() + (wait_s or LLM_RATE_WAIT_S))
+    held = True
+    throttled = False
+    used = None
+    try:
+        for chunk in fn():
+            if held:
+                held = False
+                lim.release(None)
+            used = _usage_tokens(chunk) or used
+            yield chunk
+    except Exception as exc:
+        throttled = is_throttled(exc)
+        raise
+    finally:
+        if held:
+            lim.release(None, throttled=throttled)
+    if used:
+        settle(scope, used - tokens)
+
+
+async def _abucket(scope: str, cost: int, force: bool = False) -> int:
+    rpm, tpm = LLM_LIMITS.get(scope, (0, 0))
+    if not rpm and not tpm:
+        return 0
+    r = get_async_redis()
+    return int(await r.eval(_BUCKET_LUA, 1, bucket_key(scope), rpm, tpm, cost, 1 if force else 0))
+
+
+async def await_for_budget(scope: str, tokens: int, deadline: float):
+    while True:
+        try:
+            wait_ms = await _abucket(scope, tokens)
+        except Exception as exc:
+            logger.warning("Rate limiter indisponivel (%s): seguindo sem o balde global", exc)
+            return
+        if wait_ms <= 0:
+            return
+        left = deadline - time.monotonic()
+        if left <= 0 or wait_ms / 1000 > left:
+            limiter(scope).stats["timeouts"] += 1
+            raise RateLimitTimeout(f"limite de {scope} por minuto: sem saldo dentro do prazo")
+        await asyncio.sleep(min(left, wait_ms / 1000 + random.uniform(0, 0.05)))
+
+
+async def asettle(scope: str, tokens: int):
+    if not tokens or not LLM_RATE_LIMIT_ENABLED:
+        return
+    try:
+        await _abucket(scope, tokens, force=True)
+    except Exception as exc:
+        logger.warning("Falha ao acertar o balde de %s: %s", scope, exc)
+
+
+async def _aacquire(scope: str, tokens: int, deadline: float) -> AIMDLimiter:
+    await await_for_budget(scope, tokens, deadline)
+    lim = limiter(scope)
+    await lim.aacquire(deadline)
+    return lim
+
+
+async def aguard(
+    scope: str, tokens: int, fn: Callable[[], Awaitable[T]], retries: int | None = None, wait_s: float | None = None,
+    call_site: str = "other",
+) -> T:
+    """Versao async de `guard`: mesma janela e mesmo balde, espera com asyncio.sleep."""
+    if not LLM_RATE_LIMIT_ENABLED:
+        return await fn()
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    deadline = time.monotonic() + (wait_s or LLM_RATE_WAIT_S)
+    attempt = 0
+    while True:
+        lim = await _aacquire(scope, tokens, deadline)
+        started = time.monotonic()
+        try:
+            result = await fn()
+        except Exception as exc:
+            throttled = is_throttled(exc)
+            lim.release(None, throttled=throttled)
+            if not throttled or attempt >= retries:
+                raise
+            delay = random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt)))
+            if time.monotonic() + delay >= deadline:
+                raise
+            logger.warning("%s limitado pelo provedor (%s); nova tentativa em %.2fs", scope, exc, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        lim.release(time.monotonic() - started, call_site=call_site)
+        used = _usage_tokens(result)
+        if used:
+            await asettle(scope, used - tokens)
+        return result
+
+
+async def aguard_stream(
+    scope: str, tokens: int, fn: Callable[[], Awaitable[AsyncIterator[T]]], wait_s: float | None = None
+) -> AsyncIterator[T]:
+    """Versao async de `guard_stream` (fn e o generate_content_stream do client.aio)."""
+    if not LLM_RATE_LIMIT_ENABLED:
+        async for chunk in await fn():
+            yield chunk
+        return
+    lim = await _aacquire(scope, tokens, time.monotonic() + (wait_s or LLM_RATE_WAIT_S))
+    held = True
+    throttled = False
+    used = None
+    try:
+        async for chunk in await fn():
+            if held:
+                held = False
+                lim.release(None)
+            used = _usage_tokens(chunk) or used
+            yield chunk
+    except Exception as exc:
+        throttled = is_throttled(exc)
+        raise
+    finally:
+        if held:
+            lim.release(None, throttled=throttled)
+    if used:
+        await asettle(scope, used - tokens)
@@ -0,0 +1,54 @@
+import os
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+
+# Sem timeout um Redis que parou de responder prende a thread/corrotina para
+# sempre. O de leitura tem de passar do maior bloqueio no servidor (XREAD do
+# replay, pubsub dos jobs): blocking_wait limita esses bloqueios a ele.
+REDIS_SOCKET_TIMEOUT_S = float(os.getenv("REDIS_SOCKET_TIMEOUT_S", "30"))
+REDIS_CONNECT_TIMEOUT_S = float(os.getenv("REDIS_CONNECT_TIMEOUT_S", "5"))
+# folga entre o fim do bloqueio e o timeout do socket
+_BLOCK_MARGIN_S = 1.0
+
+_lock = threading.Lock()
+_client: redis.Redis | None = None
+# o pool async fica preso ao event loop que o criou: um cliente por loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis]" = weakref.WeakKeyDictionary()
+
+
+def _options() -> dict:
+    return {
+        "decode_responses": True,
+        "health_check_interval": 30,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT_S,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT_S,
+    }
+
+
+def blocking_wait(seconds: float) -> float:
+    """Espera de uma leitura bloqueante, sempre abaixo do timeout de leitura do socket."""
+    return min(seconds, REDIS_SOCKET_TIMEOUT_S - min(_BLOCK_MARGIN_S, REDIS_SOCKET_TIMEOUT_S / 2))
+
+
+def get_redis() -> redis.Redis:
+    """Cliente Redis compartilhado pelo processo (o pool de conexoes e thread-safe)."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = redis.Redis.from_url(settings.REDIS_URL, **_options())
+    return _client
+
+
+def get_async_redis() -> aioredis.Redis:
+    """Cliente redis.asyncio do event loop atual (views ASGI)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = aioredis.Redis.from_url(settings.REDIS_URL, **_options())
+    return client
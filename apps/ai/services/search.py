@@ -1,16 +1,156 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import close_old_connections, connection, transaction
 from django.db.models import F
 from pgvector.django import CosineDistance
-from apps.ai.models import Chunk
+from apps.ai.models import Chunk, Document
 from apps.ai.services.embedding import embed_one
 
+logger = logging.getLogger(__name__)
 
-def semantic_search(query: str, k: int = 5):
-    qvec = embed_one(query)
-    qs = (Chunk.objects
-          .exclude(embedding=None)
+# Filtros (dono/documentos/plano) sao aplicados depois da varredura do HNSW.
+# Com pgvector >= 0.8 a varredura iterativa continua buscando vizinhos ate
+# preencher o top-k, em vez de devolver poucos (ou zero) resultados.
+HNSW_EF_SEARCH = int(os.getenv("SEARCH_HNSW_EF_SEARCH", "100"))
+HNSW_ITERATIVE_SCAN = os.getenv("SEARCH_HNSW_ITERATIVE_SCAN", "relaxed_order")  # off|strict_order|relaxed_order
+HNSW_MAX_SCAN_TUPLES = int(os.getenv("SEARCH_HNSW_MAX_SCAN_TUPLES", "20000"))
+
+# Busca hibrida: config do full-text, constante do RRF, tamanho do pool de
+# candidatos por ranking e tempo maximo esperando o embedding da consulta.
+TS_CONFIG = "portuguese"
+RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+HYBRID_CANDIDATES = int(os.getenv("SEARCH_HYBRID_CANDIDATES", "4"))
+EMBED_TIMEOUT_S = float(os.getenv("SEARCH_EMBED_TIMEOUT_S", "2.0"))
+
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+
+_embed_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_EMBED_WORKERS", "4")), thread_name_prefix="search-embed")
+
+
+def _plan_id(plan):
+    return getattr(plan, "pk", plan)
+
+
+def scoped_chunks(owner=None, document_ids=None, plan=None, with_embedding: bool = True):
+    """
+    Chunks restritos ao escopo pedido. Os filtros viram um subquery sobre
+    Document para o planner manter o ORDER BY ... LIMIT no indice.
+    """
+    qs = Chunk.objects.exclude(embedding=None) if with_embedding else Chunk.objects.all()
+    if owner is None and document_ids is None and plan is None:
+        return qs
+    docs = Document.objects.all()
+    if owner is not None:
+        docs = docs.filter(owner=owner)
+    if document_ids is not None:
+        docs = docs.filter(id__in=list(document_ids))
+    if plan is not None:
+        docs = docs.filter(study_plans=_plan_id(plan))
+    return qs.filter(document_id__in=docs.values("id"))
+
+
+def index_lexical(document_id) -> int:
+    """Preenche o tsvector (pt-BR) dos chunks recem-gravados de um documento."""
+    return (Chunk.objects
+            .filter(document_id=document_id, search_vector=None)
+            .update(search_vector=SearchVector("text", config=TS_CONFIG)))
+
+
+def _configure_hnsw_scan():
+    with connection.cursor() as cur:
+        cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", [str(HNSW_EF_SEARCH)])
+        if HNSW_ITERATIVE_SCAN != "off":
+            cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", [HNSW_ITERATIVE_SCAN])
+            cur.execute("SELECT set_config('hnsw.max_scan_tuples', %s, true)", [str(HNSW_MAX_SCAN_TUPLES)])
+
+
+def _row(c, **extra):
+    row = {"chunk_id": c.id, "doc_id": str(c.document_id), "ord": c.order, "text": c.text}
+    row.update(extra)
+    return row
+
+
+def vector_search(qvec, k: int = 5, owner=None, document_ids=None, plan=None):
+    filtered = not (owner is None and document_ids is None and plan is None)
+    qs = (scoped_chunks(owner=owner, document_ids=document_ids, plan=plan)
           .annotate(distance=CosineDistance(F("embedding"), qvec))
           .order_by("distance")
           .only("id", "text", "document", "order")
           .defer("embedding"))[:k]
-    return [{"chunk_id": c.id, "doc_id": str(c.document_id), "ord": c.order,
-             "text": c.text, "distance": float(c.distance)} for c in qs]
+    if filtered:
+        # set_config(..., true) vale so para a transacao corrente
+        with transaction.atomic():
+            _configure_hnsw_scan()
+            rows = list(qs)
+        # relaxed_order pode devolver vizinhos levemente fora de ordem
+        rows.sort(key=lambda c: c.distance)
+    else:
+        rows = list(qs)
+    return [_row(c, distance=float(c.distance)) for c in rows]
+
+
+def lexical_search(query: str, k: int = 5, owner=None, document_ids=None, plan=None):
+    """Full-text em portugues (websearch_to_tsquery) sobre o indice GIN."""
+    sq = SearchQuery(query, config=TS_CONFIG, search_type="websearch")
+    qs = (scoped_chunks(owner=owner, document_ids=document_ids, plan=plan, with_embedding=False)
+          .filter(search_vector=sq)
+          .annotate(rank=SearchRank(F("search_vector"), sq))
+          .order_by("-rank", "id")
+          .only("id", "text", "document", "order"))[:k]
+    return [_row(c, rank=float(c.rank)) for c in qs]
+
+
+def reciprocal_rank_fusion(rankings: list[list[dict]], k: int = RRF_K, key: str = "chunk_id") -> list[dict]:
+    """
+    Funde rankings com RRF: score(d) = sum 1 / (k + posicao_d). Linhas que
+    aparecem em mais de um ranking acumulam score e campos (distance/rank).
+    """
+    merged: dict = {}
+    for ranking in rankings:
+        for pos, row in enumerate(ranking, start=1):
+            entry = merged.setdefault(row[key], {**row, "score": 0.0})
+            entry.update({f: v for f, v in row.items() if f not in entry})
+            entry["score"] += 1.0 / (k + pos)
+    return sorted(merged.values(), key=lambda r: r["score"], reverse=True)
+
+
+def _embed_query(query: str):
+    try:
+        return embed_one(query)
+    finally:
+        close_old_connections()
+
+
+def hybrid_search(query: str, k: int = 5, owner=None, document_ids=None, plan=None):
+    """
+    Roda o full-text enquanto o embedding da consulta esta em voo e funde os
+    dois rankings com RRF. Se o embedding falhar ou passar de EMBED_TIMEOUT_S,
+    devolve so o ranking lexical.
+    """
+    pool = max(k, k * HYBRID_CANDIDATES)
+    scope = {"owner": owner, "document_ids": document_ids, "plan": plan}
+    future = _embed_pool.submit(_embed_query, query)
+    lexical = lexical_search(query, pool, **scope)
+    try:
+        qvec = future.result(timeout=EMBED_TIMEOUT_S)
+    except FutureTimeout:
+        logger.warning("Embedding da consulta excedeu %.1fs; busca so lexical", EMBED_TIMEOUT_S)
+        return [{**r, "score": r["rank"]} for r in lexical[:k]]
+    except Exception:
+        logger.exception("Falha ao embedar consulta; busca so lexical")
+        return [{**r, "score": r["rank"]} for r in lexical[:k]]
+    vector = vector_search(qvec, pool, **scope)
+    return reciprocal_rank_fusion([vector, lexical])[:k]
+
+
+def semantic_search(query: str, k: int = 5, owner=None, document_ids=None, plan=None, mode: str = "vector"):
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode invalido: {mode}")
+    if mode == "lexical":
+        return lexical_search(query, k, owner=owner, document_ids=document_ids, plan=plan)
+    if mode == "hybrid":
+        return hybrid_search(query, k, owner=owner, document_ids=document_ids, plan=plan)
+    qvec = embed_one(query)
+    return vector_search(qvec, k, owner=owner, document_ids=document_ids, plan=plan)
@@ -0,0 +1,289 @@
+import os
+import json
+import queue
+import asyncio
+import logging
+import threading
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable, Iterator
+
+from django.db import close_old_connections
+
+from apps.ai.services.redis_client import blocking_wait, get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Cada sessao SSE do chat e gravada num Redis Stream limitado; quem reconecta
+# com Last-Event-ID recebe so o que perdeu, sem rodar o Gemini de novo.
+SSE_REPLAY_MAXLEN = int(os.getenv("SSE_REPLAY_MAXLEN", "2000"))
+SSE_REPLAY_TTL_S = int(os.getenv("SSE_REPLAY_TTL_S", "900"))
+SSE_REPLAY_BLOCK_MS = int(os.getenv("SSE_REPLAY_BLOCK_MS", "15000"))
+SSE_REPLAY_MAX_IDLE = 4  # blocos sem evento antes de desistir de uma sessao parada
+
+_DONE = "__done__"
+
+Event = tuple[int, str, dict[str, Any]]
+
+
+def stream_key(session_id: str) -> str:
+    return f"ai:sse:chat:{session_id}"
+
+
+def _owner_key(session_id: str) -> str:
+    return f"ai:sse:chat:{session_id}:owner"
+
+
+def _entry_id(index: int) -> str:
+    # ids explicitos 0-<n>: o Last-Event-ID do navegador vira a posicao no stream
+    return f"0-{index}"
+
+
+def _decode(entry_id: str, fields: dict) -> Event:
+    return int(entry_id.split("-", 1)[1]), fields["event"], json.loads(fields["data"])
+
+
+def _as_event(index: int, packet) -> Event:
+    if not isinstance(packet, dict):
+        packet = {"event": "message", "data": {"raw": packet}}
+    return index, packet.get("event") or "message", packet.get("data", {})
+
+
+def _open_pipe(pipe, session_id: str, owner_id):
+    # uma sessao de chat reaproveita o id a cada turno: so o turno atual e reproduzivel
+    pipe.delete(stream_key(session_id))
+    pipe.set(_owner_key(session_id), str(owner_id), ex=SSE_REPLAY_TTL_S)
+
+
+def _add_pipe(pipe, session_id: str, index: int, event: str, data: dict):
+    key = stream_key(session_id)
+    pipe.xadd(key, {"event": event, "data": json.dumps(data, ensure_ascii=False, default=str)},
+              id=_entry_id(index), maxlen=SSE_REPLAY_MAXLEN, approximate=True)
+    pipe.expire(key, SSE_REPLAY_TTL_S)
+    pipe.expire(_owner_key(session_id), SSE_REPLAY_TTL_S)
+
+
+class SessionBuffer:
+    """Grava os eventos de uma sessao no stream. Falha de Redis so desliga o buffer."""
+
+    def __init__(self, session_id: str, owner_id):
+        self.session_id = session_id
+        self.key = stream_key(session_id)
+        self.enabled = True
+        self._call(lambda pipe: _open_pipe(pipe, session_id, owner_id))
+
+    def _call(self, build):
+        if not self.enabled:
+            return
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            build(pipe)
+            pipe.execute()
+        except Exception as exc:
+            self.enabled = False
+            logger.warning("Buffer SSE da sessao %s desativado: %s", self.session_id, exc)
+
+    def append(self, index: int, event: str, data: dict):
+        self._call(lambda pipe: _add_pipe(pipe, self.session_id, index, event, data))
+
+    def finish(self, index: int):
+        # marcador de fim: o replay para aqui em vez de esperar eventos que nao virao
+        self._call(lambda pipe: _add_pipe(pipe, self.session_id, index, _DONE, {}))
+
+
+class AsyncSessionBuffer:
+    """Mesmo buffer com redis.asyncio, para o produtor que roda no event loop."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.key = stream_key(session_id)
+        self.enabled = True
+
+    async def _call(self, build):
+        if not self.enabled:
+            return
+        try:
+            pipe = get_async_redis().pipeline(transaction=False)
+            build(pipe)
+            await pipe.execute()
+        except Exception as exc:
+            self.enabled = False
+            logger.warning("Buffer SSE da sessao %s desativado: %s", self.session_id, exc)
+
+    async def open(self, owner_id):
+        await self._call(lambda pipe: _open_pipe(pipe, self.session_id, owner_id))
+
+    async def append(self, index: int, event: str, data: dict):
+        await self._call(lambda pipe: _add_pipe(pipe, self.session_id, index, event, data))
+
+    async def finish(self, index: int):
+        await self._call(lambda pipe: _add_pipe(pipe, self.session_id, index, _DONE, {}))
+
+
+def session_owner(session_id: str) -> str | None:
+    try:
+        return get_redis().get(_owner_key(session_id))
+    except Exception as exc:
+        logger.warning("Redis indisponivel ao retomar a sessao %s: %s", session_id, exc)
+        return None
+
+
+async def asession_owner(session_id: str) -> str | None:
+    try:
+        return await get_async_redis().get(_owner_key(session_id))
+    except Exception as exc:
+        logger.warning("Redis indisponivel ao retomar a sessao %s: %s", session_id, exc)
+        return None
+
+
+def _start_producer(session_id: str, owner_id, packets: Iterable[dict], deliver: Callable[[Event | None], None]):
+    """
+    Roda `packets` (o gerador do chat) numa thread produtora que grava cada
+    evento no stream e o entrega via `deliver` para a conexao atual. Se o
+    cliente cair, a thread continua ate o fim e o restante fica no replay.
+    """
+    buffer = SessionBuffer(session_id, owner_id)
+
+    def _emit(item):
+        nonlocal deliver
+        if item is not None:
+            buffer.append(*item)
+        if deliver is None:
+            return
+        try:
+            deliver(item)
+        except Exception:  # loop da conexao async ja fechado: segue so gravando
+            deliver = None
+
+    def _run():
+        index = 0
+        try:
+            for packet in packets:
+                index += 1
+                _emit(_as_event(index, packet))
+        except Exception as exc:
+            logger.exception("Falha no chat da sessao %s", session_id)
+            index += 1
+            _emit((index, "error", {"session_id": session_id, "message": str(exc)}))
+        finally:
+            buffer.finish(index + 1)
+            _emit(None)
+            close_old_connections()  # a thread abriu a propria conexao (tool calls)
+
+    threading.Thread(target=_run, name=f"sse-{session_id}", daemon=True).start()
+
+
+def produce(session_id: str, owner_id, packets: Iterable[dict]) -> Iterator[Event]:
+    local: queue.Queue = queue.Queue()
+    _start_producer(session_id, owner_id, packets, local.put)
+    while (item := local.get()) is not None:
+        yield item
+
+
+# referencia forte das tasks produtoras: o turno segue (e vai para o replay) se a conexao cair
+_producers: set[asyncio.Task] = set()
+
+
+async def aproduce(session_id: str, owner_id, packets: AsyncIterable[dict]) -> AsyncIterator[Event]:
+    """
+    Versao async de `produce`: `packets` (achat_stream) roda numa task do event
+    loop, grava cada evento no stream com redis.asyncio e o entrega a conexao
+    por um asyncio.Queue. Nenhuma thread fica presa ao stream.
+    """
+    local: asyncio.Queue = asyncio.Queue()
+    buffer = AsyncSessionBuffer(session_id)
+
+    async def _run():
+        index = 0
+        await buffer.open(owner_id)
+        try:
+            async for packet in packets:
+                index += 1
+                item = _as_event(index, packet)
+                await buffer.append(*item)
+                local.put_nowait(item)
+        except Exception as exc:
+            logger.exception("Falha no chat da sessao %s", session_id)
+            index += 1
+            item = (index, "error", {"session_id": session_id, "message": str(exc)})
+            await buffer.append(*item)
+            local.put_nowait(item)
+        finally:
+            await buffer.finish(index + 1)
+            local.put_nowait(None)
+
+    task = asyncio.create_task(_run())
+    _producers.add(task)
+    task.add_done_callback(_producers.discard)
+    while (item := await local.get()) is not None:
+        yield item
+
+
+def _block_ms(block_ms: int | None) -> int:
+    # block=0 no XREAD esperaria para sempre; acima do timeout do socket a leitura cairia
+    return max(1, round(blocking_wait((block_ms or SSE_REPLAY_BLOCK_MS) / 1000) * 1000))
+
+
+def replay(session_id: str, last_event_id: int = 0, block_ms: int | None = None) -> Iterator[Event | None]:
+    """
+    Eventos com id > `last_event_id`: primeiro o que ja esta no stream, depois
+    (se a sessao ainda esta gerando) acompanha com XREAD ate o marcador de fim.
+    Devolve None a cada bloqueio sem evento, para a view mandar heartbeat.
+    """
+    block_ms = _block_ms(block_ms)
+    r = get_redis()
+    key = stream_key(session_id)
+    cursor = _entry_id(last_event_id)
+    first = True
+    idle = 0
+    while idle < SSE_REPLAY_MAX_IDLE:
+        if first:
+            entries = r.xrange(key, min=_entry_id(last_event_id + 1))
+        else:
+            found = r.xread({key: cursor}, block=block_ms)
+            entries = found[0][1] if found else []
+        if not entries:
+            if not first:
+                idle += 1
+                yield None
+            first = False
+            continue
+        if first and _decode(*entries[0])[0] > last_event_id + 1:
+            # parte da sessao ja saiu do stream (MAXLEN): o cliente sabe que ha lacuna
+            yield last_event_id, "meta", {"type": "replay_gap", "session_id": session_id}
+        first, idle = False, 0
+        for entry_id, fields in entries:
+            index, event, data = _decode(entry_id, fields)
+            if event == _DONE:
+                return
+            yield index, event, data
+        cursor = entries[-1][0]
+
+
+async def areplay(session_id: str, last_event_id: int = 0, block_ms: int | None = None) -> AsyncIterator[Event | None]:
+    """Mesmo contrato de `replay`, com redis.asyncio (XREAD bloqueia so a corrotina)."""
+    block_ms = _block_ms(block_ms)
+    r = get_async_redis()
+    key = stream_key(session_id)
+    cursor = _entry_id(last_event_id)
+    first = True
+    idle = 0
+    while idle < SSE_REPLAY_MAX_IDLE:
+        if first:
+            entries = await r.xrange(key, min=_entry_id(last_event_id + 1))
+        else:
+            found = await r.xread({key: cursor}, block=block_ms)
+            entries = found[0][1] if found else []
+        if not entries:
+            if not first:
+                idle += 1
+                yield None
+            first = False
+            continue
+        if first and _decode(*entries[0])[0] > last_event_id + 1:
+            yield last_event_id, "meta", {"type": "replay_gap", "session_id": session_id}
+        first, idle = False, 0
+        for entry_id, fields in entries:
+            index, event, data = _decode(entry_id, fields)
+            if event == _DONE:
+                return
+            yield index, event, data
+        cursor = entries[-1][0]
@@ -366,7 +366,8 @@ def _format_documents(docs) -> str:
     if not docs:
         return "Nenhum material proprio enviado pelo usuario."
     lines = []
-    for d in docs:
+    # ordem estavel: o prompt (e a chave do cache de respostas) nao depende da ordem do queryset
+    for d in sorted(docs, key=lambda d: str(d.id)):
         lines.append(f"- {d.title} ({d.id})")
     return "\n".join(lines)
 
@@ -384,7 +385,9 @@ def _load_json_response(resp) -> dict:
         raise
 
 
-def generate_plan_payload(user_context: StudyContext, documents, goal_override: str | None = None) -> dict:
+def generate_plan_payload(
+    user_context: StudyContext, documents, goal_override: str | None = None, force_regenerate: bool = False
+) -> dict:
     if LEGACY_MODE:
         print(f"USANDO LEGACY MODE PARA GERAÇÃO DE PLANO")
         return legacy.generate_plan_payload(user_context, documents, goal_override)
@@ -406,11 +409,12 @@ def generate_plan_payload(user_context: StudyContext, documents, goal_override:
         "Respeite o tempo semanal e niveis declarados.\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=PLAN_RESPONSE_SCHEMA)
+    # prompt determinado pelo contexto e pelos documentos: mesmo pedido, mesma resposta do cache
+    resp = generate(contents=contents, schema=PLAN_RESPONSE_SCHEMA, cache=True, refresh=force_regenerate, call_site="outline")
     return _load_json_response(resp)
 
 
-def generate_tasks_payload(plan: StudyPlan, section_id: str, documents) -> dict:
+def generate_tasks_payload(plan: StudyPlan, section_id: str, documents, force_regenerate: bool = False) -> dict:
     if LEGACY_MODE:
         return legacy.generate_tasks_payload(plan, section_id, documents)
     existing_sections = (plan.metadata or {}).get("schema", {}).get("sections", [])
@@ -429,7 +433,7 @@ def generate_tasks_payload(plan: StudyPlan, section_id: str, documents) -> dict:
         f"Materiais do usuario (RAG):\n{_format_documents(documents)}\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=TASKS_ONLY_SCHEMA)
+    resp = generate(contents=contents, schema=TASKS_ONLY_SCHEMA, cache=True, refresh=force_regenerate, call_site="section")
     return _load_json_response(resp)
 
 
@@ -448,7 +452,7 @@ def list_day_tasks(day: StudyDay) -> list[dict]:
     return out
 
 
-def generate_day_payload(plan: StudyPlan, day: StudyDay, documents) -> dict:
+def generate_day_payload(plan: StudyPlan, day: StudyDay, documents, force_regenerate: bool = False) -> dict:
     if LEGACY_MODE:
         return legacy.generate_day_payload(plan, day, documents)
     ctx = plan.user_context
@@ -482,7 +486,7 @@ def generate_day_payload(plan: StudyPlan, day: StudyDay, documents) -> dict:
         f"Tarefas ja criadas na secao: {list_plan_tasks(plan, section_id)}\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=DAY_RESPONSE_SCHEMA)
+    resp = generate(contents=contents, schema=DAY_RESPONSE_SCHEMA, cache=True, refresh=force_regenerate, call_site="day")
     return _load_json_response(resp)
 
 
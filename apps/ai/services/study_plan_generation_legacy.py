@@ -352,7 +352,7 @@ def generate_plan_payload(user_context: StudyContext, documents, goal_override:
         "Respeite o tempo semanal e niveis declarados.\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=PLAN_RESPONSE_SCHEMA)
+    resp = generate(contents=contents, schema=PLAN_RESPONSE_SCHEMA, call_site="outline")
     return _load_json_response(resp)
 
 
@@ -368,7 +368,7 @@ def generate_tasks_payload(plan: StudyPlan, section_id: str, documents) -> dict:
         f"Materiais do usuario (RAG):\n{_format_documents(documents)}\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=TASKS_ONLY_SCHEMA)
+    resp = generate(contents=contents, schema=TASKS_ONLY_SCHEMA, call_site="section")
     return _load_json_response(resp)
 
 
@@ -410,7 +410,7 @@ def generate_day_payload(plan: StudyPlan, day: StudyDay, documents) -> dict:
         f"Tarefas ja criadas na secao: {list_plan_tasks(plan, section_id)}\n"
     )
     contents = [types.Content(role="user", parts=[types.Part(text=prompt)])]
-    resp = generate(contents=contents, schema=DAY_RESPONSE_SCHEMA)
+    resp = generate(contents=contents, schema=DAY_RESPONSE_SCHEMA, call_site="day")
     return _load_json_response(resp)
 
 
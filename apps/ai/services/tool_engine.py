@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from django.db import close_old_connections
+from google.genai import types
+
+from apps.ai.tools.commit_user_context import TOOL_RESOURCES, handle_tool_call
+
+logger = logging.getLogger(__name__)
+
+# Limites do loop de tools por turno: rodadas modelo->tools e tempo total.
+TOOL_MAX_ROUNDS = int(os.getenv("AI_TOOL_MAX_ROUNDS", "4"))
+TOOL_LOOP_BUDGET_S = float(os.getenv("AI_TOOL_LOOP_BUDGET_S", "60"))
+TOOL_MAX_WORKERS = int(os.getenv("AI_TOOL_MAX_WORKERS", "4"))
+
+# Recursos gravados pelas tools reais (commit no banco): rodam inline, sem prazo.
+# Uma thread do pool que estoura o tempo continua e commita depois, e o modelo
+# ouviria "timeout" para uma escrita que aconteceu; o prazo fica so para o resto.
+INLINE_RESOURCES = frozenset(TOOL_RESOURCES.values())
+
+
+class ToolLoopBudget:
+    """Conta rodadas e o tempo do loop de tools de um turno."""
+
+    def __init__(self, max_rounds: int | None = None, budget_s: float | None = None):
+        self.max_rounds = max_rounds or TOOL_MAX_ROUNDS
+        self.budget_s = budget_s or TOOL_LOOP_BUDGET_S
+        self.started = time.monotonic()
+        self.rounds = 0
+
+    def elapsed_ms(self) -> int:
+        return round((time.monotonic() - self.started) * 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.budget_s - (time.monotonic() - self.started))
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def exhausted(self) -> bool:
+        return self.rounds >= self.max_rounds
+
+
+def _call_key(call: types.FunctionCall) -> tuple[str, str]:
+    # tools equivalentes (mesmo recurso) com os mesmos args sao a mesma operacao
+    resource = TOOL_RESOURCES.get(call.name, call.name)
+    return resource, json.dumps(dict(call.args or {}), sort_keys=True, default=str)
+
+
+def _run(user, call: types.FunctionCall) -> tuple[dict | None, Exception | None, int]:
+    started = time.monotonic()
+    try:
+        result, error = handle_tool_call(user, call.name, dict(call.args or {})), None
+    except Exception as exc:
+        result, error = None, exc
+    return result, error, round((time.monotonic() - started) * 1000)
+
+
+def _run_group(user, calls: list[types.FunctionCall], threaded: bool) -> list[tuple[dict | None, Exception | None, int]]:
+    # chamadas que tocam o mesmo recurso rodam em sequencia, na ordem do modelo
+    try:
+        return [_run(user, call) for call in calls]
+    finally:
+        if threaded:
+            close_old_connections()  # conexao aberta por esta thread do pool
+
+
+def run_tool_calls(user, calls: list[types.FunctionCall], timeout: float | None = None) -> list[tuple]:
+    """
+    Executa as function_calls de uma rodada e devolve (call, result, error, ms)
+    na ordem original. Chamadas repetidas (mesmo recurso e args) rodam uma vez.
+    Recursos de INLINE_RESOURCES rodam na thread do turno ate o fim; os demais
+    rodam em paralelo no pool, com `timeout` para a rodada toda.
+    """
+    unique: dict[tuple[str, str], types.FunctionCall] = {}
+    for call in calls:
+        unique.setdefault(_call_key(call), call)
+    groups: dict[str, list[tuple[str, str]]] = {}
+    for key in unique:
+        groups.setdefault(key[0], []).append(key)
+    inline = {resource: keys for resource, keys in groups.items() if resource in INLINE_RESOURCES}
+    pooled = {resource: keys for resource, keys in groups.items() if resource not in INLINE_RESOURCES}
+    if timeout is None and len(groups) == 1:
+        # sem prazo nao ha o que vigiar: roda na thread do turno
+        inline, pooled = groups, {}
+
+    outcomes: dict[tuple[str, str], tuple] = {}
+    pool = None
+    if pooled:
+        pool = ThreadPoolExecutor(max_workers=max(1, min(TOOL_MAX_WORKERS, len(pooled))), thread_name_prefix="tool")
+    try:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        futures = {
+            resource: pool.submit(_run_group, user, [unique[k] for k in keys], True)
+            for resource, keys in pooled.items()
+        }
+        for keys in inline.values():
+            outcomes.update(zip(keys, _run_group(user, [unique[k] for k in keys], threaded=False)))
+        for resource, future in futures.items():
+            keys = pooled[resource]
+            try:
+                left = None if deadline is None else max(0.0, deadline - time.monotonic())
+                outcomes.update(zip(keys, future.result(timeout=left)))
+            except FutureTimeout:
+                logger.warning("Tool(s) %s excederam o tempo da rodada", [unique[k].name for k in keys])
+                err = TimeoutError("tool call excedeu o tempo limite")
+                outcomes.update((k, (None, err, round((timeout or 0) * 1000))) for k in keys)
+    finally:
+        if pool is not None:
+            # nao espera threads presas: o turno segue e a thread termina sozinha
+            pool.shutdown(wait=False, cancel_futures=True)
+    return [(call, *outcomes[_call_key(call)]) for call in calls]
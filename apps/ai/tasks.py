@@ -1,11 +1,30 @@
+import os
 import logging
 
-from celery import shared_task
-from django.db import transaction
+from celery import chord, group, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.db import OperationalError, transaction
 
 from apps.accounts.models import StudyPlan, StudyContext
-from apps.ai.models import Document, Chunk
-from apps.ai.services.embedding import embed_batch
+from apps.ai.models import Document
+from apps.ai.services.embedding import cache_stats, is_retryable
+from apps.ai.services.chunking import iter_chunks
+from apps.ai.services.chat import stream_plan
+from apps.ai.services.chat_sessions import compact_history
+from apps.ai.services import llm_cache
+from apps.ai.services.jobs import fail_job, finish_job, note_retry, publish_event, start_job, update_progress
+from apps.ai.services.extraction import extract_blocks, sniff_mime
+from apps.ai.services.ingest import (
+    FANOUT_MIN_BYTES,
+    chunk_ranges,
+    embed_chunk_range,
+    ingest_chunks,
+    record_progress,
+    reingest_chunks,
+    stage_chunks,
+)
+from apps.ai.services.plan_outline import ensure_plan_outline
+from apps.ai.services.search import index_lexical
 from apps.ai.services.study_plan_generation import (
     generate_plan_payload,
     generate_day_payload,
@@ -17,18 +36,7 @@ from apps.ai.services.study_plan_generation import (
 
 logger = logging.getLogger(__name__)
 
-
-def _simple_chunk(text: str, max_chars: int = 1200):
-    parts, buf, count = [], [], 0
-    for line in text.splitlines():
-        if count + len(line) > max_chars:
-            parts.append("\n".join(buf))
-            buf, count = [], 0
-        buf.append(line)
-        count += len(line)
-    if buf:
-        parts.append("\n".join(buf))
-    return parts
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "3"))
 
 
 def _set_plan_status(plan: StudyPlan, status: str, error: str | None = None, job_id: str | None = None):
@@ -52,75 +60,174 @@ def _set_day_status(day, status: str, error: str | None = None, job_id: str | No
 
 
 @shared_task(name="ai.generate_study_plan", bind=True)
-def generate_study_plan_task(self, job_id: str, plan_id: str, study_context_id: str, goal_override: str | None, title: str | None):
+def generate_study_plan_task(
+    self,
+    job_id: str,
+    plan_id: str,
+    study_context_id: str,
+    goal_override: str | None,
+    title: str | None,
+    force_regenerate: bool = False,
+):
     plan = StudyPlan.objects.filter(id=plan_id).first()
     ctx = StudyContext.objects.filter(id=study_context_id).first()
     if not plan or not ctx:
+        fail_job(job_id, "Plan or StudyContext not found")
         return {"status": "failed", "message": "Plan or StudyContext not found"}
+    start_job(job_id)
     _set_plan_status(plan, "running", job_id=job_id, error=None)
     try:
         documents = Document.objects.filter(owner=ctx.user)
-        payload = generate_plan_payload(user_context=ctx, documents=documents, goal_override=goal_override)
+        with llm_cache.track() as cache_usage:
+            payload = generate_plan_payload(
+                user_context=ctx, documents=documents, goal_override=goal_override, force_regenerate=force_regenerate
+            )
         with transaction.atomic():
             persist_plan_from_payload(user_context=ctx, payload=payload, title=title, documents=documents, plan=plan)
         _set_plan_status(plan, "succeeded")
-        return {"status": "succeeded", "plan_id": str(plan.id)}
+        result = {"status": "succeeded", "plan_id": str(plan.id), "llm_cache": cache_usage}
+        finish_job(job_id, result)
+        return result
     except Exception as exc:
         logger.exception("Erro ao gerar plano de estudo (job %s)", job_id)
         _set_plan_status(plan, "failed", error=str(exc))
+        fail_job(job_id, str(exc))
         return {"status": "failed", "message": str(exc)}
 
 
+@shared_task(name="ai.generate_chat_plan", bind=True)
+def generate_chat_plan_task(self, job_id: str, study_context_id: str, history: list[dict] | None = None):
+    """
+    Pos-commit do chat: outline do plano e, com `history`, o plano inicial em
+    texto. Cada pedaco vira um evento "token" do job; o texto completo fica no
+    result para quem assinar o stream depois.
+    """
+    ctx = StudyContext.objects.filter(id=study_context_id).first()
+    if not ctx:
+        fail_job(job_id, "StudyContext not found")
+        return {"status": "failed", "message": "StudyContext not found"}
+    start_job(job_id)
+    try:
+        plan = ensure_plan_outline(ctx)
+        pieces: list[str] = []
+        for piece in stream_plan(history) if history else ():
+            pieces.append(piece)
+            publish_event(job_id, "token", {"index": len(pieces), "stage": "study_plan", "text": piece})
+        result = {
+            "status": "succeeded",
+            "study_context_id": str(ctx.id),
+            "plan_id": str(plan.id),
+            "tokens_streamed": len(pieces),
+            "plan_text": "".join(pieces),
+        }
+        finish_job(job_id, result)
+        return result
+    except Exception as exc:
+        logger.exception("Erro ao gerar plano do chat (job %s)", job_id)
+        fail_job(job_id, str(exc))
+        return {"status": "failed", "message": str(exc)}
+
+
+@shared_task(name="ai.compact_chat_history")
+def compact_chat_history_task(session_id: str):
+    """Resumo dos turnos antigos de uma sessao de chat, fora do caminho do proximo turno."""
+    return {"compacted": compact_history(session_id)}
+
+
 @shared_task(name="ai.generate_study_day", bind=True)
-def generate_study_day_task(self, job_id: str, plan_id: str, day_id: str, reset_existing: bool = True):
+def generate_study_day_task(
+    self, job_id: str, plan_id: str, day_id: str, reset_existing: bool = True, force_regenerate: bool = False
+):
     plan = StudyPlan.objects.filter(id=plan_id).first()
     day = plan.days.filter(id=day_id).first() if plan else None
     if not plan or not day:
+        fail_job(job_id, "Plan or day not found")
         return {"status": "failed", "message": "Plan or day not found"}
+    start_job(job_id)
     _set_plan_status(plan, "running", job_id=job_id, error=None)
     _set_day_status(day, "running", job_id=job_id, error=None)
     try:
         documents = plan.rag_documents.all()
         if not documents:
             documents = Document.objects.filter(owner=plan.user_context.user)
-        payload = generate_day_payload(plan, day, documents)
+        with llm_cache.track() as cache_usage:
+            payload = generate_day_payload(plan, day, documents, force_regenerate=force_regenerate)
         with transaction.atomic():
             created = persist_tasks_for_day(day, payload, reset_existing=reset_existing)
         _set_day_status(day, "succeeded", job_id=job_id, error="")
         _set_plan_status(plan, "succeeded")
-        return {"status": "succeeded", "day_id": str(day.id), "tasks": [str(t.id) for t in created]}
+        result = {
+            "status": "succeeded",
+            "day_id": str(day.id),
+            "tasks": [str(t.id) for t in created],
+            "llm_cache": cache_usage,
+        }
+        finish_job(job_id, result)
+        return result
     except Exception as exc:
         logger.exception("Erro ao gerar dia do plano (job %s)", job_id)
         _set_day_status(day, "failed", error=str(exc), job_id=job_id)
         _set_plan_status(plan, "failed", error=str(exc))
+        fail_job(job_id, str(exc))
         return {"status": "failed", "message": str(exc)}
 
 
 @shared_task(name="ai.generate_section_tasks", bind=True)
-def generate_section_tasks_task(self, job_id: str, plan_id: str, section_id: str, user_id: str | None = None):
+def generate_section_tasks_task(
+    self, job_id: str, plan_id: str, section_id: str, user_id: str | None = None, force_regenerate: bool = False
+):
     plan = StudyPlan.objects.filter(id=plan_id).first()
     if not plan:
+        fail_job(job_id, "Plan not found")
         return {"status": "failed", "message": "Plan not found"}
+    start_job(job_id)
     _set_plan_status(plan, "running", job_id=job_id, error=None)
     try:
         documents = plan.rag_documents.all()
         if not documents:
             documents = Document.objects.filter(owner=plan.user_context.user)
-        payload = generate_tasks_payload(plan, section_id=section_id, documents=documents)
+        with llm_cache.track() as cache_usage:
+            payload = generate_tasks_payload(plan, section_id=section_id, documents=documents, force_regenerate=force_regenerate)
         with transaction.atomic():
             created = persist_tasks_for_section(plan, section_id, payload)
         _set_plan_status(plan, "succeeded")
-        return {"status": "succeeded", "tasks": [str(t.id) for t in created]}
+        result = {"status": "succeeded", "tasks": [str(t.id) for t in created], "llm_cache": cache_usage}
+        finish_job(job_id, result)
+        return result
     except Exception as exc:
         logger.exception("Erro ao gerar tarefas da secao (job %s)", job_id)
         _set_plan_status(plan, "failed", error=str(exc))
+        fail_job(job_id, str(exc))
         return {"status": "failed", "message": str(exc)}
 
 
-@shared_task(name="ai.ingest_material", bind=True)
-def ingest_material_task(self, job_id: str, plan_id: str, file_ref_id: str, document_id: str, document_title: str):
+def _set_doc_status(doc: Document, status: str, error: str | None = None):
+    doc.ingest_status = status
+    fields = ["ingest_status"]
+    if error is not None:
+        doc.last_error = error
+        fields.append("last_error")
+    doc.save(update_fields=fields)
+
+
+def _should_retry(exc: Exception) -> bool:
+    # falhas transitorias: a nova tentativa retoma do checkpoint sem reembedar
+    return isinstance(exc, (SoftTimeLimitExceeded, OperationalError)) or is_retryable(exc)
+
+
+@shared_task(
+    name="ai.ingest_material",
+    bind=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    max_retries=INGEST_MAX_RETRIES,
+)
+def ingest_material_task(
+    self, job_id: str, plan_id: str, file_ref_id: str, document_id: str, document_title: str, reingest: bool = False
+):
     plan = StudyPlan.objects.filter(id=plan_id).first()
     if not plan:
+        fail_job(job_id, "Plan not found")
         return {"status": "failed", "message": "Plan not found"}
     doc = Document.objects.filter(id=document_id).first()
     file_ref = None
@@ -130,33 +237,125 @@ def ingest_material_task(self, job_id: str, plan_id: str, file_ref_id: str, docu
     except Exception:
         file_ref = None
     if not doc or not file_ref:
+        fail_job(job_id, "Document or FileRef not found")
         return {"status": "failed", "message": "Document or FileRef not found"}
 
+    start_job(job_id)
     doc.ingest_status = "running"
     doc.job_id = job_id
     doc.last_error = ""
     doc.save(update_fields=["ingest_status", "job_id", "last_error"])
+    # documentos grandes: grava o texto aqui e distribui os embeddings em subtarefas
+    fanout = not reingest and file_ref.file.size >= FANOUT_MIN_BYTES
+    mode = "reingest" if reingest else ("fanout" if fanout else "ingest")
     try:
-        file_ref.file.open("rb")
-        raw = file_ref.file.read()
-        file_ref.file.close()
-        if not raw:
+        if fanout and doc.chunks_total is not None:
+            # nova tentativa com staging ja concluido: so faltam os vetores
+            mime = None
+            stats = {"chunks": doc.chunks_total, "resumed_from": doc.chunks_done}
+        else:
+            # arquivo -> texto (PDF/DOCX/texto) -> chunks (sentencas + overlap) -> lotes (embed + insert)
+            with file_ref.file.open("rb") as fh:
+                mime = sniff_mime(fh)
+                chunks = iter_chunks(extract_blocks(fh, mime))
+                if fanout:
+                    stats = stage_chunks(doc, chunks)
+                elif reingest:
+                    # diff por hash contra os chunks atuais, so os novos vao para o embedding;
+                    # numa nova tentativa o que ja foi gravado e reaproveitado pelo hash
+                    stats = reingest_chunks(doc, chunks)
+                else:
+                    # arquivo pequeno (< FANOUT_MIN_BYTES): materializa para ter o total exato
+                    chunks = list(chunks)
+                    record_progress(doc.id, total=len(chunks))
+                    stats = ingest_chunks(doc, chunks, resume_from=doc.ingest_checkpoint)
+        if not stats["chunks"]:
             raise ValueError("Arquivo vazio ou nao lido")
-        try:
-            text = raw.decode("utf-8")
-        except UnicodeDecodeError:
-            text = raw.decode("latin-1", errors="ignore")
-        chunks = _simple_chunk(text)
-        vectors = embed_batch(chunks)
-        objs = [Chunk(document=doc, order=i, text=t, embedding=v) for i, (t, v) in enumerate(zip(chunks, vectors))]
-        Chunk.objects.bulk_create(objs, batch_size=200)
+        if fanout:
+            parts = chunk_ranges(stats["chunks"])
+            if len(parts) > 1:
+                header = group(
+                    embed_chunk_range_task.s(str(doc.id), start, stop).set(queue="ingest") for start, stop in parts
+                )
+                callback = finalize_ingest_task.s(job_id, str(plan.id), str(doc.id)).set(queue="ingest")
+                chord(header)(callback.on_error(ingest_parts_failed.s(job_id, str(doc.id))))
+                update_progress(job_id, mode=mode, parts=len(parts))
+                return {"status": "running", "document_id": str(doc.id), "mime": mime, "mode": mode,
+                        "parts": len(parts), **stats}
+            stats["embed_seconds"] = embed_chunk_range(doc.id, 0, stats["chunks"])["embed_seconds"]
+            index_lexical(doc.id)
         plan.rag_documents.add(doc)
-        doc.ingest_status = "succeeded"
-        doc.save(update_fields=["ingest_status"])
-        return {"status": "succeeded", "document_id": str(doc.id), "chunks": len(objs)}
+        _set_doc_status(doc, "succeeded")
+        result = {
+            "status": "succeeded",
+            "document_id": str(doc.id),
+            "mime": mime,
+            "mode": mode,
+            **stats,
+            "embedding_cache": cache_stats(),
+        }
+        finish_job(job_id, result)
+        return result
     except Exception as exc:
+        if _should_retry(exc) and self.request.retries < self.max_retries:
+            logger.warning("Ingestao interrompida (job %s), nova tentativa: %s", job_id, exc)
+            doc.last_error = f"tentativa {self.request.retries + 1}: {exc}"
+            doc.save(update_fields=["last_error"])
+            note_retry(job_id, doc.last_error)
+            raise self.retry(exc=exc, countdown=min(60, 5 * 2 ** self.request.retries))
         logger.exception("Erro ao ingerir material (job %s)", job_id)
-        doc.ingest_status = "failed"
-        doc.last_error = str(exc)
-        doc.save(update_fields=["ingest_status", "last_error"])
+        _set_doc_status(doc, "failed", error=str(exc))
+        fail_job(job_id, str(exc))
         return {"status": "failed", "message": str(exc)}
+
+
+@shared_task(
+    name="ai.embed_chunk_range",
+    bind=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def embed_chunk_range_task(self, document_id: str, start: int, stop: int):
+    # idempotente: so pega chunks da faixa ainda sem vetor
+    return embed_chunk_range(document_id, start, stop)
+
+
+@shared_task(name="ai.finalize_ingest", bind=True)
+def finalize_ingest_task(self, results: list[dict], job_id: str, plan_id: str, document_id: str):
+    doc = Document.objects.filter(id=document_id).first()
+    plan = StudyPlan.objects.filter(id=plan_id).first()
+    if not doc or not plan:
+        fail_job(job_id, "Plan or Document not found")
+        return {"status": "failed", "message": "Plan or Document not found"}
+    missing = doc.chunks.filter(embedding=None).count()
+    if missing:
+        _set_doc_status(doc, "failed", error=f"{missing} chunks sem embedding apos o fan-out")
+        fail_job(job_id, doc.last_error)
+        return {"status": "failed", "message": doc.last_error}
+    index_lexical(doc.id)
+    plan.rag_documents.add(doc)
+    _set_doc_status(doc, "succeeded")
+    result = {
+        "status": "succeeded",
+        "document_id": str(doc.id),
+        "mode": "fanout",
+        "parts": len(results),
+        "chunks": doc.chunks.count(),
+        "embed_seconds": round(sum(r["embed_seconds"] for r in results), 3),
+        "slowest_part_seconds": max((r["seconds"] for r in results), default=0.0),
+    }
+    finish_job(job_id, result)
+    return result
+
+
+@shared_task(name="ai.ingest_parts_failed")
+def ingest_parts_failed(request, exc, traceback, job_id: str, document_id: str):
+    # errback do chord: alguma faixa estourou as tentativas
+    logger.error("Fan-out de ingestao falhou (job %s): %s", job_id, exc)
+    doc = Document.objects.filter(id=document_id).first()
+    if doc:
+        _set_doc_status(doc, "failed", error=str(exc))
+    fail_job(job_id, str(exc))
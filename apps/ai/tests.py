@@ -1,7 +1,14 @@
+import io
 import json
+import uuid
+import asyncio
+import weakref
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from unittest.mock import Mock, patch
-from django.test import TestCase
+from unittest.mock import AsyncMock, Mock, patch
+from asgiref.sync import sync_to_async
+from django.test import AsyncRequestFactory, TestCase
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
 from rest_framework import status
@@ -9,7 +16,36 @@ from apps.accounts.models import StudyContext, StudyPlan
 from apps.accounts.serializers import StudyContextSerializer
 from apps.ai.tools.commit_user_context import handle_tool_call, function_declarations
 from apps.ai.services.plan_outline import ensure_plan_outline
-from apps.ai.views import sse_format
+from apps.ai.views import encode_sse
+from apps.ai.models import ChatSession, Chunk, Document, EmbeddingCache, Job
+from apps.ai.services import embedding
+from apps.ai.services.chunking import chunk_text, estimate_tokens, iter_chunks
+from apps.ai.services import chunk_writer
+from apps.ai.services import extraction
+from apps.ai.services.jobs import create_job, enqueue, finish_job, publish_event, start_job, user_channel
+from apps.ai.services.ingest import (
+    chunk_ranges,
+    embed_chunk_range,
+    ingest_chunks,
+    iter_decoded_blocks,
+    reingest_chunks,
+    stage_chunks,
+)
+from apps.ai.services.search import index_lexical, reciprocal_rank_fusion, semantic_search
+from apps.ai.services import sse_replay
+from apps.ai.services import redis_client
+from apps.ai.services import chat
+from apps.ai.services import chat_sessions
+from apps.ai.services import tool_engine
+from apps.ai.services import llm_cache
+from apps.ai.services import rate_limit
+from apps.ai.services import genai_client
+from apps.ai.services import llm_backend
+from apps.ai.services import llm_metrics
+from apps.ai import client as ai_client
+from google.genai import types
+from apps.ai.async_views import AsyncJobStreamView
+from rest_framework_simplejwt.tokens import AccessToken
 
 User = get_user_model()
 
@@ -30,7 +66,6 @@ class UpsertStudyContextToolTest(TestCase):
             'weekly_time_hours': 20,
             'study_routine': 'Daily study sessions',
             'background_level': 'High School 3rd year',
-            'background_institution_type': 'public',
             'self_assessment': {'math': 4, 'portuguese': 3},
             'diagnostic_status': 'pending',
             'diagnostic_snapshot': ['Math weak', 'Portuguese good'],
@@ -59,7 +94,8 @@ class UpsertStudyContextToolTest(TestCase):
         self.assertEqual(context.deadline, date(2025, 12, 31))
         self.assertEqual(context.weekly_time_hours, 20)
         self.assertTrue(context.consent_lgpd)
-        self.assertEqual(StudyPlan.objects.filter(user_context=context).count(), 1)
+        # o outline do plano fica para o job chat_plan, fora da tool
+        self.assertFalse(StudyPlan.objects.filter(user_context=context).exists())
 
     def test_handle_tool_call_valid_data_updates_existing_context(self):
         """Testa atualização de StudyContext existente"""
@@ -72,7 +108,6 @@ class UpsertStudyContextToolTest(TestCase):
             weekly_time_hours=10,
             study_routine='Initial routine',
             background_level='College',
-            background_institution_type='private',
             preferences_language='en',
             tech_device='Laptop',
             tech_connectivity='Excellent',
@@ -95,7 +130,7 @@ class UpsertStudyContextToolTest(TestCase):
         self.assertEqual(context.goal, 'Updated ENEM goal')
         self.assertEqual(context.weekly_time_hours, 25)
         self.assertEqual(context.persona, 'student')  # Mantém outros campos
-        self.assertEqual(StudyPlan.objects.filter(user_context=context).count(), 1)
+        self.assertFalse(StudyPlan.objects.filter(user_context=context).exists())
 
     def test_handle_tool_call_invalid_tool_name(self):
         """Testa chamada com nome de tool inválido"""
@@ -104,13 +139,17 @@ class UpsertStudyContextToolTest(TestCase):
         self.assertEqual(result['status'], 'error')
         self.assertIn('Unknown tool', result['message'])
 
-    def test_handle_tool_call_missing_required_fields(self):
-        """Testa chamada com campos obrigatórios faltando"""
-        invalid_args = self.valid_args.copy()
-        del invalid_args['persona']  # Campo obrigatório
+    def test_handle_tool_call_missing_fields_keep_saved_values(self):
+        """Testa chamada parcial: o chat grava o contexto aos poucos"""
+        handle_tool_call(self.user, 'commit_user_context', self.valid_args)
+        partial_args = {'goal': 'Vestibular', 'consent_lgpd': True}  # sem 'persona'
 
-        with self.assertRaises(Exception):  # Serializer deve levantar ValidationError
-            handle_tool_call(self.user, 'commit_user_context', invalid_args)
+        result = handle_tool_call(self.user, 'commit_user_context', partial_args)
+
+        self.assertEqual(result['status'], 'ok')
+        context = StudyContext.objects.get(user=self.user)
+        self.assertEqual(context.goal, 'Vestibular')
+        self.assertEqual(context.persona, 'student')
 
     def test_handle_tool_call_invalid_data_types(self):
         """Testa chamada com tipos de dados inválidos"""
@@ -130,48 +169,48 @@ class UpsertStudyContextToolTest(TestCase):
         self.assertEqual(declarations[1].name, 'commit_user_context')
         decl = declarations[0]
         self.assertIn('Cria/atualiza o contexto do usuário', decl.description)
-        self.assertIn('persona', decl.parameters['properties'])
-        self.assertIn('goal', decl.parameters['properties'])
-        self.assertIn('consent_lgpd', decl.parameters['required'])
+        self.assertIn('persona', decl.parameters.properties)
+        self.assertIn('goal', decl.parameters.properties)
+        self.assertIn('consent_lgpd', decl.parameters.required)
 
 
 class SSEGeneratorTest(TestCase):
     """Testes para SSE generator (formato data: ...\n\n)"""
 
-    def test_sse_format_basic(self):
+    def test_encode_sse_basic(self):
         """Testa formato SSE básico"""
         data = "Hello World"
-        result = sse_format(data)
+        result = encode_sse("", data)
 
         self.assertEqual(result, "data: Hello World\n\n")
 
-    def test_sse_format_with_special_characters(self):
-        """Testa formato SSE com caracteres especiais"""
+    def test_encode_sse_with_special_characters(self):
+        """Testa formato SSE com caracteres especiais (cada linha vira um campo data:)"""
         data = "Mensagem com\nquebra\nde linha e \"aspas\""
-        result = sse_format(data)
+        result = encode_sse("", data)
 
-        self.assertEqual(result, "data: Mensagem com\nquebra\nde linha e \"aspas\"\n\n")
+        self.assertEqual(result, "data: Mensagem com\ndata: quebra\ndata: de linha e \"aspas\"\n\n")
 
-    def test_sse_format_empty_string(self):
+    def test_encode_sse_empty_string(self):
         """Testa formato SSE com string vazia"""
         data = ""
-        result = sse_format(data)
+        result = encode_sse("", data)
 
         self.assertEqual(result, "data: \n\n")
 
-    def test_sse_format_json_data(self):
-        """Testa formato SSE com dados JSON"""
-        data = '{"status": "ok", "message": "Context saved"}'
-        result = sse_format(data)
+    def test_encode_sse_json_data(self):
+        """Testa formato SSE com dados JSON, nome do evento e id"""
+        data = {"status": "ok", "message": "Context saved"}
+        result = encode_sse("meta", data, event_id=3)
 
-        self.assertEqual(result, 'data: {"status": "ok", "message": "Context saved"}\n\n')
+        self.assertEqual(result, 'id: 3\nevent: meta\ndata: {"status": "ok", "message": "Context saved"}\n\n')
 
-    def test_sse_format_multiline_data(self):
+    def test_encode_sse_multiline_data(self):
         """Testa formato SSE com dados multilinha"""
         data = "Linha 1\nLinha 2\nLinha 3"
-        result = sse_format(data)
+        result = encode_sse("", data)
 
-        self.assertEqual(result, "data: Linha 1\nLinha 2\nLinha 3\n\n")
+        self.assertEqual(result, "data: Linha 1\ndata: Linha 2\ndata: Linha 3\n\n")
 
 
 class StudyContextSerializerTest(TestCase):
@@ -194,7 +233,6 @@ class StudyContextSerializerTest(TestCase):
             weekly_time_hours=20,
             study_routine='Daily study sessions',
             background_level='High School 3rd year',
-            background_institution_type='public',
             self_assessment={'math': 4, 'portuguese': 3},
             diagnostic_status='completed',
             diagnostic_snapshot=['Math improved', 'Portuguese good'],
@@ -236,7 +274,6 @@ class StudyContextSerializerTest(TestCase):
             'weekly_time_hours': 15,
             'study_routine': 'Weekly planning',
             'background_level': 'Masters Degree',
-            'background_institution_type': 'private',
             'self_assessment': {},
             'diagnostic_status': 'pending',
             'diagnostic_snapshot': [],
@@ -267,14 +304,14 @@ class StudyContextSerializerTest(TestCase):
             'goal': 'Test goal',
             'deadline': '2025-12-31',
             'weekly_time_hours': 10,
-            # Faltando 'persona' e 'consent_lgpd' obrigatórios
+            # Faltando 'persona' (obrigatório); 'consent_lgpd' tem default False
         }
 
         serializer = StudyContextSerializer(data=data)
         self.assertFalse(serializer.is_valid())
 
         self.assertIn('persona', serializer.errors)
-        self.assertIn('consent_lgpd', serializer.errors)
+        self.assertNotIn('consent_lgpd', serializer.errors)
 
     def test_deserialize_invalid_data_types(self):
         """Testa desserialização com tipos inválidos"""
@@ -316,7 +353,6 @@ class StudyContextSerializerTest(TestCase):
             weekly_time_hours=10,
             study_routine='Initial routine',
             background_level='High School',
-            background_institution_type='public',
             preferences_language='pt-BR',
             tech_device='Smartphone',
             tech_connectivity='Good',
@@ -379,3 +415,1297 @@ class PlanOutlineServiceTest(TestCase):
         first_week = plan.weeks.order_by("week_index").first()
         self.assertEqual(first_week.week_index, 1)
         self.assertIn("Onboarding", first_week.focus)
+
+
+class EmbeddingCacheTest(TestCase):
+    def setUp(self):
+        embedding.reset_cache()
+
+    def _fake_remote(self, texts):
+        return [[float(len(t)), 0.5, 1.0] for t in texts]
+
+    def test_embed_batch_sends_only_unique_misses(self):
+        with patch.object(embedding, "_embed_remote", side_effect=self._fake_remote) as remote:
+            vectors = embedding.embed_batch(["apostila", "enem", "apostila"])
+        remote.assert_called_once_with(["apostila", "enem"])
+        self.assertEqual(vectors[0], vectors[2])
+        self.assertEqual(EmbeddingCache.objects.count(), 2)
+
+    def test_repeated_material_costs_zero_api_calls(self):
+        with patch.object(embedding, "_embed_remote", side_effect=self._fake_remote):
+            embedding.embed_batch(["capitulo 1", "capitulo 2"])
+        embedding.reset_cache(stats=False)  # esvazia o LRU: forca leitura do Postgres
+        with patch.object(embedding, "_embed_remote", side_effect=self._fake_remote) as remote:
+            vectors = embedding.embed_batch(["capitulo 2", "capitulo 1"])
+            embedding.embed_one("capitulo 1")
+        remote.assert_not_called()
+        self.assertEqual(vectors[1], [10.0, 0.5, 1.0])
+        stats = embedding.cache_stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["db_hits"], 2)
+        self.assertEqual(stats["memory_hits"], 1)
+
+    def test_synthetic_run_does_not_change_what_a_real_run_gets(self):
+        with patch.object(llm_backend, "AI_LLM_BACKEND", "synthetic"), \
+                patch.object(embedding, "_embed_remote", return_value=[[9.0, 9.0, 9.0]]):
+            embedding.embed_batch(["apostila"])
+        with patch.object(llm_backend, "AI_LLM_BACKEND", "gemini"), \
+                patch.object(embedding, "_embed_remote", side_effect=self._fake_remote) as remote:
+            vectors = embedding.embed_batch(["apostila"])
+        remote.assert_called_once_with(["apostila"])  # nem o LRU nem o Postgres servem o vetor sintetico
+        self.assertEqual(vectors, [[8.0, 0.5, 1.0]])
+        self.assertEqual(
+            sorted(EmbeddingCache.objects.values_list("model", flat=True)),
+            [embedding.EMBED_MODEL, f"synthetic:{embedding.EMBED_MODEL}"],
+        )
+
+
+class EmbeddingBatchSplitTest(TestCase):
+    def test_split_respects_item_and_token_limits(self):
+        texts = ["a" * 40] * 5 + ["b" * 400] + ["c" * 40] * 3
+        batches = embedding.split_batches(texts, max_items=4, max_tokens=100)
+        for _, batch in batches:
+            self.assertLessEqual(len(batch), 4)
+        self.assertEqual([t for _, b in batches for t in b], texts)
+        self.assertEqual([offset for offset, _ in batches], [0, 4, 5, 6])
+
+    def test_remote_reassembles_sub_batches_in_order(self):
+        texts = [f"trecho {i}" for i in range(10)]
+        with patch.object(embedding, "EMBED_BATCH_MAX_ITEMS", 3), \
+                patch.object(embedding, "_embed_request", side_effect=lambda b: [[float(t.split()[1])] for t in b]):
+            vectors = embedding._embed_remote(texts)
+        self.assertEqual(vectors, [[float(i)] for i in range(10)])
+
+    @patch("apps.ai.services.embedding.EMBED_BACKOFF_BASE_S", 0.01)
+    @patch("apps.ai.services.llm_metrics.LLM_METRICS_REDIS", False)
+    def test_transport_errors_are_retried(self):
+        import httpx
+
+        self.assertTrue(embedding.is_retryable(httpx.ReadTimeout("lento")))
+        self.assertTrue(embedding.is_retryable(httpx.RemoteProtocolError("conexao caiu")))
+        self.assertFalse(embedding.is_retryable(ValueError("entrada invalida")))
+        resp = types.EmbedContentResponse(embeddings=[types.ContentEmbedding(values=[0.5])])
+        client = Mock()
+        client.models.embed_content.side_effect = [httpx.ConnectError("recusada"), resp]
+        with patch("apps.ai.services.embedding.get_client", return_value=client), \
+                patch("apps.ai.services.rate_limit._bucket", return_value=0):
+            self.assertEqual(embedding._embed_request(["oi"]), [[0.5]])
+        self.assertEqual(client.models.embed_content.call_count, 2)
+
+
+class HybridSearchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="rag-user", email="rag@example.com", password="rag")
+        other = User.objects.create_user(username="rag-other", email="other@example.com", password="rag")
+        doc = Document.objects.create(title="Fisica", owner=self.user)
+        other_doc = Document.objects.create(title="Fisica (outro)", owner=other)
+        Chunk.objects.create(document=doc, order=0, text="A Lei de Ohm relaciona tensao, corrente e resistencia.")
+        Chunk.objects.create(document=doc, order=1, text="A fotossintese ocorre nos cloroplastos.")
+        Chunk.objects.create(document=other_doc, order=0, text="Lei de Ohm: V = R * I.")
+        index_lexical(doc.id)
+        index_lexical(other_doc.id)
+
+    def test_reciprocal_rank_fusion_rewards_agreement(self):
+        vector = [{"chunk_id": 1, "distance": 0.1}, {"chunk_id": 2, "distance": 0.2}]
+        lexical = [{"chunk_id": 2, "rank": 0.9}, {"chunk_id": 3, "rank": 0.5}]
+        fused = reciprocal_rank_fusion([vector, lexical], k=60)
+        self.assertEqual([r["chunk_id"] for r in fused], [2, 1, 3])
+        self.assertEqual(fused[0]["distance"], 0.2)
+        self.assertEqual(fused[0]["rank"], 0.9)
+
+    def test_hybrid_falls_back_to_lexical_when_embedding_fails(self):
+        with patch("apps.ai.services.search.embed_one", side_effect=RuntimeError("embedding down")):
+            rows = semantic_search("Lei de Ohm", k=5, owner=self.user, mode="hybrid")
+        self.assertEqual(len(rows), 1)
+        self.assertIn("Ohm", rows[0]["text"])
+
+
+class StreamingIngestTest(TestCase):
+    def test_decoder_handles_multibyte_split_across_blocks(self):
+        raw = "Revolução Francesa\r\nIluminismo e ação".encode("utf-8")
+        blocks = list(iter_decoded_blocks(io.BytesIO(raw), block_size=7))
+        self.assertEqual("".join(blocks), "Revolução Francesa\r\nIluminismo e ação")
+
+    def test_decoder_falls_back_to_latin1(self):
+        raw = "ok\n".encode("utf-8") + "função".encode("latin-1")
+        text = "".join(iter_decoded_blocks(io.BytesIO(raw), block_size=4))
+        self.assertEqual(text, "ok\nfunção")
+
+    def test_ingest_chunks_embeds_in_bounded_batches(self):
+        doc = Document.objects.create(title="apostila")
+        chunks = (f"paragrafo {i}" for i in range(10))
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=lambda b: [[0.0] * 1535 + [1.0]] * len(b)) as emb:
+            stats = ingest_chunks(doc, chunks, batch_size=4)
+        self.assertEqual([len(c.args[0]) for c in emb.call_args_list], [4, 4, 2])
+        self.assertEqual(stats["chunks"], 10)
+        self.assertEqual(list(doc.chunks.order_by("order").values_list("order", flat=True)), list(range(10)))
+
+    def test_vector_type_is_registered_once_per_connection(self):
+        doc = Document.objects.create(title="apostila")
+        with patch.object(chunk_writer, "_vector_conns", weakref.WeakSet()), \
+                patch("apps.ai.services.chunk_writer.register_vector", wraps=chunk_writer.register_vector) as register, \
+                patch("apps.ai.services.ingest.embed_batch", side_effect=lambda b: [[0.0] * 1535 + [1.0]] * len(b)):
+            ingest_chunks(doc, (f"paragrafo {i}" for i in range(10)), batch_size=4)
+        register.assert_called_once()
+
+
+class ChunkingTest(TestCase):
+    def test_keeps_abbreviations_inside_sentences(self):
+        text = "Segundo o art. 5º da Constituição, todos são iguais. O Prof. Silva explicou a Lei de Ohm."
+        chunks = chunk_text(text, max_tokens=15, overlap_tokens=0)
+        self.assertEqual(chunks, [
+            "Segundo o art. 5º da Constituição, todos são iguais.",
+            "O Prof. Silva explicou a Lei de Ohm.",
+        ])
+
+    def test_hard_splits_oversized_lines(self):
+        minified = "x" * 5000
+        chunks = chunk_text(minified, max_tokens=100, overlap_tokens=0)
+        self.assertTrue(all(len(c) <= 400 for c in chunks))
+        self.assertEqual("".join(chunks), minified)
+
+    def test_overlap_repeats_trailing_sentences(self):
+        text = " ".join(f"Esta é a frase número {i}." for i in range(40))
+        chunks = chunk_text(text, max_tokens=50, overlap_tokens=10)
+        self.assertGreater(len(chunks), 1)
+        for prev, nxt in zip(chunks, chunks[1:]):
+            last_sentence = prev.rsplit(". ", 1)[-1]
+            self.assertTrue(nxt.startswith(last_sentence))
+            self.assertLessEqual(estimate_tokens(nxt), 50)
+
+    def test_streaming_blocks_match_whole_text(self):
+        text = "Primeira linha\nSegunda frase. Terceira! " * 50
+        blocks = (text[i:i + 13] for i in range(0, len(text), 13))
+        self.assertEqual(list(iter_chunks(blocks, 40, 8)), chunk_text(text, 40, 8))
+
+
+def _docx(*paragraphs):
+    xml = "".join(f"<w:p><w:r><w:t>{p}</w:t></w:r></w:p>" for p in paragraphs)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr(
+            "word/document.xml",
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{xml}</w:body></w:document>",
+        )
+    buf.seek(0)
+    return buf
+
+
+class ExtractionTest(TestCase):
+    def test_sniffs_mime_from_content(self):
+        self.assertEqual(extraction.sniff_mime(io.BytesIO(b"%PDF-1.7\n...")), extraction.MIME_PDF)
+        self.assertEqual(extraction.sniff_mime(_docx("oi")), extraction.MIME_DOCX)
+        self.assertEqual(extraction.sniff_mime(io.BytesIO("Anotações\n".encode())), extraction.MIME_TEXT)
+        self.assertEqual(extraction.sniff_mime(io.BytesIO(b"\x89PNG\r\n\x1a\n")), extraction.MIME_BINARY)
+
+    def test_docx_streams_paragraphs(self):
+        blocks = list(extraction.extract_blocks(_docx("Capítulo 1", "A célula é a unidade da vida.")))
+        self.assertEqual(blocks, ["Capítulo 1\n", "A célula é a unidade da vida.\n"])
+
+    def test_rejects_binary_and_empty_before_embedding(self):
+        doc = Document.objects.create(title="foto")
+        with patch("apps.ai.services.ingest.embed_batch") as emb:
+            for fh in (io.BytesIO(b"\x00\x01\x02binario"), _docx("", " ")):
+                with self.assertRaises(extraction.UnsupportedMaterialError):
+                    ingest_chunks(doc, iter_chunks(extraction.extract_blocks(fh)))
+        emb.assert_not_called()
+        self.assertFalse(doc.chunks.exists())
+
+    def test_process_pool_only_outside_daemon_workers(self):
+        # --pool threads: a task roda numa thread do processo principal do worker
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            self.assertTrue(pool.submit(extraction._can_fork_pool).result())
+        # prefork: o filho e daemon e a extracao cai para o caminho em serie
+        with patch("apps.ai.services.extraction.multiprocessing.current_process") as proc:
+            proc.return_value.daemon = True
+            self.assertFalse(extraction._can_fork_pool())
+
+
+class ReingestTest(TestCase):
+    def _fake_embed(self, batch):
+        return [[0.0] * 1535 + [1.0]] * len(batch)  # Chunk.embedding e vector(1536)
+
+    def test_only_new_chunks_are_embedded(self):
+        doc = Document.objects.create(title="anotacoes")
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=self._fake_embed):
+            ingest_chunks(doc, ["intro", "capitulo 1", "capitulo 2", "apendice"])
+        kept_ids = set(doc.chunks.filter(text__in=["intro", "capitulo 2"]).values_list("id", flat=True))
+
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=self._fake_embed) as emb:
+            stats = reingest_chunks(doc, ["intro", "capitulo 1 revisado", "capitulo 2", "exercicios"], batch_size=2)
+
+        embedded = [t for c in emb.call_args_list for t in c.args[0]]
+        self.assertEqual(embedded, ["capitulo 1 revisado", "exercicios"])
+        self.assertEqual((stats["reused"], stats["added"], stats["removed"]), (2, 2, 2))
+        rows = list(doc.chunks.order_by("order").values_list("order", "text"))
+        self.assertEqual(rows, [(0, "intro"), (1, "capitulo 1 revisado"), (2, "capitulo 2"), (3, "exercicios")])
+        self.assertTrue(kept_ids <= set(doc.chunks.values_list("id", flat=True)))
+
+    def test_reordered_chunks_keep_their_rows(self):
+        doc = Document.objects.create(title="resumo")
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=self._fake_embed):
+            ingest_chunks(doc, ["a", "b", "c"])
+            stats = reingest_chunks(doc, ["c", "a", "b"])
+        self.assertEqual((stats["reused"], stats["added"], stats["removed"]), (3, 0, 0))
+        self.assertEqual(list(doc.chunks.order_by("order").values_list("text", flat=True)), ["c", "a", "b"])
+
+    def test_new_version_stays_hidden_until_the_swap(self):
+        doc = Document.objects.create(title="apostila")
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=self._fake_embed):
+            ingest_chunks(doc, ["a", "b"])
+        seen = []
+
+        def embed_then_fail(batch):
+            # o lote anterior ja foi embedado: a tabela ainda tem so a versao antiga
+            seen.append(list(doc.chunks.order_by("order").values_list("text", flat=True)))
+            if len(seen) == 2:
+                raise RuntimeError("embedding caiu")
+            return self._fake_embed(batch)
+
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=embed_then_fail), \
+                self.assertRaises(RuntimeError):
+            reingest_chunks(doc, ["x", "y", "z", "w"], batch_size=2)
+        self.assertEqual(seen, [["a", "b"], ["a", "b"]])
+        self.assertEqual(list(doc.chunks.order_by("order").values_list("text", flat=True)), ["a", "b"])
+
+
+class FanoutIngestTest(TestCase):
+    def test_chunk_ranges_cover_document(self):
+        self.assertEqual(chunk_ranges(10, 4), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(chunk_ranges(0, 4), [])
+
+    def test_range_embedding_is_idempotent(self):
+        doc = Document.objects.create(title="livro")
+        stats = stage_chunks(doc, (f"pagina {i}" for i in range(10)))
+        self.assertEqual(stats["chunks"], 10)
+        self.assertEqual(doc.chunks.filter(embedding=None).count(), 10)
+
+        fake = lambda b: [[0.0] * 1535 + [1.0]] * len(b)
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=fake) as emb:
+            first = embed_chunk_range(doc.id, 0, 5, batch_size=2)
+            again = embed_chunk_range(doc.id, 0, 5, batch_size=2)
+        self.assertEqual((first["chunks"], again["chunks"]), (5, 0))
+        self.assertEqual(emb.call_count, 3)
+        self.assertEqual(
+            list(doc.chunks.filter(embedding=None).order_by("order").values_list("order", flat=True)),
+            [5, 6, 7, 8, 9],
+        )
+
+
+class ResumableIngestTest(TestCase):
+    def test_retry_resumes_from_last_committed_batch(self):
+        doc = Document.objects.create(title="apostila", ingest_status="running")
+        chunks = [f"trecho {i}" for i in range(10)]
+        calls = []
+
+        def flaky(batch):
+            calls.append(list(batch))
+            if len(calls) == 3:
+                raise ConnectionError("api caiu")
+            return [[0.0] * 1535 + [1.0]] * len(batch)
+
+        with patch("apps.ai.services.ingest.embed_batch", side_effect=flaky):
+            with self.assertRaises(ConnectionError):
+                ingest_chunks(doc, chunks, batch_size=3)
+            doc.refresh_from_db()
+            self.assertEqual((doc.ingest_checkpoint, doc.chunks_done, doc.chunks.count()), (6, 6, 6))
+
+            stats = ingest_chunks(doc, chunks, batch_size=3, resume_from=doc.ingest_checkpoint)
+
+        self.assertEqual(calls[3:], [chunks[6:9], chunks[9:]])
+        self.assertEqual((stats["chunks"], stats["resumed_from"]), (10, 6))
+        doc.refresh_from_db()
+        self.assertEqual(doc.chunks_done, 10)
+        self.assertEqual(list(doc.chunks.order_by("order").values_list("text", flat=True)), chunks)
+
+
+class JobRegistryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        self.other = User.objects.create_user(username="outro", email="outro@example.com", password="x")
+        self.client.force_authenticate(self.user)
+
+    def test_enqueue_uses_job_id_as_task_id(self):
+        job = create_job(self.user, "study_plan")
+        task = Mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue(task, job, args=[str(job.id)], queue="ai_generation")
+        task.apply_async.assert_called_once_with(
+            args=[str(job.id)], kwargs={}, queue="ai_generation", task_id=str(job.id)
+        )
+
+    def test_status_reflects_task_updates(self):
+        job = create_job(self.user, "study_day")
+        start_job(job.id)
+        finish_job(job.id, {"status": "succeeded", "tasks": []})
+        resp = self.client.get(f"/api/ai/jobs/{job.id}/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["status"], "succeeded")
+        self.assertEqual(resp.data["attempts"], 1)
+        self.assertIsNotNone(resp.data["duration_ms"])
+
+    def test_bulk_lookup_is_scoped_to_owner(self):
+        mine = [create_job(self.user, "ingest") for _ in range(3)]
+        foreign = create_job(self.other, "ingest")
+        ids = ",".join(str(j.id) for j in mine + [foreign])
+        with self.assertNumQueries(1):
+            resp = self.client.get(f"/api/ai/jobs/?ids={ids}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual({r["job_id"] for r in resp.data}, {str(j.id) for j in mine})
+        self.assertEqual(self.client.get(f"/api/ai/jobs/{foreign.id}/").status_code, 404)
+        self.assertEqual(self.client.get("/api/ai/jobs/?ids=nao-e-uuid").status_code, 400)
+
+    def test_stuck_ingest_accepts_a_new_upload_once_stale(self):
+        from datetime import timedelta
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.utils import timezone
+
+        context = StudyContext.objects.create(
+            user=self.user, persona="student", goal="ENEM", deadline=date(2030, 12, 31),
+            weekly_time_hours=10, consent_lgpd=True,
+        )
+        plan = StudyPlan.objects.create(user_context=context)
+        job = create_job(self.user, "ingest")
+        start_job(job.id)
+        doc = Document.objects.create(title="apostila", owner=self.user, ingest_status="running", job_id=str(job.id))
+        url = f"/api/ai/study-plans/{plan.id}/materials/"
+
+        def upload():
+            data = {"file": SimpleUploadedFile("a.txt", b"texto novo", content_type="text/plain"),
+                    "document_id": str(doc.id)}
+            with patch("apps.ai.views.enqueue"):
+                return self.client.post(url, data, format="multipart")
+
+        self.assertEqual(upload().status_code, 409)
+        # o worker morreu: o Job nao recebe atualizacao ha mais de INGEST_STALE_S
+        Job.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(hours=1))
+        resp = upload()
+        self.assertEqual(resp.status_code, 202)
+        doc.refresh_from_db()
+        self.assertEqual((doc.ingest_status, doc.job_id), ("pending", resp.data["job_id"]))
+
+
+class JobEventStreamTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        self.client.force_authenticate(self.user)
+
+    def test_tasks_publish_to_owner_channel_after_commit(self):
+        job = create_job(self.user, "ingest")
+        fake = Mock()
+        with patch("apps.ai.services.jobs.get_redis", return_value=fake):
+            with self.captureOnCommitCallbacks(execute=True):
+                start_job(job.id)
+        channel, message = fake.publish.call_args.args
+        self.assertEqual(channel, user_channel(self.user.id))
+        self.assertEqual(json.loads(message), {"event": "status", "job_id": str(job.id), "kind": "ingest", "status": "running"})
+
+    def test_missing_job_is_not_cached(self):
+        job_id = uuid.uuid4()
+        fake = Mock()
+        with patch("apps.ai.services.jobs.get_redis", return_value=fake):
+            with self.captureOnCommitCallbacks(execute=True):
+                publish_event(job_id, "status", {"status": "queued"})
+            fake.publish.assert_not_called()
+            # o Job aparece depois (commit atrasado): o proximo evento ja chega ao dono
+            create_job(self.user, "ingest", job_id=job_id)
+            with self.captureOnCommitCallbacks(execute=True):
+                publish_event(job_id, "status", {"status": "running"})
+        self.assertEqual(fake.publish.call_args.args[0], user_channel(self.user.id))
+
+    def test_stream_relays_pushed_events_for_all_jobs(self):
+        running = create_job(self.user, "ingest")
+        start_job(running.id)
+        events = [
+            {"event": "progress", "job_id": str(running.id), "kind": "ingest", "chunks_done": 64, "chunks_total": 128},
+            {"event": "status", "job_id": str(running.id), "kind": "ingest", "status": "succeeded", "result": {"chunks": 128}},
+        ]
+        queue = [{"data": json.dumps(e)} for e in events]
+        pubsub = Mock()
+        pubsub.get_message.side_effect = lambda timeout: queue.pop(0) if queue else None
+        with patch("apps.ai.views.get_redis") as redis, patch("apps.ai.views.JOB_STREAM_MAX_S", 0.05):
+            redis.return_value.pubsub.return_value = pubsub
+            resp = self.client.get("/api/ai/jobs/stream/")
+            body = b"".join(resp.streaming_content).decode()
+        pubsub.subscribe.assert_called_once_with(user_channel(self.user.id))
+        self.assertIn('"status": "running"', body)  # snapshot inicial dos jobs ativos
+        self.assertIn('"chunks_done": 64', body)
+        self.assertIn("event: result", body)
+        pubsub.close.assert_called_once()
+
+
+class RedisClientTest(TestCase):
+    @patch("apps.ai.services.redis_client._client", None)
+    @patch("apps.ai.services.redis_client.REDIS_SOCKET_TIMEOUT_S", 10.0)
+    def test_clients_have_timeouts_longer_than_the_blocking_reads(self):
+        with patch("apps.ai.services.redis_client.redis.Redis.from_url") as from_url:
+            redis_client.get_redis()
+        options = from_url.call_args.kwargs
+        self.assertEqual(options["socket_timeout"], 10.0)
+        self.assertEqual(options["socket_connect_timeout"], redis_client.REDIS_CONNECT_TIMEOUT_S)
+        # o XREAD do replay (15s por padrao) e cortado para caber no timeout de leitura
+        self.assertEqual(sse_replay._block_ms(15000), 9000)
+        self.assertEqual(redis_client.blocking_wait(5.0), 5.0)
+
+        redis = Mock()
+        redis.xrange.return_value = []
+        redis.xread.return_value = []
+        with patch("apps.ai.services.sse_replay.get_redis", return_value=redis), \
+                patch("apps.ai.services.sse_replay.SSE_REPLAY_MAX_IDLE", 1):
+            list(sse_replay.replay("s1", last_event_id=0))
+        self.assertEqual(redis.xread.call_args.kwargs["block"], 9000)
+
+
+class ChatStreamReplayTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        self.client.force_authenticate(self.user)
+
+    def _entry(self, index, event, data):
+        return (f"0-{index}", {"event": event, "data": json.dumps(data)})
+
+    def test_replay_returns_only_missed_events_until_done_marker(self):
+        redis = Mock()
+        redis.xrange.return_value = [
+            self._entry(3, "token", {"text": "c"}),
+            self._entry(4, "meta", {"type": "session_finished"}),
+            self._entry(5, "__done__", {}),
+        ]
+        with patch("apps.ai.services.sse_replay.get_redis", return_value=redis):
+            events = list(sse_replay.replay("s1", last_event_id=2))
+        redis.xrange.assert_called_once_with(sse_replay.stream_key("s1"), min="0-3")
+        redis.xread.assert_not_called()  # sessao encerrada: nada de bloquear esperando
+        self.assertEqual([e[0] for e in events], [3, 4])
+
+    def test_producer_keeps_streaming_when_redis_is_down(self):
+        packets = [{"event": "token", "data": {"text": "a"}}, {"event": "meta", "data": {"type": "session_finished"}}]
+        with patch("apps.ai.services.sse_replay.get_redis", side_effect=ConnectionError("down")):
+            events = list(sse_replay.produce("s2", self.user.id, iter(packets)))
+        self.assertEqual([(i, e) for i, e, _ in events], [(1, "token"), (2, "meta")])
+
+    def test_resume_replays_buffer_without_calling_the_model(self):
+        redis = Mock()
+        redis.get.return_value = str(self.user.id)
+        redis.xrange.return_value = [self._entry(2, "token", {"text": "b"}), self._entry(3, "__done__", {})]
+        with patch("apps.ai.services.sse_replay.get_redis", return_value=redis), \
+                patch("apps.ai.views.chat_stream") as chat:
+            resp = self.client.get("/api/ai/chat/stream/6f1c1a52-4c6e-4d5a-9a43-0b8f9f2d8e11/", HTTP_LAST_EVENT_ID="1")
+            body = b"".join(resp.streaming_content).decode()
+        chat.assert_not_called()
+        self.assertIn("id: 2\nevent: token", body)
+        self.assertNotIn("__done__", body)
+
+    def test_resume_rejects_session_of_another_user(self):
+        redis = Mock()
+        redis.get.return_value = "outro-usuario"
+        with patch("apps.ai.services.sse_replay.get_redis", return_value=redis):
+            resp = self.client.get("/api/ai/chat/stream/6f1c1a52-4c6e-4d5a-9a43-0b8f9f2d8e11/")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncSSEViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        # AsyncRequestFactory ja prefixa HTTP_: o header vai pelo nome HTTP normal
+        self.headers = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+    async def test_async_replay_stops_at_done_marker(self):
+        redis = Mock()
+        redis.xrange = AsyncMock(return_value=[
+            ("0-2", {"event": "token", "data": json.dumps({"text": "b"})}),
+            ("0-3", {"event": "__done__", "data": "{}"}),
+        ])
+        with patch("apps.ai.services.sse_replay.get_async_redis", return_value=redis):
+            events = [e async for e in sse_replay.areplay("s1", last_event_id=1)]
+        self.assertEqual(events, [(2, "token", {"text": "b"})])
+
+    async def test_async_producer_buffers_events_and_survives_disconnect(self):
+        pipe = Mock(execute=AsyncMock())
+        redis = Mock(pipeline=Mock(return_value=pipe))
+
+        async def packets():
+            yield {"event": "token", "data": {"text": "a"}}
+            yield {"event": "token", "data": {"text": "b"}}
+
+        with patch("apps.ai.services.sse_replay.get_async_redis", return_value=redis):
+            events = sse_replay.aproduce("s1", self.user.id, packets())
+            first = await events.__anext__()
+            await events.aclose()  # cliente caiu: a task segue gravando o resto
+            await asyncio.gather(*sse_replay._producers)
+        self.assertEqual(first, (1, "token", {"text": "a"}))
+        ids = [c.kwargs["id"] for c in pipe.xadd.call_args_list]
+        self.assertEqual(ids, ["0-1", "0-2", "0-3"])  # dois tokens e o marcador de fim
+
+    async def test_async_job_stream_relays_until_terminal_status(self):
+        job = await Job.objects.acreate(owner=self.user, kind="ingest", status="running")
+        queue = [{"data": json.dumps({"event": "status", "job_id": str(job.id), "kind": "ingest",
+                                      "status": "succeeded", "result": {"chunks": 3}})}]
+        pubsub = Mock(subscribe=AsyncMock(), aclose=AsyncMock())
+        pubsub.get_message = AsyncMock(side_effect=lambda timeout: queue.pop(0) if queue else None)
+        request = AsyncRequestFactory().get("/api/ai/jobs/stream/", {"job_id": str(job.id)}, headers=self.headers)
+        with patch("apps.ai.async_views.get_async_redis") as redis:
+            redis.return_value.pubsub.return_value = pubsub
+            resp = await AsyncJobStreamView.as_view()(request)
+            body = "".join([chunk.decode() async for chunk in resp.streaming_content])
+        pubsub.subscribe.assert_awaited_once_with(user_channel(self.user.id))
+        self.assertIn('"status": "running"', body)
+        self.assertIn('event: result\ndata: {"job_id": "%s", "chunks": 3}' % job.id, body)
+        pubsub.aclose.assert_awaited_once()
+
+    async def test_async_views_require_authentication(self):
+        request = AsyncRequestFactory().get("/api/ai/jobs/stream/")
+        resp = await AsyncJobStreamView.as_view()(request)
+        self.assertEqual(resp.status_code, 401)
+
+
+class ChatTokenStreamingTest(TestCase):
+    @staticmethod
+    def _chunk(part):
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))])
+
+    def test_text_is_forwarded_per_chunk_and_tool_calls_detected_mid_stream(self):
+        call = types.FunctionCall(name="commit_user_context", args={"persona": "estudante"})
+        rounds = [
+            [self._chunk(types.Part(text="Vou ")), self._chunk(types.Part(text="salvar.")),
+             self._chunk(types.Part(function_call=call))],
+            [self._chunk(types.Part(text="Feito!"))],
+        ]
+        seen = []
+
+        def fake_generate(contents, tools=None, stream=False, session_id=None, call_site="other"):
+            self.assertTrue(stream)
+            self.assertEqual(call_site, "chat")
+            seen.append([c.role for c in contents])
+            return iter(rounds.pop(0))
+
+        with patch("apps.ai.services.chat.generate", side_effect=fake_generate), \
+                patch("apps.ai.services.chat.enqueue_chat_plan", return_value=Mock(id="j1")), \
+                patch("apps.ai.services.tool_engine.handle_tool_call", return_value={"status": "ok"}) as tool:
+            events = list(chat.chat_stream(None, [{"role": "user", "content": "oi"}], "s1"))
+        tokens = [e["data"]["text"] for e in events if e["event"] == "token"]
+        self.assertEqual(tokens, ["Vou ", "salvar.", "Feito!"])
+        tool.assert_called_once_with(None, "commit_user_context", {"persona": "estudante"})
+        # a segunda rodada recebe o turno do modelo (texto + function_call) e a resposta da tool
+        self.assertEqual(seen[1][-2:], ["model", "user"])
+        finished = events[-1]["data"]
+        self.assertEqual(finished["type"], "session_finished")
+        self.assertIsNotNone(finished["ttft_ms"])
+
+    async def test_async_stream_emits_the_same_events_as_the_sync_stream(self):
+        call = types.FunctionCall(name="commit_user_context", args={"persona": "estudante"})
+
+        def rounds():
+            return [
+                [self._chunk(types.Part(text="Vou ")), self._chunk(types.Part(function_call=call))],
+                [self._chunk(types.Part(text="Feito!"))],
+            ]
+
+        sync_rounds, async_rounds = rounds(), rounds()
+
+        async def fake_astream(contents, tools=None, session_id=None, call_site="other"):
+            self.assertEqual(call_site, "chat")
+            for chunk in async_rounds.pop(0):
+                yield chunk
+
+        def shape(events):
+            return [(e["event"], e["data"].get("text") or e["data"].get("stage") or e["data"].get("type"))
+                    for e in events]
+
+        with patch("apps.ai.services.chat.generate", side_effect=lambda *a, **k: iter(sync_rounds.pop(0))), \
+                patch("apps.ai.services.chat.astream", side_effect=fake_astream), \
+                patch("apps.ai.services.chat.enqueue_chat_plan", return_value=Mock(id="j1")), \
+                patch("apps.ai.services.tool_engine.handle_tool_call", return_value={"status": "ok"}) as tool:
+            expected = await sync_to_async(lambda: list(chat.chat_stream(None, [{"role": "user", "content": "oi"}], "s1")))()
+            events = [e async for e in chat.achat_stream(None, [{"role": "user", "content": "oi"}], "s1")]
+        self.assertEqual(shape(events), shape(expected))
+        self.assertEqual([e["data"]["text"] for e in events if e["event"] == "token"], ["Vou ", "Feito!"])
+        self.assertEqual(tool.call_count, 2)
+
+
+class ChatSessionTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        self.client.force_authenticate(self.user)
+        chat_sessions.clear_history_cache()
+
+    def test_turns_are_kept_server_side(self):
+        seen = []
+
+        def fake_chat_once(user, messages, session_id, history=None):
+            seen.append([(c.role, c.parts[0].text) for c in history[1:]])
+            return f"resposta {len(seen)}"
+
+        with patch("apps.ai.services.chat_sessions.chat_once", side_effect=fake_chat_once):
+            first = self.client.post("/api/ai/chat/", {"message": "oi"}, format="json")
+            session_id = first.data["session_id"]
+            second = self.client.post("/api/ai/chat/", {"message": "quero estudar", "session_id": session_id}, format="json")
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data["session_id"], session_id)
+        self.assertEqual(seen[1], [("user", "oi"), ("model", "resposta 1"), ("user", "quero estudar")])
+        self.assertEqual(ChatSession.objects.get(id=session_id).turn_count, 4)
+
+    def test_history_is_served_from_cache_after_each_turn(self):
+        session = chat_sessions.open_session(self.user)
+        chat_sessions.session_history(session)
+        chat_sessions.append_turn(session, "user", "oi")
+        chat_sessions.append_turn(session, "assistant", "ola")
+        with self.assertNumQueries(0):
+            history = chat_sessions.session_history(session)
+        self.assertIs(history[0], chat.SYSTEM_CONTENT)
+        self.assertEqual([c.role for c in history[1:]], ["user", "model"])
+
+    def test_session_of_another_user_is_not_found(self):
+        other = User.objects.create_user(username="outro", email="outro@example.com", password="x")
+        session = ChatSession.objects.create(owner=other)
+        resp = self.client.post("/api/ai/chat/", {"message": "oi", "session_id": str(session.id)}, format="json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_requires_message_or_messages(self):
+        resp = self.client.post("/api/ai/chat/", {}, format="json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChatHistoryCompactionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        chat_sessions.clear_history_cache()
+        self.session = chat_sessions.open_session(self.user)
+        for i in range(10):
+            chat_sessions.append_turn(self.session, "user" if i % 2 == 0 else "assistant", f"turno {i} " + "x" * 400)
+
+    @patch("apps.ai.services.chat_sessions.CHAT_HISTORY_KEEP_TURNS", 4)
+    @patch("apps.ai.services.chat_sessions.CHAT_HISTORY_TOKEN_BUDGET", 500)
+    def test_old_turns_are_folded_into_a_cached_summary(self):
+        with patch("apps.ai.services.chat_sessions.generate", return_value=Mock(text="- persona: estudante")) as gen:
+            self.assertTrue(chat_sessions.compact_history(self.session.id))
+            self.assertFalse(chat_sessions.compact_history(self.session.id))
+        gen.assert_called_once()  # o resumo fica gravado: a janela volta ao orcamento
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary_upto, 6)
+        with patch("apps.ai.services.chat_sessions.generate") as gen:
+            history = chat_sessions.prompt_history(self.session)
+        gen.assert_not_called()
+        self.assertEqual(len(history), 2 + 4)
+        self.assertIn("persona: estudante", history[1].parts[0].text)
+        self.assertTrue(history[-1].parts[0].text.startswith("turno 9"))
+
+    @patch("apps.ai.services.chat_sessions.CHAT_HISTORY_KEEP_TURNS", 4)
+    @patch("apps.ai.services.chat_sessions.CHAT_HISTORY_TOKEN_BUDGET", 500)
+    def test_compaction_runs_after_the_turn_and_skips_the_fallback(self):
+        order = []
+
+        def fake_stream(user, messages, session_id, history=None):
+            order.append("stream")
+            yield {"event": "token", "data": {"text": chat.FALLBACK_REPLY}}
+
+        task = Mock()
+        task.apply_async.side_effect = lambda **kw: order.append("compact")
+        with patch("apps.ai.services.chat_sessions.chat_stream", side_effect=fake_stream), \
+                patch("apps.ai.services.chat_sessions.generate") as gen, \
+                patch("apps.ai.tasks.compact_chat_history_task", task), \
+                self.captureOnCommitCallbacks(execute=True):
+            list(chat_sessions.session_stream(self.user, self.session, "oi"))
+        gen.assert_not_called()  # nada de resumo antes do primeiro token
+        self.assertEqual(order, ["stream", "compact"])
+        self.assertEqual(task.apply_async.call_args.kwargs["args"], [str(self.session.id)])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.turn_count, 11)  # so a mensagem do usuario foi gravada
+        self.assertEqual(self.session.turns.order_by("-index").first().role, "user")
+
+    @patch("apps.ai.services.chat_sessions.CHAT_HISTORY_TOKEN_BUDGET", 100_000)
+    def test_history_under_budget_is_sent_verbatim(self):
+        with patch("apps.ai.services.chat_sessions.generate") as gen:
+            history = chat_sessions.prompt_history(self.session)
+        gen.assert_not_called()
+        self.assertEqual(len(history), 1 + 10)
+
+
+class ToolLoopTest(TestCase):
+    @staticmethod
+    def _chunk(part):
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))])
+
+    def test_equivalent_calls_run_once(self):
+        args = {"persona": "estudante"}
+        calls = [types.FunctionCall(name="commit_user_context", args=args),
+                 types.FunctionCall(name="commit_study_context", args=args)]
+        with patch("apps.ai.services.tool_engine.handle_tool_call", return_value={"status": "ok"}) as tool:
+            results = tool_engine.run_tool_calls(None, calls)
+        tool.assert_called_once()
+        self.assertEqual([r[0].name for r in results], ["commit_user_context", "commit_study_context"])
+        self.assertEqual([r[1] for r in results], [{"status": "ok"}] * 2)
+
+    def test_independent_calls_run_concurrently_within_the_round_timeout(self):
+        import time
+
+        def slow(user, name, args):
+            time.sleep(0.1 if name == "a" else 2)
+            return {"status": "ok", "tool": name}
+
+        calls = [types.FunctionCall(name="a", args={}), types.FunctionCall(name="b", args={})]
+        with patch("apps.ai.services.tool_engine.handle_tool_call", side_effect=slow), \
+                patch("apps.ai.services.tool_engine.close_old_connections"):
+            started = time.monotonic()
+            results = tool_engine.run_tool_calls(None, calls, timeout=0.5)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(results[0][1], {"status": "ok", "tool": "a"})
+        self.assertIsInstance(results[1][2], TimeoutError)
+
+    def test_real_tool_finishing_after_the_timeout_reports_its_write(self):
+        import time
+
+        user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+
+        def slow_commit(user, name, args):
+            time.sleep(0.3)
+            return handle_tool_call(user, name, args)
+
+        # a escrita termina depois do prazo: o modelo ouve o que ficou no banco, nao um timeout
+        calls = [types.FunctionCall(name="commit_user_context", args={
+            "persona": "student", "goal": "ENEM", "deadline": "2030-12-31", "weekly_time_hours": 10, "consent_lgpd": True,
+        })]
+        with patch("apps.ai.services.tool_engine.handle_tool_call", side_effect=slow_commit):
+            results = tool_engine.run_tool_calls(user, calls, timeout=0.1)
+        self.assertIsNone(results[0][2])
+        self.assertEqual(results[0][1]["status"], "ok")
+        self.assertEqual(str(StudyContext.objects.get(user=user).id), results[0][1]["study_context_id"])
+
+    def test_pooled_call_finishing_after_the_timeout_is_not_observed(self):
+        import threading
+
+        finished = threading.Event()
+
+        def late(user, name, args):
+            finished.wait(0.3)
+            return {"status": "ok"}
+
+        calls = [types.FunctionCall(name="a", args={})]
+        with patch("apps.ai.services.tool_engine.handle_tool_call", side_effect=late), \
+                patch("apps.ai.services.tool_engine.close_old_connections"):
+            results = tool_engine.run_tool_calls(None, calls, timeout=0.05)
+            finished.set()
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[0][2], TimeoutError)
+
+    @patch("apps.ai.services.tool_engine.TOOL_MAX_ROUNDS", 2)
+    def test_stream_stops_calling_tools_after_max_rounds(self):
+        call = types.FunctionCall(name="commit_user_context", args={})
+        seen_tools = []
+
+        def looping_model(contents, tools=None, stream=False, session_id=None, call_site="other"):
+            seen_tools.append(tools)
+            if tools is None:
+                return iter([self._chunk(types.Part(text="Resumo final"))])
+            return iter([self._chunk(types.Part(function_call=call))])
+
+        with patch("apps.ai.services.chat.generate", side_effect=looping_model), \
+                patch("apps.ai.services.tool_engine.handle_tool_call", return_value={"status": "error"}):
+            events = list(chat.chat_stream(None, [{"role": "user", "content": "oi"}], "s1"))
+        # status nao-ok do commit encerra o turno na primeira rodada
+        self.assertEqual(events[-1]["data"]["error"]["tool"], "commit_user_context")
+
+        with patch("apps.ai.services.chat.generate", side_effect=looping_model), \
+                patch("apps.ai.services.chat.enqueue_chat_plan", return_value=Mock(id="j1")), \
+                patch("apps.ai.services.tool_engine.handle_tool_call", return_value={"status": "ok", "study_context_id": "c1"}):
+            seen_tools.clear()
+            events = list(chat.chat_stream(None, [{"role": "user", "content": "oi"}], "s1"))
+        rounds = [e["data"] for e in events if e["event"] == "heartbeat" and e["data"]["stage"] == "tool_round"]
+        self.assertEqual([r["round"] for r in rounds], [1, 2])
+        self.assertTrue(rounds[-1]["final"])
+        self.assertIsNone(seen_tools[2])  # a ultima rodada vai sem tools
+
+
+class ChatPlanJobTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="x")
+        self.context = StudyContext.objects.create(
+            user=self.user, persona="student", goal="ENEM", deadline=date(2030, 12, 31),
+            weekly_time_hours=10, consent_lgpd=True,
+        )
+
+    @staticmethod
+    def _chunk(part):
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))])
+
+    def test_commit_ends_chat_stream_with_plan_job(self):
+        call = types.FunctionCall(name="commit_user_context", args={"goal": "ENEM"})
+        rounds = [[self._chunk(types.Part(function_call=call))], [self._chunk(types.Part(text="Contexto salvo!"))]]
+        task = Mock()
+        with patch("apps.ai.services.chat.generate", side_effect=lambda **kw: iter(rounds.pop(0))), \
+                patch("apps.ai.services.tool_engine.handle_tool_call",
+                      return_value={"status": "ok", "study_context_id": str(self.context.id)}), \
+                patch("apps.ai.tasks.generate_chat_plan_task", task), \
+                self.captureOnCommitCallbacks(execute=True):
+            events = list(chat.chat_stream(self.user, [{"role": "user", "content": "confirmo"}], "s1"))
+        self.assertEqual(rounds, [])  # nenhuma chamada ao modelo para o plano dentro do chat
+        job = Job.objects.get(owner=self.user, kind="chat_plan")
+        enqueued = [e["data"] for e in events if e["data"].get("type") == "plan_generation_enqueued"]
+        self.assertEqual(enqueued[0]["job_id"], str(job.id))
+        self.assertEqual(events[-1]["data"]["job_id"], str(job.id))
+        kwargs = task.apply_async.call_args.kwargs
+        self.assertEqual((kwargs["queue"], kwargs["task_id"]), ("ai_generation", str(job.id)))
+        job_id, context_id, history = kwargs["args"]
+        self.assertEqual(context_id, str(self.context.id))
+        self.assertEqual(history[0]["parts"][0]["text"], "confirmo")
+
+    def test_plan_job_publishes_tokens_and_keeps_full_text(self):
+        from apps.ai.tasks import generate_chat_plan_task
+        from apps.ai.views import _job_message_events
+
+        job = create_job(self.user, "chat_plan")
+        history = [chat.make_turn("user", "confirmo").model_dump(mode="json", exclude_none=True)]
+        fake = Mock()
+        chunks = [self._chunk(types.Part(text="Semana 1")), self._chunk(types.Part(text=": revisao"))]
+        with patch("apps.ai.services.chat.generate", return_value=iter(chunks)), \
+                patch("apps.ai.services.jobs.get_redis", return_value=fake), \
+                self.captureOnCommitCallbacks(execute=True):
+            result = generate_chat_plan_task.run(str(job.id), str(self.context.id), history)
+        self.assertEqual(result["plan_text"], "Semana 1: revisao")
+        self.assertTrue(StudyPlan.objects.filter(user_context=self.context).exists())
+        messages = [c.args[1] for c in fake.publish.call_args_list]
+        tokens = [m for m in messages if json.loads(m)["event"] == "token"]
+        self.assertEqual(len(tokens), 2)
+        events, done = _job_message_events(tokens[0], str(job.id))
+        self.assertTrue(events[0].startswith("event: token"))
+        self.assertFalse(done)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "succeeded")
+
+
+class LLMResponseCacheTest(TestCase):
+    def setUp(self):
+        llm_cache.reset_stats()
+        self.contents = [types.Content(role="user", parts=[types.Part(text="Gere o outline")])]
+
+    @staticmethod
+    def _response(text):
+        return types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text=text)])
+        )])
+
+    def test_key_depends_on_model_contents_and_schema(self):
+        same = [types.Content(role="user", parts=[types.Part(text="Gere o outline")])]
+        key = llm_cache.cache_key("m", self.contents, {"type": "object"})
+        self.assertEqual(key, llm_cache.cache_key("m", same, {"type": "object"}))
+        self.assertNotEqual(key, llm_cache.cache_key("m", self.contents, {"type": "array"}))
+        self.assertNotEqual(key, llm_cache.cache_key("outro", self.contents, {"type": "object"}))
+
+    def test_fake_backends_use_their_own_keys_and_index(self):
+        keys = {}
+        for backend in llm_backend.BACKENDS:
+            with patch.object(llm_backend, "AI_LLM_BACKEND", backend):
+                keys[backend] = (llm_cache.cache_key("m", self.contents), llm_cache._index())
+        # record grava respostas reais: divide o cache com o gemini
+        self.assertEqual(keys["record"], keys["gemini"])
+        self.assertEqual(len({keys["gemini"], keys["replay"], keys["synthetic"]}), 3)
+        self.assertTrue(keys["synthetic"][0].startswith("ai:llm_cache:synthetic:"))
+
+    def test_hit_skips_the_network_and_refresh_bypasses_it(self):
+        cached = self._response('{"plan": 1}')
+        fresh = self._response('{"plan": 2}')
+        with patch.object(ai_client, "get_client") as get_client, \
+                patch("apps.ai.services.llm_cache.lookup", return_value=cached) as lookup, \
+                patch("apps.ai.services.llm_cache.store") as store:
+            api = get_client.return_value
+            api.models.generate_content.return_value = fresh
+            self.assertIs(ai_client.generate(self.contents, schema={"type": "object"}, cache=True), cached)
+            api.models.generate_content.assert_not_called()
+
+            resp = ai_client.generate(self.contents, schema={"type": "object"}, cache=True, refresh=True)
+        self.assertIs(resp, fresh)
+        lookup.assert_called_once()
+        store.assert_called_once()
+        self.assertEqual(llm_cache.cache_stats()["bypassed"], 1)
+
+    def test_invalid_structured_response_is_not_stored(self):
+        fake = Mock()
+        with patch("apps.ai.services.llm_cache.get_redis", return_value=fake):
+            llm_cache.store("k", self._response("nao e json"), schema={"type": "object"})
+        fake.pipeline.assert_not_called()
+
+    def test_hit_round_trips_the_response(self):
+        fake = Mock()
+        fake.get.return_value = self._response('{"plan": 1}').model_dump_json(exclude_none=True)
+        with patch("apps.ai.services.llm_cache.get_redis", return_value=fake):
+            resp = llm_cache.lookup("k")
+        self.assertEqual(json.loads(resp.text), {"plan": 1})
+        self.assertEqual(llm_cache.cache_stats()["hit_rate"], 1.0)
+
+    def test_track_counts_only_lookups_inside_the_block(self):
+        fake = Mock()
+        fake.get.side_effect = [None, self._response('{"plan": 1}').model_dump_json(exclude_none=True), None]
+        with patch("apps.ai.services.llm_cache.get_redis", return_value=fake):
+            llm_cache.lookup("antes")  # outro job do mesmo processo
+            with llm_cache.track() as usage:
+                llm_cache.lookup("k")
+                llm_cache.lookup("k2")
+        self.assertEqual(usage, {"hits": 1, "misses": 1})
+        self.assertEqual(llm_cache.cache_stats()["misses"], 2)
+
+
+class LLMRateLimitTest(TestCase):
+    def setUp(self):
+        rate_limit.reset_limiters()
+
+    @staticmethod
+    def _throttle():
+        from google.genai import errors
+        return errors.APIError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+
+    def test_aimd_grows_on_success_and_halves_on_throttle(self):
+        lim = rate_limit.AIMDLimiter(initial=4, minimum=1, maximum=8)
+        for _ in range(4):
+            lim.acquire(deadline=float("inf"))
+            lim.release(0.1)
+        self.assertGreater(lim.limit, 4.5)
+        grown = lim.limit
+        lim.acquire(deadline=float("inf"))
+        lim.release(None, throttled=True)
+        self.assertAlmostEqual(lim.limit, grown * rate_limit.LLM_AIMD_BACKOFF)
+
+    def test_latency_spike_is_measured_per_call_site(self):
+        lim = rate_limit.AIMDLimiter(initial=4, minimum=1, maximum=8)
+        for _ in range(3):
+            lim.acquire(deadline=float("inf"))
+            lim.release(0.2, call_site="chat_summary")
+        grown = lim.limit
+        # um outline e sempre mais lento que um resumo: nao e pico, a janela segue crescendo
+        lim.acquire(deadline=float("inf"))
+        lim.release(5.0, call_site="outline")
+        self.assertGreater(lim.limit, grown)
+        self.assertEqual(lim.stats["spikes"], 0)
+        lim.acquire(deadline=float("inf"))
+        lim.release(5.0, call_site="chat_summary")
+        self.assertEqual(lim.stats["spikes"], 1)
+        self.assertLess(lim.limit, grown)
+
+    def test_full_window_waits_until_deadline(self):
+        import time
+
+        lim = rate_limit.AIMDLimiter(initial=1, minimum=1, maximum=1)
+        lim.acquire(deadline=float("inf"))
+        with self.assertRaises(rate_limit.RateLimitTimeout):
+            lim.acquire(deadline=time.monotonic() + 0.05)
+        self.assertEqual(lim.stats["timeouts"], 1)
+
+    @patch("apps.ai.services.rate_limit.LLM_BACKOFF_BASE_S", 0.01)
+    def test_throttled_call_is_retried_with_a_smaller_window(self):
+        fn = Mock(side_effect=[self._throttle(), "ok"])
+        with patch("apps.ai.services.rate_limit._bucket", return_value=0):
+            self.assertEqual(rate_limit.guard("generate", 10, fn), "ok")
+        self.assertEqual(fn.call_count, 2)
+        stats = rate_limit.limiter_stats()["generate"]
+        self.assertEqual(stats["throttled"], 1)
+        self.assertLess(stats["limit"], rate_limit.LLM_AIMD_INITIAL)
+
+    def test_empty_bucket_queues_then_gives_up_at_deadline(self):
+        with patch("apps.ai.services.rate_limit._bucket", side_effect=[50, 0]), \
+                patch("apps.ai.services.rate_limit.time.sleep") as sleep:
+            self.assertEqual(rate_limit.guard("embed", 10, lambda: "ok"), "ok")
+        sleep.assert_called_once()
+        with patch("apps.ai.services.rate_limit._bucket", return_value=120_000):
+            with self.assertRaises(rate_limit.RateLimitTimeout):
+                rate_limit.guard("embed", 10, lambda: "ok", wait_s=1)
+
+    def test_open_stream_frees_the_window_after_first_chunk(self):
+        rate_limit._limiters["generate"] = rate_limit.AIMDLimiter(initial=1, minimum=1, maximum=1)
+        with patch("apps.ai.services.rate_limit._bucket", return_value=0) as bucket:
+            first = rate_limit.guard_stream("generate", 10, lambda: iter(["a", "b"]))
+            self.assertEqual(next(first), "a")
+            # a primeira conversa segue aberta e a segunda nao espera por ela
+            second = rate_limit.guard_stream("generate", 10, lambda: iter(["c"]), wait_s=0.05)
+            self.assertEqual(list(second), ["c"])
+            self.assertEqual(list(first), ["b"])
+        self.assertEqual(bucket.call_count, 2)  # o balde global continua valendo para cada stream
+        self.assertEqual(rate_limit.limiter_stats()["generate"]["in_flight"], 0)
+
+    async def test_async_stream_frees_the_window_after_first_chunk(self):
+        rate_limit._limiters["generate"] = rate_limit.AIMDLimiter(initial=1, minimum=1, maximum=1)
+
+        def stream(*items):
+            async def gen():
+                for item in items:
+                    yield item
+            return AsyncMock(return_value=gen())
+
+        with patch("apps.ai.services.rate_limit._abucket", AsyncMock(return_value=0)):
+            first = rate_limit.aguard_stream("generate", 10, stream("a", "b"))
+            self.assertEqual(await first.__anext__(), "a")
+            second = [c async for c in rate_limit.aguard_stream("generate", 10, stream("c"), wait_s=0.05)]
+            self.assertEqual(second, ["c"])
+            self.assertEqual([c async for c in first], ["b"])
+        self.assertEqual(rate_limit.limiter_stats()["generate"]["in_flight"], 0)
+
+
+class GenaiAsyncClientTest(TestCase):
+    def test_generation_and_embeddings_share_one_lazy_client(self):
+        with patch.object(genai_client, "_client", None), \
+                patch("apps.ai.services.genai_client.genai.Client") as factory:
+            first = genai_client.get_client()
+            self.assertIs(genai_client.get_client(), first)
+        factory.assert_called_once()
+        options = factory.call_args.kwargs["http_options"]
+        self.assertEqual(options.async_client_args["limits"].max_connections, genai_client.GEMINI_HTTP_MAX_CONNECTIONS)
+
+    async def test_agenerate_keeps_calls_in_flight_concurrently(self):
+        import asyncio
+
+        running = []
+        peak = []
+
+        async def fake_generate(**kwargs):
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+            return types.GenerateContentResponse(candidates=[types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(text="ok")])
+            )])
+
+        aio = Mock()
+        aio.models.generate_content = fake_generate
+        with patch("apps.ai.client.get_async_client", return_value=aio), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False):
+            responses = await asyncio.gather(*(ai_client.agenerate(["oi"]) for _ in range(4)))
+        self.assertEqual([r.text for r in responses], ["ok"] * 4)
+        self.assertEqual(max(peak), 4)
+
+    async def test_aembed_batches_misses_through_the_async_client(self):
+        async def fake_request(texts):
+            return [[float(len(t))] for t in texts]
+
+        embedding.reset_cache()
+        with patch.object(embedding, "EMBED_CACHE_DB", False), \
+                patch.object(embedding, "EMBED_BATCH_MAX_ITEMS", 2), \
+                patch.object(embedding, "_aembed_request", side_effect=fake_request) as request:
+            vectors = await embedding.aembed(["a", "bb", "a", "ccc", "dddd"])
+        self.assertEqual(vectors, [[1.0], [2.0], [1.0], [3.0], [4.0]])
+        self.assertEqual(request.call_count, 2)
+
+    @patch("apps.ai.services.embedding.EMBED_BACKOFF_BASE_S", 0.01)
+    @patch("apps.ai.services.llm_metrics.LLM_METRICS_REDIS", False)
+    async def test_async_embed_retries_on_the_same_schedule(self):
+        import httpx
+
+        aio = Mock()
+        aio.models.embed_content = AsyncMock(side_effect=[
+            httpx.ReadTimeout("lento"), types.EmbedContentResponse(embeddings=[types.ContentEmbedding(values=[0.5])]),
+        ])
+        with patch("apps.ai.services.embedding.get_async_client", return_value=aio), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False), \
+                patch("apps.ai.services.embedding.asyncio.sleep", new_callable=AsyncMock) as sleep:
+            self.assertEqual(await embedding._aembed_request(["oi"]), [[0.5]])
+            aio.models.embed_content.side_effect = [ValueError("entrada invalida")]
+            with self.assertRaises(ValueError):
+                await embedding._aembed_request(["oi"])
+        sleep.assert_awaited_once()
+        self.assertLessEqual(sleep.await_args.args[0], 0.01)
+
+
+class LLMBackendTest(TestCase):
+    def _synthetic(self):
+        return llm_backend.build_client(Mock(side_effect=AssertionError("sem rede")), backend="synthetic")
+
+    def test_synthetic_embeddings_are_deterministic_unit_vectors(self):
+        client = self._synthetic()
+        with patch("apps.ai.services.llm_backend.time.sleep"):
+            first = client.models.embed_content(model="m", contents=["a", "b"], config=types.EmbedContentConfig(output_dimensionality=64))
+            again = client.models.embed_content(model="m", contents=["b"], config=types.EmbedContentConfig(output_dimensionality=64))
+        a, b = (e.values for e in first.embeddings)
+        self.assertEqual(len(a), 64)
+        self.assertAlmostEqual(sum(x * x for x in a), 1.0, places=6)
+        self.assertEqual(again.embeddings[0].values, b)
+        self.assertNotEqual(a, b)
+
+    def test_synthetic_generate_answers_with_json_matching_the_schema(self):
+        schema = {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "weeks": {"type": "array", "items": {"type": "object", "properties": {
+                    "index": {"type": "integer"},
+                    "level": {"type": "string", "enum": ["easy", "hard"]},
+                }}},
+            },
+        }
+        with patch("apps.ai.services.genai_client._client", self._synthetic()), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False), \
+                patch("apps.ai.services.llm_backend.time.sleep") as sleep:
+            resp = ai_client.generate(["plano"], schema=schema)
+        data = json.loads(resp.text)
+        self.assertEqual(data["title"], "title-1")
+        self.assertEqual([w["index"] for w in data["weeks"]], [1, 2])
+        self.assertEqual(data["weeks"][0]["level"], "easy")
+        self.assertGreater(resp.usage_metadata.total_token_count, 0)
+        sleep.assert_called_once()
+
+    def test_synthetic_stream_follows_configured_cadence(self):
+        with patch.object(llm_backend, "AI_FAKE_TTFT", "fixed:300"), \
+                patch.object(llm_backend, "AI_FAKE_CHUNK_INTERVAL", "fixed:20"), \
+                patch.object(llm_backend, "AI_FAKE_OUTPUT_WORDS", 10), \
+                patch.object(llm_backend, "AI_FAKE_CHUNK_WORDS", 4), \
+                patch("apps.ai.services.genai_client._client", self._synthetic()), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False), \
+                patch("apps.ai.services.llm_backend.time.sleep") as sleep:
+            pieces = list(ai_client.stream_text(["oi"]))
+        self.assertEqual(len(pieces), 3)
+        self.assertEqual(len("".join(pieces).split()), 10)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.3, 0.02, 0.02])
+
+    def test_recorded_calls_replay_without_the_real_client(self):
+        import tempfile
+
+        real = Mock()
+        real.models.generate_content.return_value = types.GenerateContentResponse(candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text="gravado")])
+        )])
+        real.models.generate_content_stream.return_value = iter([
+            types.GenerateContentResponse(candidates=[types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(text=t)])
+            )]) for t in ("um ", "dois")
+        ])
+        with tempfile.TemporaryDirectory() as tmp, patch.object(llm_backend, "AI_LLM_CASSETTE_DIR", tmp):
+            recorder = llm_backend.build_client(lambda: real, backend="record")
+            recorder.models.generate_content(model="m", contents=["oi"])
+            list(recorder.models.generate_content_stream(model="m", contents=["conte"]))
+
+            replay = llm_backend.build_client(Mock(side_effect=AssertionError("sem rede")), backend="replay")
+            with patch("apps.ai.services.llm_backend.time.sleep"):
+                self.assertEqual(replay.models.generate_content(model="m", contents=["oi"]).text, "gravado")
+                chunks = [c.text for c in replay.models.generate_content_stream(model="m", contents=["conte"])]
+                self.assertEqual(chunks, ["um ", "dois"])
+                with self.assertRaises(LookupError):
+                    replay.models.generate_content(model="m", contents=["inedito"])
+
+    async def test_async_facade_sleeps_on_the_event_loop(self):
+        client = self._synthetic()
+        with patch.object(llm_backend, "AI_FAKE_CHUNK_WORDS", 1000), \
+                patch("apps.ai.services.llm_backend.asyncio.sleep", new_callable=AsyncMock) as sleep:
+            stream = await client.aio.models.generate_content_stream(model="m", contents=["oi"])
+            chunks = [c async for c in stream]
+            resp = await client.aio.models.embed_content(model="m", contents=["oi"])
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(len(resp.embeddings[0].values), llm_backend.EMBED_DIM)
+        self.assertEqual(sleep.await_count, 2)
+
+
+class LLMMetricsTest(TestCase):
+    def setUp(self):
+        llm_metrics.reset_metrics()
+        rate_limit.reset_limiters()
+        patcher = patch.object(llm_metrics, "LLM_METRICS_REDIS", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _response(text="ok", prompt=120, output=30):
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt, candidates_token_count=output, total_token_count=prompt + output,
+            ),
+        )
+
+    @patch("apps.ai.services.rate_limit.LLM_BACKOFF_BASE_S", 0.01)
+    def test_generate_records_call_site_usage_and_retries(self):
+        from google.genai import errors
+
+        throttle = errors.APIError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+        client = Mock()
+        client.models.generate_content.side_effect = [throttle, self._response()]
+        with patch("apps.ai.client.get_client", return_value=client), \
+                patch("apps.ai.services.rate_limit._bucket", return_value=0):
+            ai_client.generate(["oi"], call_site="day")
+        series = llm_metrics.local_snapshot()
+        model = ai_client.CHAT_MODEL or ""
+        self.assertEqual(series[("llm_calls_total", "day", model)], 1)
+        self.assertEqual(series[("llm_retries_total", "day", model)], 1)
+        self.assertEqual(series[("llm_prompt_tokens", "day", model)]["sum"], 120)
+        self.assertEqual(series[("llm_output_tokens", "day", model)]["sum"], 30)
+        self.assertEqual(series[("llm_call_latency_ms", "day", model)]["count"], 1)
+
+    def test_cache_hit_is_counted_without_a_latency_sample(self):
+        with patch("apps.ai.services.llm_cache.LLM_CACHE_ENABLED", True), \
+                patch("apps.ai.services.llm_cache.lookup", return_value=self._response()), \
+                patch("apps.ai.client.get_client") as get_client:
+            ai_client.generate(["oi"], schema={"type": "object"}, cache=True, call_site="outline")
+        get_client.assert_not_called()
+        series = llm_metrics.local_snapshot()
+        self.assertEqual(series[("llm_cache_hits_total", "outline", ai_client.CHAT_MODEL or "")], 1)
+        self.assertNotIn(("llm_call_latency_ms", "outline", ai_client.CHAT_MODEL or ""), series)
+
+    def test_stream_records_time_to_first_chunk(self):
+        with patch.object(llm_backend, "AI_FAKE_TTFT", "fixed:30"), \
+                patch.object(llm_backend, "AI_FAKE_CHUNK_INTERVAL", "fixed:0"), \
+                patch.object(llm_backend, "AI_FAKE_OUTPUT_WORDS", 4), \
+                patch.object(llm_backend, "AI_FAKE_CHUNK_WORDS", 2), \
+                patch("apps.ai.services.genai_client._client", llm_backend.build_client(Mock(), backend="synthetic")), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False):
+            list(ai_client.stream_text(["oi"], call_site="chat"))
+        hist = llm_metrics.local_snapshot()[("llm_stream_ttft_ms", "chat", ai_client.CHAT_MODEL or "")]
+        self.assertEqual(hist["count"], 1)
+        self.assertGreaterEqual(hist["sum"], 30)
+
+    def test_failed_embedding_counts_an_error(self):
+        client = Mock()
+        client.models.embed_content.side_effect = ValueError("schema")
+        with patch("apps.ai.services.embedding.get_client", return_value=client), \
+                patch("apps.ai.services.rate_limit.LLM_RATE_LIMIT_ENABLED", False), \
+                self.assertRaises(ValueError):
+            embedding._embed_request(["a"])
+        series = llm_metrics.local_snapshot()
+        self.assertEqual(series[("llm_errors_total", "embedding", embedding.EMBED_MODEL)], 1)
+        self.assertEqual(series[("llm_prompt_tokens", "embedding", embedding.EMBED_MODEL)]["count"], 1)
+
+    def test_prometheus_text_accumulates_buckets(self):
+        for ms in (40, 300, 90000):
+            trace = llm_metrics.CallTrace("section", "m")
+            trace.started -= ms / 1000
+            trace.finish()
+        text = llm_metrics.render_prometheus(llm_metrics.local_snapshot())
+        self.assertIn('llm_calls_total{site="section",model="m"} 3', text)
+        self.assertIn('llm_call_latency_ms_bucket{site="section",model="m",le="50"} 1', text)
+        self.assertIn('llm_call_latency_ms_bucket{site="section",model="m",le="500"} 2', text)
+        self.assertIn('llm_call_latency_ms_bucket{site="section",model="m",le="+Inf"} 3', text)
+        self.assertIn("# TYPE llm_stream_ttft_ms histogram", text)
+
+
+class LLMMetricsViewTest(APITestCase):
+    def setUp(self):
+        llm_metrics.reset_metrics()
+        patcher = patch.object(llm_metrics, "LLM_METRICS_REDIS", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.staff = User.objects.create_user(username="ops", email="ops@example.com", password="ops", is_staff=True)
+        self.user = User.objects.create_user(username="aluno", email="aluno@example.com", password="aluno")
+        llm_metrics.CallTrace("chat", "m").finish()
+
+    def test_metrics_are_staff_only_or_scraper_token(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get("/api/ai/metrics/?scope=local").status_code, 403)
+        self.client.force_authenticate(None)
+        with patch.object(llm_metrics, "LLM_METRICS_TOKEN", "segredo"):
+            resp = self.client.get("/api/ai/metrics/?scope=local", HTTP_X_METRICS_TOKEN="segredo")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_non_ascii_token_is_denied(self):
+        with patch.object(llm_metrics, "LLM_METRICS_TOKEN", "segredo"):
+            resp = self.client.get("/api/ai/metrics/?scope=local", HTTP_X_METRICS_TOKEN="segrêdo")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_staff_gets_prometheus_text(self):
+        self.client.force_authenticate(self.staff)
+        with patch("apps.ai.services.llm_metrics.get_redis", side_effect=ConnectionError("redis fora")):
+            resp = self.client.get("/api/ai/metrics/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain"))
+        self.assertIn('llm_call_latency_ms_count{site="chat",model="m"} 1', resp.content.decode())
+
+    def test_response_cache_counters_come_from_all_processes(self):
+        self.client.force_authenticate(self.staff)
+        with patch("apps.ai.services.llm_metrics.global_snapshot", return_value={}), \
+                patch("apps.ai.services.llm_cache.global_stats", return_value={"hits": 3, "misses": 1, "hit_rate": 0.75}):
+            body = self.client.get("/api/ai/metrics/").content.decode()
+        self.assertIn('llm_response_cache_lookups_total{result="hit"} 3', body)
+        self.assertIn("llm_response_cache_hit_ratio 0.75", body)
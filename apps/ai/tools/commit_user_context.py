@@ -6,7 +6,6 @@ from django.utils import timezone
 from google.genai import types
 
 from apps.accounts.serializers import StudyContextSerializer
-from apps.ai.services.plan_outline import ensure_plan_outline
 from collections.abc import Mapping
 
 
@@ -86,6 +85,8 @@ STUDY_CONTEXT_SCHEMA = {
 
 
 _TOOL_NAMES = ("commit_study_context", "commit_user_context")
+# recurso que cada tool grava: chamadas no mesmo recurso nunca rodam em paralelo
+TOOL_RESOURCES = {name: "study_context" for name in _TOOL_NAMES}
 
 
 def function_declarations() -> list[types.FunctionDeclaration]:
@@ -171,8 +172,8 @@ def handle_tool_call(user, name: str, args: dict) -> dict:
     instance = getattr(user, "study_context", None)
     ser = StudyContextSerializer(instance=instance, data=normalized_args, partial=True)
     ser.is_valid(raise_exception=True)
+    # o outline do plano (select_for_update) fica no job pos-commit, fora da requisicao do chat
     obj = ser.save(user=user)
-    ensure_plan_outline(obj)
     return {
         "status": "ok",
         "study_context_id": str(obj.id),
@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+from .async_views import AsyncChatSSEView, AsyncChatSSEResumeView, AsyncJobStreamView
 from .views import (
     IndexDocumentView,
     SearchView,
     ChatView,
     ChatSSEView,
+    ChatSSEResumeView,
     StudyPlanListView,
     GenerateStudyPlanView,
     StudyPlanDetailView,
@@ -14,15 +18,28 @@ from .views import (
     StudyPlanDayCreateView,
     StudyDayResultView,
     StudyPlanMaterialUploadView,
+    JobListView,
     JobStatusView,
     JobStreamView,
+    LLMMetricsView,
 )
 
+# Sob ASGI os streams SSE usam as views async; sob WSGI (runserver, testes) as sync.
+if settings.AI_ASYNC_SSE:
+    chat_stream_view = csrf_exempt(AsyncChatSSEView.as_view())
+    chat_stream_resume_view = AsyncChatSSEResumeView.as_view()
+    job_stream_view = AsyncJobStreamView.as_view()
+else:
+    chat_stream_view = ChatSSEView.as_view()
+    chat_stream_resume_view = ChatSSEResumeView.as_view()
+    job_stream_view = JobStreamView.as_view()
+
 urlpatterns = [
     path("index/", IndexDocumentView.as_view()),
     path("search/", SearchView.as_view()),
     path('chat/', ChatView.as_view(), name='ai_chat'),
-    path('chat/stream/', ChatSSEView.as_view(), name='ai_chat_stream'),
+    path('chat/stream/', chat_stream_view, name='ai_chat_stream'),
+    path('chat/stream/<uuid:session_id>/', chat_stream_resume_view, name='ai_chat_stream_resume'),
     path("study-plans/", StudyPlanListView.as_view(), name="study_plan_list"),
     path("study-plans/generate/", GenerateStudyPlanView.as_view(), name="generate_study_plan"),
     path("study-plans/<uuid:plan_id>/", StudyPlanDetailView.as_view(), name="study_plan_detail"),
@@ -33,6 +50,8 @@ urlpatterns = [
     path("study-plans/<uuid:plan_id>/tasks/", GenerateSectionTasksView.as_view(), name="study_plan_tasks"),
     path("study-plans/<uuid:plan_id>/materials/", StudyPlanMaterialUploadView.as_view(), name="study_plan_material"),
     path("study-tasks/<uuid:task_id>/progress/", StudyTaskProgressView.as_view(), name="study_task_progress"),
-    path("jobs/<str:job_id>/", JobStatusView.as_view(), name="job_status"),
-    path("jobs/stream/", JobStreamView.as_view(), name="job_stream"),
+    path("jobs/", JobListView.as_view(), name="job_list"),
+    path("jobs/stream/", job_stream_view, name="job_stream"),
+    path("jobs/<uuid:job_id>/", JobStatusView.as_view(), name="job_status"),
+    path("metrics/", LLMMetricsView.as_view(), name="llm_metrics"),
 ]
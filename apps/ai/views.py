@@ -1,3 +1,4 @@
+import hmac
 import uuid
 import json
 import logging
@@ -10,13 +11,12 @@ from rest_framework import status, permissions
 from django.db import transaction
 from django.db.models import Max
 from django.utils import timezone
-from django.http import StreamingHttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiTypes
-from celery.result import AsyncResult
 
-from setup.celery import app as celery_app
+from setup.celery import app as celery_app  # noqa: F401 - configura o app Celery (broker) no processo web
 from apps.accounts.models import StudyPlan, StudyDay, StudyTask, FileRef
-from .models import Document, Chunk
+from .models import Document
 from .serializers import (
     DocumentIngestSerializer,
     ChatRequestSerializer,
@@ -41,8 +41,22 @@ from .serializers import (
     StudyDayResultSerializer,
 )
 from .services.chat import chat_once, chat_stream
-from .services.embedding import embed_batch
-from .services.search import semantic_search
+from .services.chat_sessions import open_session, session_reply, session_stream
+from .services.chunking import iter_chunks
+from .services import llm_cache, llm_metrics
+from .services.jobs import (
+    MAX_BULK_IDS,
+    TERMINAL_STATUSES,
+    create_job,
+    enqueue,
+    ingest_is_stale,
+    user_channel,
+    user_jobs,
+)
+from .services.redis_client import blocking_wait, get_redis
+from .services.sse_replay import produce, replay, session_owner
+from .services.ingest import ingest_chunks, reingest_chunks
+from .services.search import semantic_search, SEARCH_MODES
 from .tasks import (
     generate_study_plan_task,
     generate_study_day_task,
@@ -61,45 +75,43 @@ def _log_api_event(event: str, **payload):
         logger.info("%s | %s", event, payload)
 
 
-def simple_chunk(text: str, max_chars=1200):
-    parts, buf, count = [], [], 0
-    for line in text.splitlines():
-        if count + len(line) > max_chars:
-            parts.append("\n".join(buf)); buf, count = [], 0
-        buf.append(line); count += len(line)
-    if buf: parts.append("\n".join(buf))
-    return parts
-
-
 class IndexDocumentView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     @extend_schema(
         operation_id="indexDocument",
         request=DocumentIngestSerializer,
-        responses={201: DocumentIngestResponseSerializer, 400: DocumentIngestSerializer},
-        description="Ingests a document, chunks it, embeds the chunks, and stores them."
+        responses={200: DocumentIngestResponseSerializer, 201: DocumentIngestResponseSerializer, 400: DocumentIngestSerializer},
+        description="Ingests a document, chunks it, embeds the chunks, and stores them. "
+                    "If `id` points to an existing document, re-ingests it incrementally (only changed chunks are embedded)."
     )
     @transaction.atomic
     def post(self, request):
         s = DocumentIngestSerializer(data=request.data)
         s.is_valid(raise_exception=True)
+        doc_id = s.validated_data.get("id")
+        doc = Document.objects.filter(id=doc_id).first() if doc_id else None
+        if doc is not None:
+            if doc.owner_id != request.user.id:
+                return Response({"detail": "Documento nao encontrado."}, status=404)
+            # nova versao de um documento existente: so os chunks alterados sao embedados
+            doc.title = s.validated_data["title"]
+            doc.save(update_fields=["title"])
+            stats = reingest_chunks(doc, iter_chunks([s.validated_data["text"]]))
+            return Response(
+                {"document_id": str(doc.id), "chunks": stats["chunks"],
+                 "reused": stats["reused"], "added": stats["added"], "removed": stats["removed"]},
+                status=status.HTTP_200_OK,
+            )
         doc = Document.objects.create(
-            id=s.validated_data.get("id") or uuid.uuid4(),
+            id=doc_id or uuid.uuid4(),
             title=s.validated_data["title"],
             owner=request.user,
             source="upload",
         )
-        chunks = simple_chunk(s.validated_data["text"])
-        vectors = embed_batch(chunks)
+        stats = ingest_chunks(doc, iter_chunks([s.validated_data["text"]]))
 
-        objs = [
-            Chunk(document=doc, order=i, text=t, embedding=v)
-            for i, (t, v) in enumerate(zip(chunks, vectors))
-        ]
-        Chunk.objects.bulk_create(objs, batch_size=200)  # sem SQL manual
-
-        return Response({"document_id": str(doc.id), "chunks": len(objs)},
+        return Response({"document_id": str(doc.id), "chunks": stats["chunks"]},
                         status=status.HTTP_201_CREATED)
 
 
@@ -111,16 +123,36 @@ class SearchView(APIView):
         parameters=[
             OpenApiParameter(name='q', type=OpenApiTypes.STR, description='Search query', required=True),
             OpenApiParameter(name='k', type=OpenApiTypes.INT, description='Number of results to return', default=5),
+            OpenApiParameter(name='document_ids', type=OpenApiTypes.STR, description='Comma-separated document ids to restrict the search'),
+            OpenApiParameter(name='plan_id', type=OpenApiTypes.UUID, description='Restrict the search to the RAG documents of a study plan'),
+            OpenApiParameter(name='mode', type=OpenApiTypes.STR, enum=list(SEARCH_MODES), default='vector',
+                             description='vector (cosine/HNSW), lexical (full-text pt-BR) or hybrid (both, merged with reciprocal rank fusion)'),
         ],
         responses={200: SearchResultSerializer(many=True), 400: {'description': 'Missing query parameter'}},
-        description="Performs a semantic search based on the query."
+        description="Performs a semantic search over the authenticated user's documents."
     )
     def get(self, request): 
         q = request.query_params.get("q", "") 
         k = int(request.query_params.get("k", "5")) 
         if not q: 
             return Response({"detail": "missing q"}, status=400) 
-        rows = semantic_search(q, k) 
+        document_ids = None
+        raw_ids = request.query_params.get("document_ids")
+        if raw_ids:
+            try:
+                document_ids = [uuid.UUID(v.strip()) for v in raw_ids.split(",") if v.strip()]
+            except ValueError:
+                return Response({"detail": "document_ids invalido"}, status=400)
+        plan = None
+        plan_id = request.query_params.get("plan_id")
+        if plan_id:
+            plan = StudyPlan.objects.filter(id=plan_id, user_context__user=request.user).first()
+            if not plan:
+                return Response({"detail": "Plano nao encontrado."}, status=404)
+        mode = request.query_params.get("mode", "vector")
+        if mode not in SEARCH_MODES:
+            return Response({"detail": f"mode deve ser um de {', '.join(SEARCH_MODES)}"}, status=400)
+        rows = semantic_search(q, k, owner=request.user, document_ids=document_ids, plan=plan, mode=mode) 
         return Response(rows)
 
 
@@ -142,17 +174,25 @@ class ChatView(APIView):
     def post(self, request):
         s = ChatRequestSerializer(data=request.data)
         s.is_valid(raise_exception=True)
-        session_id = str(uuid.uuid4())
+        chat = None
+        if s.validated_data.get("message"):
+            chat = open_session(request.user, s.validated_data.get("session_id"))
+            if chat is None:
+                return Response({"detail": "Sessao de chat nao encontrada."}, status=404)
+        session_id = str(chat.id) if chat else str(uuid.uuid4())
         print(json.dumps({
             "timestamp": datetime.now().isoformat(),
             "level": "INFO",
             "session_id": session_id,
             "event": "chat_request",
             "user": str(request.user),
-            "messages_count": len(s.validated_data['messages']),
-            "messages": s.validated_data['messages']
+            "messages_count": len(s.validated_data.get("messages") or []),
+            "messages": s.validated_data.get("messages") or [s.validated_data["message"]],
         }))
-        reply = chat_once(request.user, s.validated_data["messages"], session_id)
+        if chat:
+            reply = session_reply(request.user, chat, s.validated_data["message"])
+        else:
+            reply = chat_once(request.user, s.validated_data["messages"], session_id)
         logging.info(json.dumps({
             "timestamp": datetime.now().isoformat(),
             "level": "INFO",
@@ -161,10 +201,26 @@ class ChatView(APIView):
             "reply_length": len(reply),
             "reply": reply
         }))
-        return Response({"reply": reply}, status=status.HTTP_200_OK)
+        return Response({"reply": reply, "session_id": session_id}, status=status.HTTP_200_OK)
     
 
 
+def chat_packets(user, data: dict):
+    """
+    (session_id, eventos do chat) para um pedido validado. Com `message` usa a
+    sessao do servidor (o session_id da conversa tambem identifica o stream
+    para replay); com `messages` (legado) cada pedido e uma sessao avulsa.
+    Devolve None se o session_id nao for uma sessao do usuario.
+    """
+    if data.get("message"):
+        chat = open_session(user, data.get("session_id"))
+        if chat is None:
+            return None
+        return str(chat.id), session_stream(user, chat, data["message"])
+    session_id = str(uuid.uuid4())
+    return session_id, chat_stream(user, data["messages"], session_id)
+
+
 def encode_sse(event: str, data, event_id=None) -> str:
     """
     Encode a server-sent event with optional name and id.
@@ -208,23 +264,39 @@ class ChatSSEView(APIView):
         - `error`: Tratamento de erros
 
         **Fluxo típico**: session_started → tokens (assistant_response) → [tool calls] → [plan generation] → session_finished
+
+        **Sessão no servidor**: envie só `message` (e o `session_id` devolvido no header `X-Chat-Session` a partir
+        do 2º turno); o histórico é mantido no servidor. `messages` com o histórico completo segue aceito.
+
+        **Reconexão**: os eventos ficam num buffer por sessão (header `X-Chat-Session`). Reenvie o POST com
+        `?session_id=<id>` e o header `Last-Event-ID`, ou use GET /api/ai/chat/stream/<id>/, para receber só
+        os eventos perdidos sem gerar a resposta de novo.
         """
     )
     def post(self, request):
+        # fetch-event-source e similares repetem o POST ao reconectar: com
+        # Last-Event-ID + session_id a sessao e retomada do buffer, sem regenerar
+        resume_id = request.query_params.get("session_id")
+        if resume_id and request.headers.get("Last-Event-ID") is not None:
+            return _resume_chat_stream(request, resume_id)
         s = ChatRequestSerializer(data=request.data)
         s.is_valid(raise_exception=True)
-        session_id = str(uuid.uuid4())
+        packets = chat_packets(request.user, s.validated_data)
+        if packets is None:
+            return Response({"detail": "Sessao de chat nao encontrada."}, status=404)
+        session_id, packets = packets
         print(json.dumps({
             "timestamp": datetime.now().isoformat(),
             "level": "INFO",
             "session_id": session_id,
             "event": "chat_sse_request",
             "user": str(request.user),
-            "messages_count": len(s.validated_data['messages']),
-            "messages": s.validated_data['messages']
+            "messages_count": len(s.validated_data.get("messages") or []),
+            "messages": s.validated_data.get("messages") or [s.validated_data["message"]],
         }))
-        # chat_stream agora emite eventos estruturados {"event": ..., "data": {...}}
-        gen = chat_stream(request.user, s.validated_data["messages"], session_id)
+        # chat_stream agora emite eventos estruturados {"event": ..., "data": {...}};
+        # a thread produtora grava cada um no buffer de replay da sessao
+        gen = produce(session_id, request.user.id, packets)
         print(json.dumps({
             "timestamp": datetime.now().isoformat(),
             "level": "INFO",
@@ -237,12 +309,7 @@ class ChatSSEView(APIView):
             try:
                 event_index = 0
                 token_count = 0
-                for packet in gen:
-                    event_index += 1
-                    if not isinstance(packet, dict):
-                        packet = {"event": "message", "data": {"raw": packet}}
-                    event_name = packet.get("event") or "message"
-                    payload = packet.get("data", {})
+                for event_index, event_name, payload in gen:
                     if event_name == "token":
                         token_count += 1
                         preview = str(payload.get("text", ""))[:50]
@@ -281,9 +348,66 @@ class ChatSSEView(APIView):
         resp = StreamingHttpResponse(event_source(), content_type="text/event-stream")
         resp["Cache-Control"] = "no-cache"
         resp["X-Accel-Buffering"] = "no"  # Nginx: nÃ£o buferizar
+        resp["X-Chat-Session"] = session_id
         return resp
 
 
+def _last_event_id(request) -> int:
+    raw = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id") or "0"
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return 0
+
+
+def _resume_chat_stream(request, session_id: str):
+    owner = session_owner(session_id)
+    if owner is None or owner != str(request.user.id):
+        # buffer expirado (SSE_REPLAY_TTL_S) ou sessao de outro usuario
+        return Response({"detail": "Sessao nao encontrada ou expirada."}, status=404)
+    last_id = _last_event_id(request)
+    print(json.dumps({
+        "timestamp": datetime.now().isoformat(),
+        "session_id": session_id,
+        "event": "sse_stream_resumed",
+        "last_event_id": last_id,
+    }))
+
+    def event_source():
+        yield "retry: 1000\n\n"
+        for item in replay(session_id, last_id):
+            if item is None:
+                yield ": ping\n\n"
+                continue
+            event_id, event_name, payload = item
+            yield encode_sse(event_name, payload, event_id=event_id)
+
+    resp = StreamingHttpResponse(event_source(), content_type="text/event-stream")
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"
+    resp["X-Chat-Session"] = session_id
+    return resp
+
+
+class ChatSSEResumeView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        operation_id="resumeChatStream",
+        parameters=[
+            OpenApiParameter(name="Last-Event-ID", location=OpenApiParameter.HEADER, type=OpenApiTypes.INT,
+                             description="Ultimo id recebido; o EventSource envia sozinho ao reconectar."),
+            OpenApiParameter(name="last_event_id", type=OpenApiTypes.INT,
+                             description="Alternativa ao header para clientes que nao o controlam."),
+        ],
+        responses={200: {"description": "SSE com os eventos da sessao posteriores ao Last-Event-ID"},
+                   404: {"description": "Sessao expirada"}},
+        description="Retoma uma sessao de /chat/stream/ a partir do buffer (Redis Stream), sem chamar o modelo de novo.",
+    )
+    def get(self, request, session_id):
+        return _resume_chat_stream(request, str(session_id))
+
+
 class StudyPlanListView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -339,8 +463,12 @@ class GenerateStudyPlanView(APIView):
             job_id=job_id,
             metadata={"requested_goal_override": s.validated_data.get("goal_override")},
         )
-        generate_study_plan_task.apply_async(
+        job = create_job(request.user, "study_plan", job_id=job_id, plan=plan)
+        enqueue(
+            generate_study_plan_task,
+            job,
             args=[job_id, str(plan.id), str(study_context.id), s.validated_data.get("goal_override"), s.validated_data.get("title")],
+            kwargs={"force_regenerate": s.validated_data["force_regenerate"]},
             queue="ai_generation",
         )
         _log_api_event(
@@ -528,8 +656,12 @@ class GenerateSectionTasksView(APIView):
         plan.last_error = ""
         plan.job_id = job_id
         plan.save(update_fields=["generation_status", "last_error", "job_id"])
-        generate_section_tasks_task.apply_async(
+        job = create_job(request.user, "section_tasks", job_id=job_id, plan=plan)
+        enqueue(
+            generate_section_tasks_task,
+            job,
             args=[job_id, str(plan.id), section_id, str(request.user.id)],
+            kwargs={"force_regenerate": s.validated_data["force_regenerate"]},
             queue="ai_generation",
         )
         _log_api_event(
@@ -573,8 +705,12 @@ class GenerateStudyDayView(APIView):
         day.metadata = day_meta
         day.save(update_fields=["metadata"])
 
-        generate_study_day_task.apply_async(
+        job = create_job(request.user, "study_day", job_id=job_id, plan=plan, day=day)
+        enqueue(
+            generate_study_day_task,
+            job,
             args=[job_id, str(plan.id), str(day.id), s.validated_data["reset_existing"]],
+            kwargs={"force_regenerate": s.validated_data["force_regenerate"]},
             queue="ai_generation",
         )
         _log_api_event(
@@ -652,7 +788,10 @@ class StudyPlanDayCreateView(APIView):
             day_meta.update({"generation_status": "pending", "job_id": job_id})
             day.metadata = day_meta
             day.save(update_fields=["metadata"])
-            generate_study_day_task.apply_async(
+            job = create_job(request.user, "study_day", job_id=job_id, plan=plan, day=day)
+            enqueue(
+                generate_study_day_task,
+                job,
                 args=[job_id, str(plan.id), str(day.id), data.get("reset_existing", True)],
                 queue="ai_generation",
             )
@@ -743,7 +882,8 @@ class StudyPlanMaterialUploadView(APIView):
         operation_id="uploadStudyPlanMaterial",
         request=PlanMaterialUploadSerializer,
         responses={201: PlanMaterialUploadResponseSerializer},
-        description="Faz upload de arquivo, associa ao plano e o ingere no RAG (Document + chunks).",
+        description="Faz upload de arquivo, associa ao plano e o ingere no RAG (Document + chunks). "
+                    "Com `document_id`, atualiza um documento existente reaproveitando os chunks inalterados.",
     )
     @transaction.atomic
     def post(self, request, plan_id):
@@ -756,17 +896,45 @@ class StudyPlanMaterialUploadView(APIView):
 
         uploaded = s.validated_data["file"]
         job_id = str(uuid.uuid4())
+        target_id = s.validated_data.get("document_id")
+        doc = None
+        if target_id:
+            doc = Document.objects.select_for_update().filter(id=target_id, owner=request.user).first()
+            if not doc:
+                return Response({"detail": "Documento nao encontrado."}, status=404)
+            if doc.ingest_status in ("pending", "running"):
+                if not ingest_is_stale(doc):
+                    return Response({"detail": "Documento ja esta sendo ingerido."}, status=status.HTTP_409_CONFLICT)
+                # worker morto deixou o status preso: a nova ingestao assume o documento
+                _log_api_event(
+                    "study_plan_material_stale_ingest_replaced",
+                    user_id=str(request.user.id),
+                    document_id=str(doc.id),
+                    stale_job_id=doc.job_id,
+                )
+
         file_ref = FileRef.objects.create(file=uploaded)
         user_context = plan.user_context
         user_context.materials.add(file_ref)
 
-        doc = Document.objects.create(
-            title=s.validated_data.get("title") or uploaded.name,
-            owner=request.user,
-            source="study_plan_upload",
-            ingest_status="pending",
-            job_id=job_id,
-        )
+        if doc is not None:
+            doc.title = s.validated_data.get("title") or doc.title
+            doc.ingest_status = "pending"
+            doc.job_id = job_id
+            doc.last_error = ""
+            doc.chunks_total, doc.chunks_done, doc.ingest_checkpoint = None, 0, 0
+            doc.save(update_fields=[
+                "title", "ingest_status", "job_id", "last_error", "chunks_total", "chunks_done", "ingest_checkpoint",
+            ])
+        else:
+            doc = Document.objects.create(
+                title=s.validated_data.get("title") or uploaded.name,
+                owner=request.user,
+                source="study_plan_upload",
+                ingest_status="pending",
+                job_id=job_id,
+            )
+        mode = "reingest" if target_id else "ingest"
         _log_api_event(
             "study_plan_material_upload_enqueued",
             user_id=str(request.user.id),
@@ -774,40 +942,114 @@ class StudyPlanMaterialUploadView(APIView):
             job_id=job_id,
             document_id=str(doc.id),
             file_id=str(file_ref.id),
+            mode=mode,
         )
 
-        ingest_material_task.apply_async(
+        job = create_job(request.user, "ingest", job_id=job_id, plan=plan, document=doc)
+        enqueue(
+            ingest_material_task,
+            job,
             args=[job_id, str(plan.id), str(file_ref.id), str(doc.id), doc.title],
+            kwargs={"reingest": mode == "reingest"},
             queue="ingest",
         )
 
         return Response(
-            {"job_id": job_id, "plan_id": str(plan.id), "file_id": str(file_ref.id), "document_id": str(doc.id)},
+            {"job_id": job_id, "plan_id": str(plan.id), "file_id": str(file_ref.id), "document_id": str(doc.id),
+             "mode": mode},
             status=status.HTTP_202_ACCEPTED,
         )
 
 
+JOB_STREAM_HEARTBEAT_S = 15.0
+JOB_STREAM_MAX_S = 600  # depois disso o EventSource reconecta sozinho
+
+
+def _parse_job_ids(raw: str | None) -> list[uuid.UUID] | None:
+    ids = []
+    for part in (raw or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            ids.append(uuid.UUID(part))
+        except ValueError:
+            return None
+    return ids
+
+
+class JobListView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        operation_id="listJobs",
+        parameters=[
+            OpenApiParameter(name="ids", type=OpenApiTypes.STR,
+                             description="Job ids separados por virgula (max. 100). Sem ids, devolve os jobs mais recentes."),
+        ],
+        responses={200: JobStatusSerializer(many=True), 400: {"description": "ids invalidos"}},
+        description="Status de varios jobs numa unica consulta (polling em lote do frontend).",
+    )
+    def get(self, request):
+        raw = request.query_params.get("ids")
+        if raw is None:
+            jobs = user_jobs(request.user)[:20]
+        else:
+            ids = _parse_job_ids(raw)
+            if ids is None:
+                return Response({"detail": "ids invalidos"}, status=400)
+            jobs = user_jobs(request.user, ids=ids)
+        return Response(JobStatusSerializer(jobs, many=True).data)
+
+
 class JobStatusView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     @extend_schema(
         operation_id="jobStatus",
-        responses={200: JobStatusSerializer},
-        description="Consulta status de um job Celery.",
+        responses={200: JobStatusSerializer, 404: {"description": "Job nao encontrado"}},
+        description="Consulta status, progresso e resultado de um job.",
     )
     def get(self, request, job_id):
-        res = AsyncResult(job_id, app=celery_app)
-        data = {"job_id": job_id, "status": res.status.lower()}
-        if res.failed():
-            data["error"] = str(res.result)
-        if res.successful():
-            try:
-                data["result"] = res.result if isinstance(res.result, dict) else {"result": res.result}
-            except Exception:
-                data["result"] = None
-        ser = JobStatusSerializer(data=data)
-        ser.is_valid(raise_exception=True)
-        return Response(ser.data)
+        job = user_jobs(request.user).filter(id=job_id).first()
+        if not job:
+            return Response({"detail": "Job nao encontrado."}, status=404)
+        return Response(JobStatusSerializer(job).data)
+
+
+def _job_events(data: dict):
+    """Traduz um evento/snapshot de job nos eventos SSE do contrato (meta/progress/result/error)."""
+    job_id = str(data["job_id"])
+    if data.get("status"):
+        yield encode_sse("meta", {"job_id": job_id, "kind": data.get("kind"), "status": data["status"]})
+    if data.get("progress"):
+        yield encode_sse("progress", {"job_id": job_id, **data["progress"]})
+    if data.get("status") == "failed":
+        yield encode_sse("error", {"job_id": job_id, "message": data.get("error") or ""})
+    elif data.get("status") == "succeeded":
+        yield encode_sse("result", {"job_id": job_id, **(data.get("result") or {})})
+
+
+def _stream_jobs(user, job_id: str | None):
+    # jobs do snapshot inicial: o job pedido ou os ativos do usuario
+    jobs = user_jobs(user)
+    if job_id:
+        return jobs.filter(id=job_id)
+    return jobs.exclude(status__in=TERMINAL_STATUSES)[:MAX_BULK_IDS]
+
+
+def _job_message_events(raw: str, job_id: str | None) -> tuple[list[str], bool]:
+    """Eventos SSE de uma mensagem do pub/sub e se o stream de `job_id` terminou."""
+    payload = json.loads(raw)
+    if job_id and payload.get("job_id") != job_id:
+        return [], False
+    event = payload.pop("event", None)
+    if event == "token":
+        # texto do plano gerado pelo job chat_plan: mesmo evento do stream do chat
+        return [encode_sse("token", payload)], False
+    if event == "progress":
+        payload = {"job_id": payload.pop("job_id"), "kind": payload.pop("kind", None), "progress": payload}
+    return list(_job_events(payload)), bool(job_id and payload.get("status") in TERMINAL_STATUSES)
 
 
 class JobStreamView(APIView):
@@ -816,36 +1058,83 @@ class JobStreamView(APIView):
     @extend_schema(
         operation_id="jobStatusStream",
         parameters=[
-            OpenApiParameter(name="job_id", type=OpenApiTypes.STR, description="Job ID a acompanhar", required=True),
+            OpenApiParameter(name="job_id", type=OpenApiTypes.UUID,
+                             description="Job a acompanhar. Sem job_id, acompanha todos os jobs do usuario."),
         ],
-        responses={200: {"description": "SSE com status do job"}},
-        description="SSE que streama mudancas de status de um job Celery.",
+        responses={200: {"description": "SSE com status, progresso e tokens (chat_plan) dos jobs"}},
+        description="SSE alimentado por Redis pub/sub: os eventos sao empurrados pelas tasks, sem polling.",
     )
     def get(self, request):
-        job_id = request.query_params.get("job_id")
-        if not job_id:
-            return Response({"detail": "job_id obrigatorio"}, status=400)
+        job_id = None
+        if request.query_params.get("job_id"):
+            ids = _parse_job_ids(request.query_params["job_id"])
+            if not ids:
+                return Response({"detail": "job_id invalido"}, status=400)
+            job_id = str(ids[0])
+        jobs = _stream_jobs(request.user, job_id)
+        if job_id and not jobs.exists():
+            return Response({"detail": "Job nao encontrado."}, status=404)
+        channel = user_channel(request.user.id)
 
         def event_source():
-            res = AsyncResult(job_id, app=celery_app)
-            last_status = None
-            for _ in range(360):  # ~6 minutos
-                status_lower = res.status.lower()
-                if status_lower != last_status:
-                    yield encode_sse("meta", {"job_id": job_id, "status": status_lower})
-                    last_status = status_lower
-                if res.ready():
-                    if res.failed():
-                        yield encode_sse("error", {"job_id": job_id, "message": str(res.result)})
-                    else:
-                        payload = res.result if isinstance(res.result, dict) else {"result": res.result}
-                        yield encode_sse("result", {"job_id": job_id, **(payload or {})})
-                    break
-                time.sleep(1)
-            else:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            # assina antes de ler o snapshot: nenhum evento se perde entre os dois
+            pubsub.subscribe(channel)
+            try:
+                # estado duravel no Job: ao reconectar, o snapshot abaixo ja repoe o que se perdeu
+                yield "retry: 1000\n\n"
+                for job in jobs:
+                    data = JobStatusSerializer(job).data
+                    yield from _job_events(data)
+                    if job_id and data["status"] in TERMINAL_STATUSES:
+                        return
+                deadline = time.monotonic() + JOB_STREAM_MAX_S
+                while time.monotonic() < deadline:
+                    message = pubsub.get_message(timeout=blocking_wait(JOB_STREAM_HEARTBEAT_S))
+                    if message is None:
+                        yield ": ping\n\n"  # mantem proxies/navegador com a conexao aberta
+                        continue
+                    events, done = _job_message_events(message["data"], job_id)
+                    yield from events
+                    if done:
+                        return
                 yield encode_sse("meta", {"job_id": job_id, "status": "timeout"})
+            finally:
+                pubsub.close()
 
         resp = StreamingHttpResponse(event_source(), content_type="text/event-stream")
         resp["Cache-Control"] = "no-cache"
         resp["X-Accel-Buffering"] = "no"
         return resp
+
+
+class LLMMetricsView(APIView):
+    def get_permissions(self):
+        # scraper do Prometheus: token fixo no header, sem JWT (que expira)
+        token = self.request.headers.get("X-Metrics-Token", "")
+        # compare_digest so aceita str ASCII: em bytes um header com acento nega em vez de dar 500
+        if llm_metrics.LLM_METRICS_TOKEN and hmac.compare_digest(token.encode(), llm_metrics.LLM_METRICS_TOKEN.encode()):
+            return [permissions.AllowAny()]
+        return [permissions.IsAdminUser()]
+
+    @extend_schema(
+        operation_id="llmMetrics",
+        parameters=[
+            OpenApiParameter(name="scope", type=OpenApiTypes.STR,
+                             description="global (padrao): somado entre processos no Redis; local: so este processo."),
+        ],
+        responses={200: {"description": "Metricas no formato texto do Prometheus"}},
+        description="Histogramas de latencia, TTFT e tokens e contadores de chamadas/retries/cache por call site e modelo.",
+    )
+    def get(self, request):
+        series = cache = None
+        if request.query_params.get("scope", "global") != "local":
+            series = llm_metrics.global_snapshot()
+            cache = llm_cache.global_stats() or None
+        if series is None:
+            series = llm_metrics.local_snapshot()
+        if cache is None:
+            cache = llm_cache.cache_stats()
+        return HttpResponse(
+            llm_metrics.render_prometheus(series, cache), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -30,5 +30,5 @@ poetry run python manage.py migrate accounts
 # Depois migrar o resto
 poetry run python manage.py migrate --noinput
 
-# Sobe o servidor
-exec poetry run gunicorn --bind 0.0.0.0:8000 --workers 1 setup.wsgi:application --log-level info --access-logfile - --error-logfile - --capture-output --enable-stdio-inheritance
+# Sobe o servidor (ASGI: conexoes SSE abertas sao corrotinas, nao prendem o worker)
+exec poetry run gunicorn --bind 0.0.0.0:8000 --workers 1 --worker-class uvicorn_worker.UvicornWorker setup.asgi:application --log-level info --access-logfile - --error-logfile - --capture-output --enable-stdio-inheritance
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'setup.settings')
+# sob ASGI os streams SSE usam as views async (apps/ai/async_views.py)
+os.environ.setdefault('AI_ASYNC_SSE', 'true')
 
 application = get_asgi_application()
@@ -201,6 +201,12 @@ CELERY_TASK_QUEUES = {
 CELERY_TASK_TIME_LIMIT = int(os.getenv("CELERY_TASK_TIME_LIMIT", "300"))
 CELERY_TASK_SOFT_TIME_LIMIT = int(os.getenv("CELERY_TASK_SOFT_TIME_LIMIT", "280"))
 
+# Redis da aplicacao (eventos de jobs em pub/sub); por padrao o mesmo do broker
+REDIS_URL = os.getenv("REDIS_URL", CELERY_BROKER_URL)
+
+# Streams SSE (chat/jobs) pelas views async; ligado automaticamente por setup/asgi.py
+AI_ASYNC_SSE = os.getenv("AI_ASYNC_SSE", "false").lower() in ("1", "true", "yes", "on")
+
 SPECTACULAR_SETTINGS = {
     "TITLE": "Teacher Plus Backend API",
     "DESCRIPTION": "API for the Teacher Plus application",